@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+In-memory directory of registered callsign aliases (`hamfurs.aliases`).
+
+Every alias is indexed by Telegram user id, callsign and lower-cased
+handle so lookups never touch Mongo once the directory has loaded.  It
+is kept current from a Mongo change stream where the server supports one
+(replica sets), and otherwise by polling for recently `updated` aliases
+plus a periodic full reload to pick up deletions.  While polling, the
+change stream is retried with exponential backoff, so it comes back
+after e.g. a replica set election.  The bot's own /register and
+/unregister update it directly.
+"""
+
+import time
+import logging
+import threading
+
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger("HamfursBot.aliases")
+
+# Longest wait between attempts to open the change stream
+WATCH_RETRY_MAX = 3600
+
+
+class AliasDirectory(object):
+    def __init__(self, collection, poll_interval=30, reload_interval=600):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.reload_interval = reload_interval
+        self.users = {}
+        self.callsigns = {}
+        self.handles = {}
+        self.ids = {}
+        self.updated = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.running = False
+        self.streaming = False
+
+    def __contains__(self, callsign):
+        return callsign in self.callsigns
+
+    def __len__(self):
+        return len(self.users)
+
+    def all_callsigns(self):
+        with self.lock:
+            return list(self.callsigns)
+
+    def by_callsign(self, callsign):
+        callsign = callsign.upper()
+        if not self.ready.is_set():
+            return self.collection.find_one({"callsign": callsign})
+        return self.callsigns.get(callsign)
+
+    def by_handle(self, handle):
+        handle = handle.lower()
+        if not self.ready.is_set():
+            return self.collection.find_one({"user_name_lower": handle})
+        return self.handles.get(handle)
+
+    def put(self, document):
+        with self.lock:
+            self._remove(document["user_id"])
+            self.users[document["user_id"]] = document
+            self.callsigns[document["callsign"]] = document
+            if document.get("user_name_lower"):
+                self.handles[document["user_name_lower"]] = document
+            if "_id" in document:
+                self.ids[document["_id"]] = document["user_id"]
+            if document.get("updated", 0) > self.updated:
+                self.updated = document["updated"]
+
+    def remove(self, user_id):
+        with self.lock:
+            self._remove(user_id)
+
+    def _remove(self, user_id):
+        document = self.users.pop(user_id, None)
+        if document is None:
+            return
+        if self.callsigns.get(document["callsign"]) is document:
+            del self.callsigns[document["callsign"]]
+        handle = document.get("user_name_lower")
+        if handle and self.handles.get(handle) is document:
+            del self.handles[handle]
+        self.ids.pop(document.get("_id"), None)
+
+    def load(self):
+        users = {}
+        callsigns = {}
+        handles = {}
+        ids = {}
+        updated = 0
+        for document in self.collection.find({}):
+            users[document["user_id"]] = document
+            callsigns[document["callsign"]] = document
+            if document.get("user_name_lower"):
+                handles[document["user_name_lower"]] = document
+            ids[document["_id"]] = document["user_id"]
+            updated = max(updated, document.get("updated") or 0)
+        with self.lock:
+            self.users = users
+            self.callsigns = callsigns
+            self.handles = handles
+            self.ids = ids
+            self.updated = updated
+        self.ready.set()
+        logger.debug("Loaded {0} callsign aliases".format(len(users)))
+
+    def apply_change(self, change):
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            document = change.get("fullDocument")
+            if document is not None:
+                self.put(document)
+        elif operation == "delete":
+            user_id = self.ids.get(change["documentKey"]["_id"])
+            if user_id is not None:
+                self.remove(user_id)
+        elif operation in ("drop", "invalidate"):
+            self.load()
+
+    def start(self):
+        self.running = True
+        thread = threading.Thread(target=self.run, name="AliasDirectory", daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        backoff = self.poll_interval
+        while self.running:
+            self.streaming = False
+            try:
+                self.load()
+                self.watch()
+            except Exception as e:
+                if self.streaming:
+                    # It worked until now, try again soon
+                    backoff = self.poll_interval
+                logger.info(
+                    "Alias change stream unavailable, polling for {0}s ({1})".format(backoff, e)
+                )
+                self.poll(time.monotonic() + backoff)
+                backoff = min(backoff * 2, WATCH_RETRY_MAX)
+
+    def watch(self):
+        with self.collection.watch(full_document="updateLookup") as stream:
+            self.streaming = True
+            # Catch anything written between the load and the stream opening
+            self.poll_once()
+            for change in stream:
+                self.apply_change(change)
+                if not self.running:
+                    return
+
+    def poll_once(self):
+        for document in self.collection.find({"updated": {"$gte": self.updated}}):
+            self.put(document)
+
+    def poll(self, until=None):
+        """
+        Polls for changes until `until` (a time.monotonic() value), or
+        for as long as the directory runs.
+        """
+        reloaded = time.monotonic()
+        while self.running and (until is None or time.monotonic() < until):
+            time.sleep(self.poll_interval)
+            try:
+                stale = time.monotonic() - reloaded > self.reload_interval
+                if stale or not self.ready.is_set():
+                    self.load()
+                    reloaded = time.monotonic()
+                else:
+                    self.poll_once()
+            except PyMongoError as e:
+                logger.error("Unable to refresh callsign aliases: {0}".format(e))
@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+
+"""
+APRS-IS gateway (see NOTES).
+
+A single connection to APRS-IS with a server-side filter: messages for
+our callsign or the HAMFURS group, and positions of every callsign with
+a registered alias.  Packets are parsed locally, positions kept in a
+PositionCache so /where is answered from memory, and messages for us
+handed to a relay thread through a queue, which delivers them to
+Telegram and acks them on APRS-IS.
+
+The connection is re-established on errors and every 24 hours, and the
+filter is updated in place as aliases come and go.
+
+To time the parser over a capture (one TNC2 packet per line):
+
+  python3 aprs.py bench/aprs.txt
+"""
+
+import sys
+import time
+import queue
+import socket
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("HamfursBot.aprs")
+
+SERVER = "rotate.aprs2.net:14580"
+# Experimental tocall, see the APRS tocall list
+TOCALL = "APZHFB"
+VERSION = "HamfursBot 1.0"
+GROUP = "HAMFURS"
+
+SOCKET_TIMEOUT = 60
+RECONNECT_INTERVAL = 24 * 3600
+FILTER_INTERVAL = 300
+MAX_BACKOFF = 300
+MAX_MESSAGE = 67
+
+CACHE_SIZE = 10000
+# /where ignores anything older than this
+MAX_AGE = 24 * 3600
+# Messages are retried until acked; remember the ones already relayed
+SEEN_SIZE = 1000
+
+KNOTS_TO_KMH = 1.852
+
+
+def passcode(callsign):
+    """
+    The APRS-IS passcode for `callsign` (its SSID is ignored).
+    """
+    call = callsign.upper().split("-")[0]
+    code = 0x73E2
+    for i in range(0, len(call), 2):
+        code ^= ord(call[i]) << 8
+        if i + 1 < len(call):
+            code ^= ord(call[i + 1])
+    return code & 0x7FFF
+
+
+def base_callsign(callsign):
+    return callsign.split("-")[0]
+
+
+class Position(object):
+    __slots__ = (
+        "callsign",
+        "latitude",
+        "longitude",
+        "symbol",
+        "course",
+        "speed",
+        "comment",
+        "heard",
+    )
+
+    def __init__(self, callsign, latitude, longitude, symbol="", course=None, speed=None, comment="", heard=None):
+        self.callsign = callsign
+        self.latitude = latitude
+        self.longitude = longitude
+        self.symbol = symbol
+        self.course = course
+        # km/h
+        self.speed = speed
+        self.comment = comment
+        self.heard = heard if heard is not None else time.time()
+
+    def summary(self, now=None):
+        if now is None:
+            now = time.time()
+        age = int(now - self.heard)
+        if age < 60:
+            ago = "{0}s".format(age)
+        elif age < 3600:
+            ago = "{0} min".format(age // 60)
+        else:
+            ago = "{0}h {1:02d}m".format(age // 3600, (age % 3600) // 60)
+        text = "{0} heard {1} ago at {2:.4f}, {3:.4f}".format(
+            self.callsign, ago, self.latitude, self.longitude
+        )
+        if self.speed:
+            text += ", {0:.0f} km/h".format(self.speed)
+            if self.course:
+                text += " heading {0}°".format(self.course)
+        if self.comment:
+            text += "\n{0}".format(self.comment)
+        return text
+
+
+class Message(object):
+    __slots__ = ("source", "addressee", "text", "msgno")
+
+    def __init__(self, source, addressee, text, msgno=None):
+        self.source = source
+        self.addressee = addressee
+        self.text = text
+        self.msgno = msgno
+
+    @property
+    def is_ack(self):
+        return self.text.startswith(("ack", "rej")) and self.msgno is None and len(self.text) <= 8
+
+
+class Packet(object):
+    __slots__ = ("source", "destination", "path", "payload", "position", "message")
+
+    def __init__(self, source, destination, path, payload):
+        self.source = source
+        self.destination = destination
+        self.path = path
+        self.payload = payload
+        self.position = None
+        self.message = None
+
+
+def parse(line, now=None):
+    """
+    Parses a TNC2 formatted packet ("SRC>DEST,PATH:payload"), returning
+    a Packet (with .position or .message filled in when it carries one)
+    or None if it isn't a packet.  Only what the bot uses is decoded:
+    positions (plain, compressed and Mic-E) and messages.
+    """
+    header, sep, payload = line.partition(":")
+    if not sep or not payload:
+        return None
+    source, sep, route = header.partition(">")
+    if not sep or not source:
+        return None
+    destination, _, path = route.partition(",")
+    packet = Packet(source.upper(), destination, path, payload)
+
+    kind = payload[0]
+    try:
+        if kind in "!=":
+            packet.position = parse_position(packet.source, payload[1:], now)
+        elif kind in "/@":
+            # DDHHMMz or HHMMSSh timestamp first
+            packet.position = parse_position(packet.source, payload[8:], now)
+        elif kind in "`'":
+            packet.position = parse_mic_e(packet.source, destination, payload, now)
+        elif kind == ":":
+            packet.message = parse_message(packet.source, payload)
+    except (ValueError, IndexError):
+        pass
+    return packet
+
+
+def parse_position(source, data, now=None):
+    if data[:1].isdigit():
+        return parse_uncompressed(source, data, now)
+    return parse_compressed(source, data, now)
+
+
+def parse_uncompressed(source, data, now=None):
+    # DDMM.mmN/DDDMM.mmW$ with position ambiguity as spaces
+    lat = data[0:8].replace(" ", "0")
+    lon = data[9:18].replace(" ", "0")
+    latitude = int(lat[0:2]) + float(lat[2:7]) / 60
+    if lat[7] in "Ss":
+        latitude = -latitude
+    longitude = int(lon[0:3]) + float(lon[3:8]) / 60
+    if lon[8] in "Ww":
+        longitude = -longitude
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("position out of range")
+    symbol = data[8] + data[18]
+    comment = data[19:]
+    course = speed = None
+    # CSE/SPD extension
+    if len(comment) >= 7 and comment[3] == "/" and comment[:3].isdigit() and comment[4:7].isdigit():
+        course = int(comment[:3]) or None
+        speed = int(comment[4:7]) * KNOTS_TO_KMH
+        comment = comment[7:]
+    return Position(source, latitude, longitude, symbol, course, speed, comment.strip(), now)
+
+
+def base91(data):
+    value = 0
+    for c in data:
+        value = value * 91 + ord(c) - 33
+    return value
+
+
+def parse_compressed(source, data, now=None):
+    # /YYYYXXXX$csT
+    if len(data) < 13:
+        raise ValueError("short compressed position")
+    latitude = 90 - base91(data[1:5]) / 380926.0
+    longitude = -180 + base91(data[5:9]) / 190463.0
+    symbol = data[0] + data[9]
+    course = speed = None
+    c, s = ord(data[10]) - 33, ord(data[11]) - 33
+    if data[10] != " " and 0 <= c <= 89:
+        course = c * 4 or None
+        speed = (1.08 ** s - 1) * KNOTS_TO_KMH
+    return Position(source, latitude, longitude, symbol, course, speed, data[13:].strip(), now)
+
+
+def mic_e_digit(c):
+    if "0" <= c <= "9":
+        return ord(c) - 48
+    if "A" <= c <= "J":
+        return ord(c) - 65
+    if "P" <= c <= "Y":
+        return ord(c) - 80
+    # K, L and Z are ambiguity spaces
+    return 0
+
+
+def parse_mic_e(source, destination, data, now=None):
+    """
+    Mic-E packs the latitude into the destination callsign and the
+    longitude, course and speed into the first bytes of the payload.
+    """
+    dest = destination.split("-")[0]
+    if len(dest) < 6 or len(data) < 9:
+        raise ValueError("short Mic-E packet")
+    digits = [mic_e_digit(c) for c in dest[:6]]
+    latitude = digits[0] * 10 + digits[1] + (digits[2] * 10 + digits[3] + (digits[4] * 10 + digits[5]) / 100.0) / 60
+    if dest[3] <= "L":
+        latitude = -latitude
+
+    degrees = ord(data[1]) - 28
+    if dest[4] >= "P":
+        degrees += 100
+    if 180 <= degrees <= 189:
+        degrees -= 80
+    elif 190 <= degrees <= 199:
+        degrees -= 190
+    minutes = ord(data[2]) - 28
+    if minutes >= 60:
+        minutes -= 60
+    longitude = degrees + (minutes + (ord(data[3]) - 28) / 100.0) / 60
+    if dest[5] >= "P":
+        longitude = -longitude
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("position out of range")
+
+    sp, dc, se = ord(data[4]) - 28, ord(data[5]) - 28, ord(data[6]) - 28
+    speed = sp * 10 + dc // 10
+    course = (dc % 10) * 100 + se
+    if speed >= 800:
+        speed -= 800
+    if course >= 400:
+        course -= 400
+    symbol = data[8] + data[7]
+    return Position(source, latitude, longitude, symbol, course or None, speed * KNOTS_TO_KMH, data[9:].strip(), now)
+
+
+def parse_message(source, data):
+    # :ADDRESSEE:text{msgno
+    if len(data) < 11 or data[10] != ":":
+        raise ValueError("malformed message")
+    addressee = data[1:10].strip().upper()
+    text, _, msgno = data[11:].partition("{")
+    # Reply-ack capable stations send {MM}AA
+    msgno = msgno.split("}")[0] or None
+    return Message(source, addressee, text.rstrip(), msgno)
+
+
+class PositionCache(object):
+    """
+    Last known position of each station, LRU bounded.  Lookups by a
+    bare callsign return whichever of its SSIDs was heard last.
+    """
+
+    def __init__(self, capacity=CACHE_SIZE, max_age=MAX_AGE):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.positions = OrderedDict()
+        self.latest = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def put(self, position):
+        with self.lock:
+            self.positions[position.callsign] = position
+            self.positions.move_to_end(position.callsign)
+            self.latest[base_callsign(position.callsign)] = position.callsign
+            while len(self.positions) > self.capacity:
+                callsign, _ = self.positions.popitem(last=False)
+                if self.latest.get(base_callsign(callsign)) == callsign:
+                    del self.latest[base_callsign(callsign)]
+
+    def get(self, callsign, now=None):
+        if now is None:
+            now = time.time()
+        callsign = callsign.upper()
+        with self.lock:
+            if "-" not in callsign:
+                callsign = self.latest.get(callsign, callsign)
+            position = self.positions.get(callsign)
+        if position is None or now - position.heard > self.max_age:
+            return None
+        return position
+
+
+class Connection(object):
+    """
+    A logged in APRS-IS session.  Lines are read with readline(); the
+    server sends a keepalive comment every 20 seconds, so a read timing
+    out means the connection is dead.
+    """
+
+    def __init__(self, server, callsign, filter, timeout=SOCKET_TIMEOUT):
+        host, _, port = server.rpartition(":")
+        self.sock = socket.create_connection((host, int(port)), timeout=timeout)
+        self.file = self.sock.makefile("rb")
+        self.lock = threading.Lock()
+        self.write(
+            "user {0} pass {1} vers {2} filter {3}".format(
+                callsign, passcode(callsign), VERSION, filter
+            )
+        )
+
+    def write(self, line):
+        with self.lock:
+            self.sock.sendall(line.encode("utf-8") + b"\r\n")
+
+    def readline(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("APRS-IS closed the connection")
+        return line.decode("utf-8", "replace").rstrip("\r\n")
+
+    def close(self):
+        try:
+            self.file.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class Gateway(object):
+    """
+    Runs the APRS-IS connection and the relay in background threads.
+
+    `watched()` returns the callsigns whose positions to follow, and
+    `deliver(message)` is called from the relay thread with every
+    Message addressed to us or to the group.  When several bots share
+    the work (cluster.py), every one keeps positions but only the one
+    for which `leader()` is true acks and relays messages.
+    """
+
+    def __init__(self, callsign, watched, deliver, server=SERVER, extra_filter="", cache=None, leader=None):
+        self.callsign = callsign.upper()
+        self.watched = watched
+        self.deliver = deliver
+        self.leader = leader or (lambda: True)
+        self.server = server
+        self.extra_filter = extra_filter
+        self.positions = cache if cache is not None else PositionCache()
+        self.inbox = queue.Queue()
+        self.seen = OrderedDict()
+        self.connection = None
+        self.filter = None
+        self.running = False
+        self.packets = 0
+
+    def build_filter(self):
+        """
+        Messages for us and the group, plus the watched stations (any
+        SSID).
+        """
+        terms = ["g/{0}/{1}".format(self.callsign, GROUP)]
+        callsigns = sorted(set(base_callsign(c) for c in self.watched()))
+        if callsigns:
+            terms.append("b/" + "/".join(c + "*" for c in callsigns))
+        if self.extra_filter:
+            terms.append(self.extra_filter)
+        return " ".join(terms)
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, name="APRS-IS", daemon=True).start()
+        threading.Thread(target=self.relay, name="APRSRelay", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.inbox.put(None)
+        if self.connection is not None:
+            self.connection.close()
+
+    def run(self):
+        backoff = 1
+        while self.running:
+            try:
+                self.session()
+                backoff = 1
+            except (OSError, ValueError) as e:
+                if not self.running:
+                    return
+                logger.warning("APRS-IS connection lost ({0}), reconnecting in {1}s".format(e, backoff))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def session(self):
+        self.filter = self.build_filter()
+        self.connection = Connection(self.server, self.callsign, self.filter)
+        logger.info("Connected to APRS-IS at {0}".format(self.server))
+        opened = checked = time.monotonic()
+        try:
+            while self.running:
+                line = self.connection.readline()
+                if line.startswith("#"):
+                    logger.debug(line)
+                else:
+                    self.handle(line)
+
+                now = time.monotonic()
+                if now - checked > FILTER_INTERVAL:
+                    checked = now
+                    self.update_filter()
+                if now - opened > RECONNECT_INTERVAL:
+                    logger.info("Reopening the APRS-IS connection")
+                    return
+        finally:
+            self.connection.close()
+
+    def update_filter(self):
+        current = self.build_filter()
+        if current != self.filter:
+            self.connection.write("#filter {0}".format(current))
+            self.filter = current
+
+    def handle(self, line):
+        packet = parse(line)
+        if packet is None:
+            return
+        self.packets += 1
+        if packet.position is not None:
+            self.positions.put(packet.position)
+        message = packet.message
+        if message is None or message.addressee not in (self.callsign, GROUP):
+            return
+        if not self.leader():
+            return
+        if message.is_ack:
+            return
+        if message.msgno is not None and message.addressee == self.callsign:
+            self.send_message(message.source, "ack" + message.msgno)
+        key = (message.source, message.msgno or message.text)
+        if key in self.seen:
+            return
+        self.seen[key] = True
+        while len(self.seen) > SEEN_SIZE:
+            self.seen.popitem(last=False)
+        self.inbox.put(message)
+
+    def relay(self):
+        while True:
+            message = self.inbox.get()
+            if message is None:
+                return
+            try:
+                self.deliver(message)
+            except Exception as e:
+                logger.error("Unable to relay APRS message from {0}: {1}".format(message.source, e))
+
+    def send_message(self, addressee, text):
+        """
+        Sends an APRS message from our callsign.  Returns False if there
+        is no connection to send it on.
+        """
+        connection = self.connection
+        if connection is None:
+            return False
+        try:
+            connection.write(
+                "{0}>{1},TCPIP*::{2:<9}:{3}".format(self.callsign, TOCALL, addressee, text[:MAX_MESSAGE])
+            )
+        except OSError as e:
+            logger.warning("Unable to send APRS message to {0}: {1}".format(addressee, e))
+            return False
+        return True
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1], encoding="utf-8", errors="replace") as f:
+        lines = [line.rstrip("\r\n") for line in f if not line.startswith("#")]
+    repeat = max(1, 200000 // max(1, len(lines)))
+    start = time.perf_counter()
+    positions = messages = 0
+    for _ in range(repeat):
+        for line in lines:
+            packet = parse(line)
+            if packet is not None:
+                positions += packet.position is not None
+                messages += packet.message is not None
+    elapsed = time.perf_counter() - start
+    count = len(lines) * repeat
+    print(
+        "{0} packets in {1:.3f}s ({2:.0f} packets/s), {3} positions, {4} messages".format(
+            count, elapsed, count / elapsed, positions // repeat, messages // repeat
+        )
+    )
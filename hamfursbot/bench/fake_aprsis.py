@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for an APRS-IS server: accepts a login, replays a packet
+capture (one TNC2 packet or # comment per line) to every client, then
+sends keepalives.  Lines the client sends (acks, messages, #filter) are
+kept in `received`.
+
+  python3 bench/fake_aprsis.py bench/aprs.txt --port 14580
+"""
+
+import time
+import argparse
+import threading
+import socketserver
+
+KEEPALIVE = 20
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        self.send("# aprsc fake")
+        login = self.rfile.readline().decode("utf-8", "replace").strip()
+        server.logins.append(login)
+        callsign = login.split()[1] if len(login.split()) > 1 else "N0CALL"
+        self.send("# logresp {0} verified, server FAKE".format(callsign))
+        threading.Thread(target=self.listen, daemon=True).start()
+
+        for line in server.capture:
+            self.send(line)
+            if server.rate:
+                time.sleep(1.0 / server.rate)
+        while not server.closing.wait(KEEPALIVE):
+            self.send("# aprsc fake keepalive")
+
+    def listen(self):
+        for line in self.rfile:
+            self.server.received.append(line.decode("utf-8", "replace").strip())
+
+    def send(self, line):
+        self.wfile.write(line.encode("utf-8") + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeAPRSIS(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, capture, port=0, rate=0):
+        super().__init__(("127.0.0.1", port), Handler)
+        with open(capture, encoding="utf-8") as f:
+            self.capture = [line.rstrip("\r\n") for line in f if line.strip()]
+        self.rate = rate
+        self.logins = []
+        self.received = []
+        self.closing = threading.Event()
+
+    @property
+    def address(self):
+        return "{0}:{1}".format(*self.server_address)
+
+    @property
+    def packets(self):
+        return sum(1 for line in self.capture if not line.startswith("#"))
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="FakeAPRSIS", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.closing.set()
+        self.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay an APRS-IS capture to clients")
+    parser.add_argument("capture")
+    parser.add_argument("--port", type=int, default=14580)
+    parser.add_argument("--rate", type=float, default=0, help="packets per second, 0 for as fast as possible")
+    args = parser.parse_args()
+    server = FakeAPRSIS(args.capture, args.port, args.rate)
+    print("Replaying {0} packets on {1}".format(server.packets, server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.closing.set()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-ins for the services the bot talks to, all served from one
+HTTP server so the benchmark never leaves the box:
+
+  /bot<token>/<method>     Telegram Bot API (getUpdates serves `feed`,
+                           sends are logged in `sent`)
+  /callook/<call>/json     callook.info
+  /hamqth/xml.php          HamQTH XML API
+  /hamqsl/solar101vhf.php  hamqsl.com band conditions banner
+"""
+
+import json
+import time
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HAMQTH_NS = "https://www.hamqth.com"
+
+# 1x1 transparent GIF
+CONDITIONS_GIF = (
+    b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01"
+    b"\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;"
+)
+
+# Send methods answered with a media object, and its field
+MEDIA = {
+    "sendPhoto": "photo",
+    "sendVoice": "voice",
+    "sendDocument": "document",
+    "sendSticker": "sticker",
+}
+
+CALLOOK = {
+    "KF3RRY": {
+        "status": "VALID",
+        "type": "PERSON",
+        "current": {"callsign": "KF3RRY", "operClass": "EXTRA"},
+        "previous": {"callsign": "", "operClass": ""},
+        "trustee": {"callsign": "", "name": ""},
+        "name": "Test Operator",
+        "address": {"line1": "1 Main St", "line2": "ANYTOWN, VA 22201", "attn": ""},
+        "location": {"latitude": "38.88", "longitude": "-77.10", "gridsquare": "FM18lv"},
+        "otherInfo": {
+            "grantDate": "01/01/2015",
+            "expiryDate": "01/01/2025",
+            "lastActionDate": "01/01/2015",
+            "frn": "0000000000",
+            "ulsUrl": "http://wireless2.fcc.gov/UlsApp/UlsSearch/license.jsp?licKey=1",
+        },
+    },
+    "W1AW": {
+        "status": "VALID",
+        "type": "CLUB",
+        "current": {"callsign": "W1AW", "operClass": ""},
+        "previous": {"callsign": "", "operClass": ""},
+        "trustee": {"callsign": "K1ZZ", "name": "Trustee Name"},
+        "name": "ARRL HQ OPERATORS CLUB",
+        "address": {"line1": "225 Main St", "line2": "NEWINGTON, CT 06111", "attn": ""},
+        "location": {"latitude": "41.71", "longitude": "-72.72", "gridsquare": "FN31pr"},
+        "otherInfo": {
+            "grantDate": "01/01/2015",
+            "expiryDate": "01/01/2025",
+            "lastActionDate": "01/01/2015",
+            "frn": "0000000001",
+            "ulsUrl": "http://wireless2.fcc.gov/UlsApp/UlsSearch/license.jsp?licKey=2",
+        },
+    },
+}
+
+HAMQTH = {
+    "DL1ABC": {
+        "callsign": "dl1abc",
+        "nick": "Hans",
+        "adr_name": "Hans Test",
+        "adr_city": "Berlin",
+        "adr_zip": "10115",
+        "adr_country": "Germany",
+        "country": "Germany",
+        "grid": "JO62qm",
+        "utc_offset": "1",
+    },
+}
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.route()
+
+    def do_POST(self):
+        self.route()
+
+    def route(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = url.path.strip("/").split("/")
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        self.upload = "multipart" in self.headers.get("Content-Type", "")
+
+        if parts[0].startswith("bot"):
+            self.reply_json(self.telegram(parts[-1], query))
+        elif parts[0] == "callook":
+            call = parts[1].upper()
+            self.reply_json(CALLOOK.get(call, {"status": "INVALID"}))
+        elif parts[0] == "hamqth":
+            self.reply(self.hamqth(query), "text/xml")
+        elif parts[0] == "hamqsl":
+            self.reply(CONDITIONS_GIF, "image/gif")
+        else:
+            self.send_error(404)
+
+    def telegram(self, method, query):
+        server = self.server
+        chat_id = int(query.get("chat_id", 0) or 0)
+        chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "benchbot"}
+        elif method == "getChat":
+            result = chat
+        elif method == "getChatAdministrators":
+            result = []
+        elif method == "sendChatAction":
+            result = True
+        elif method == "getUpdates":
+            result = self.get_updates(int(query.get("offset", 0) or 0))
+        elif method in ("setWebhook", "deleteWebhook"):
+            result = True
+        else:
+            with server.lock:
+                server.message_id += 1
+                message_id = server.message_id
+            result = {
+                "message_id": int(query.get("message_id", message_id)),
+                "date": int(time.time()),
+                "chat": chat,
+                "text": query.get("text", ""),
+            }
+            if method in MEDIA:
+                field = MEDIA[method]
+                media = {"file_id": query.get(field) or "fake-{0}".format(message_id)}
+                media["file_unique_id"] = media["file_id"]
+                if field == "photo":
+                    media.update(width=1, height=1)
+                    media = [media]
+                elif field == "sticker":
+                    media.update(type="regular", width=1, height=1, is_animated=False, is_video=False)
+                elif field == "voice":
+                    media["duration"] = 1
+                result[field] = media
+        if method.startswith("send") and method != "sendChatAction":
+            self.record(method, chat_id, query)
+        if self.upload:
+            method += "[upload]"
+        with server.lock:
+            server.calls[method] = server.calls.get(method, 0) + 1
+        return {"ok": True, "result": result}
+
+    def get_updates(self, offset):
+        server = self.server
+        with server.lock:
+            result = [update for update in server.feed if update["update_id"] >= offset][:100]
+        if not result:
+            # Stand in for long polling
+            time.sleep(0.1)
+        return result
+
+    def record(self, method, chat_id, query):
+        reply_to = query.get("reply_to_message_id")
+        if "reply_parameters" in query:
+            reply_to = json.loads(query["reply_parameters"]).get("message_id")
+        with self.server.lock:
+            self.server.sent.append(
+                {
+                    "method": method,
+                    "chat_id": chat_id,
+                    "reply_to": int(reply_to) if reply_to else None,
+                    "text": query.get("text", ""),
+                }
+            )
+
+    def hamqth(self, query):
+        if "u" in query:
+            body = "<session><session_id>bench</session_id></session>"
+        else:
+            data = HAMQTH.get(query.get("callsign", "").upper())
+            if data is None:
+                body = "<session><error>Callsign not found</error></session>"
+            else:
+                fields = "".join("<{0}>{1}</{0}>".format(k, v) for k, v in data.items())
+                body = "<search>{0}</search>".format(fields)
+        return '<?xml version="1.0"?><HamQTH version="2.7" xmlns="{0}">{1}</HamQTH>'.format(
+            HAMQTH_NS, body
+        ).encode("utf-8")
+
+    def reply_json(self, data):
+        self.reply(json.dumps(data).encode("utf-8"), "application/json")
+
+    def reply(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeUpstream(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        super().__init__((host, port), FakeUpstreamHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.message_id = 1000
+        self.calls = {}
+        # Served by getUpdates, and what the bot sent
+        self.feed = []
+        self.sent = []
+
+    @property
+    def url(self):
+        return "http://{0}:{1}".format(*self.server_address)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="FakeUpstream", daemon=True).start()
+        return self
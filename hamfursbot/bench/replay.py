@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+"""
+Replays recorded Telegram updates through the bot's handlers and reports
+per-command latency (p50/p95/p99) and throughput.
+
+Telegram, callook.info, HamQTH and hamqsl.com are replaced by the local
+fakes in bench/fakes.py.  With --aprs the APRS-IS gateway is started
+against bench/fake_aprsis.py replaying a packet capture.  Mongo is whatever HAMFURS_MONGO_HOST points at
+(use a throwaway local instance), or mongomock with --mongomock (which
+currently needs pymongo<4.9 for bulk writes).
+
+  python3 bench/replay.py --iterations 200
+  python3 bench/replay.py --mongomock --updates my-recording.jsonl
+  python3 bench/replay.py --mongomock --aprs bench/aprs.txt
+
+Updates are read one JSON document per line; update and message ids are
+rewritten on every pass so edit tracking sees fresh messages.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BOT_DIR = os.path.dirname(HERE)
+sys.path.insert(0, BOT_DIR)
+sys.path.insert(0, HERE)
+
+import fakes
+import fake_aprsis
+
+PERCENTILES = (0.50, 0.95, 0.99)
+
+
+def percentile(samples, fraction):
+    index = max(0, int(math.ceil(fraction * len(samples))) - 1)
+    return samples[index]
+
+
+def command_of(update):
+    message = update.get("message") or update.get("edited_message") or {}
+    text = message.get("text", "")
+    if text.startswith("/"):
+        return text.split()[0].split("@")[0]
+    return "<{0}>".format("text" if text else "other")
+
+
+def load_updates(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def seed(client):
+    hamfurs = client.hamfurs
+    hamfurs.aliases.replace_one(
+        {"user_id": 42},
+        {
+            "callsign": "KF3RRY",
+            "user_id": 42,
+            "user_name": "benchuser",
+            "user_name_lower": "benchuser",
+            "user_first": "Bench",
+            "user_last": "User",
+            "updated": int(time.time()),
+        },
+        upsert=True,
+    )
+    hamfurs.definitions.replace_one(
+        {"index": "qsl"},
+        {
+            "term": "QSL",
+            "index": "qsl",
+            "keywords": ["qsl"],
+            "definition": "I acknowledge receipt",
+            "metaphone": ["KSL", ""],
+            "contributor": "HamFursBot",
+            "last_edit": "2017-01-02 12:00:00",
+        },
+        upsert=True,
+    )
+    client.ic.callbook.replace_one(
+        {"callsign": "VE3XYZ"},
+        {
+            "callsign": "VE3XYZ",
+            "name": "Jane",
+            "surname": "Doe",
+            "address": "1 Rue",
+            "city": "Ottawa",
+            "province": "ON",
+            "postcode": "K1A 0A1",
+            "qualifications": {
+                "basic": True,
+                "5wpm": False,
+                "12wpm": False,
+                "advanced": True,
+                "basic_honours": False,
+            },
+            "club": None,
+            "updated": int(time.time()),
+        },
+        upsert=True,
+    )
+    client.dmr_marc.users.replace_one(
+        {"callsign": "KF3RRY"}, {"callsign": "KF3RRY", "radio_id": 3100001}, upsert=True
+    )
+
+
+def setup(args, upstream, aprs_server=None):
+    os.environ.setdefault("TELEGRAM_API_TOKEN", "1:bench")
+    os.environ.setdefault("HAMFURS_CHAT_ID", "-1001000000000")
+    os.environ.setdefault("HAMFURS_HAMQTH_USER", "bench")
+    os.environ.setdefault("HAMFURS_HAMQTH_PASS", "bench")
+    os.environ.setdefault("HAMFURS_MONGO_HOST", "localhost")
+    if aprs_server is not None:
+        os.environ["HAMFURS_APRS_SERVER"] = aprs_server.address
+    os.chdir(BOT_DIR)
+
+    if args.mongomock:
+        import mongomock
+        import pymongo
+
+        pymongo.MongoClient = mongomock.MongoClient
+
+    from telebot import apihelper
+    import hamqth
+    import outbox
+    import ratelimit
+
+    apihelper.API_URL = upstream.url + "/bot{0}/{1}"
+    hamqth.ENDPOINTS = {
+        "auth": upstream.url + "/hamqth/xml.php?u={username}&p={password}",
+        "callbook": upstream.url
+        + "/hamqth/xml.php?id={id}&callsign={callsign}&prg={agent}",
+    }
+    # Measure the handlers, not Telegram's flood limits
+    outbox.GLOBAL_RATE = outbox.GLOBAL_BURST = 1e6
+    outbox.GROUP_RATE = outbox.GROUP_BURST = 1e6
+    outbox.PRIVATE_RATE = outbox.PRIVATE_BURST = 1e6
+    # ...nor the command budgets
+    ratelimit.BUDGETS = {
+        key: {scope: (1e6, 1e6) for scope in budget} for key, budget in ratelimit.BUDGETS.items()
+    }
+
+    import main
+
+    main.CALLOOK_URL = upstream.url + "/callook/{0}/json"
+    main.CONDITIONS_URL = upstream.url + "/hamqsl/solar101vhf.php"
+    seed(main.mongo_client)
+    return main
+
+
+def wait_for_aprs(gateway, aprs_server, timeout=10):
+    """
+    Waits until the gateway has parsed the whole capture, so /where
+    sees every position.
+    """
+    start = time.perf_counter()
+    while gateway.packets < aprs_server.packets - 1 and time.perf_counter() - start < timeout:
+        time.sleep(0.01)
+
+
+def run(bot, updates, iterations, warmup):
+    from telebot import types
+
+    timings = {}
+    update_id = 0
+    message_id = 0
+    started = None
+    for iteration in range(warmup + iterations):
+        if iteration == warmup:
+            started = time.perf_counter()
+        for recorded in updates:
+            update_id += 1
+            message_id += 1
+            update = dict(recorded, update_id=update_id)
+            for kind in ("message", "edited_message"):
+                if kind in update:
+                    update[kind] = dict(update[kind], message_id=message_id)
+            parsed = types.Update.de_json(update)
+
+            start = time.perf_counter()
+            bot.process_new_updates([parsed])
+            elapsed = time.perf_counter() - start
+            if iteration >= warmup:
+                timings.setdefault(command_of(update), []).append(elapsed)
+    return timings, time.perf_counter() - started
+
+
+def drain(outbox, timeout=30):
+    start = time.perf_counter()
+    while len(outbox) and time.perf_counter() - start < timeout:
+        time.sleep(0.001)
+    return time.perf_counter() - start
+
+
+def report(timings, wall):
+    header = "{0:<18} {1:>7} {2:>9} {3:>9} {4:>9} {5:>10}".format(
+        "command", "count", "p50 ms", "p95 ms", "p99 ms", "req/s"
+    )
+    print(header)
+    print("-" * len(header))
+    total = 0
+    for command in sorted(timings):
+        samples = sorted(timings[command])
+        total += len(samples)
+        row = [percentile(samples, p) * 1000 for p in PERCENTILES]
+        print(
+            "{0:<18} {1:>7} {2:>9.2f} {3:>9.2f} {4:>9.2f} {5:>10.1f}".format(
+                command, len(samples), row[0], row[1], row[2], len(samples) / sum(samples)
+            )
+        )
+    print("-" * len(header))
+    print("{0} updates in {1:.2f}s ({2:.1f} updates/s)".format(total, wall, total / wall))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--updates",
+        default=os.path.join(HERE, "updates.jsonl"),
+        help="recorded updates, one JSON document per line",
+    )
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds of artificial delay added to every upstream response",
+    )
+    parser.add_argument("--mongomock", action="store_true", help="use mongomock for Mongo")
+    parser.add_argument("--aprs", metavar="CAPTURE", help="APRS-IS capture to replay to the gateway")
+    args = parser.parse_args()
+
+    updates = load_updates(os.path.abspath(args.updates))
+    upstream = fakes.FakeUpstream(latency=args.latency).start()
+    aprs_server = None
+    if args.aprs:
+        aprs_server = fake_aprsis.FakeAPRSIS(os.path.abspath(args.aprs)).start()
+    bot_main = setup(args, upstream, aprs_server)
+    if aprs_server is not None:
+        wait_for_aprs(bot_main.aprs_gateway, aprs_server)
+
+    timings, wall = run(bot_main.bot, updates, args.iterations, args.warmup)
+    report(timings, wall)
+    print("Outbox drained {0:.3f}s after the last update".format(drain(bot_main.bot.outbox)))
+    print("Upstream calls: {0}".format(json.dumps(upstream.calls, sort_keys=True)))
+    if aprs_server is not None:
+        gateway = bot_main.aprs_gateway
+        print(
+            "APRS-IS: {0} packets, {1} positions cached, sent {2}".format(
+                gateway.packets, len(gateway.positions), json.dumps(aprs_server.received)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
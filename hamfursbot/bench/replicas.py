@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+Runs several clustered replicas against one Mongo and checks that every
+update is answered exactly once and every chat in order.
+
+By default each replica is a separate `main.py` process talking to the
+fake Telegram in bench/fakes.py, so it needs a throwaway Mongo at
+HAMFURS_MONGO_HOST (the queue and lease collections are cleared first).
+With --threads the replicas are cluster.Cluster instances in this
+process sharing mongomock, which exercises the election, queueing and
+chat locks without a Mongo server.
+
+  python3 bench/replicas.py --replicas 3 --chats 20 --updates 600
+  python3 bench/replicas.py --replicas 3 --kill-leader
+  python3 bench/replicas.py --threads --replicas 4
+
+--kill-leader SIGKILLs (or, with --threads, stops) the leader halfway
+through; updates it was processing at that moment are reported as
+abandoned rather than answered.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import threading
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BOT_DIR = os.path.dirname(HERE)
+sys.path.insert(0, BOT_DIR)
+sys.path.insert(0, HERE)
+
+import fakes
+
+GRIDS = ["FN25", "FM18", "JO59", "JO22", "IO91", "QF22", "PM95", "EM10"]
+
+
+def make_updates(count, chats, start=1):
+    """
+    `count` /distance commands spread randomly over `chats` chats, with
+    message ids increasing within each chat.
+    """
+    updates = []
+    message_ids = {}
+    for update_id in range(start, start + count):
+        chat_id = -1001000000000 - random.randrange(chats)
+        message_ids[chat_id] = message_ids.get(chat_id, 0) + 1
+        text = "/distance {0} {1}".format(*random.sample(GRIDS, 2))
+        updates.append(
+            {
+                "update_id": update_id,
+                "message": {
+                    "message_id": message_ids[chat_id],
+                    "date": int(time.time()),
+                    "from": {"id": 42, "is_bot": False, "first_name": "Bench", "username": "benchuser"},
+                    "chat": {"id": chat_id, "type": "supergroup", "title": "Bench"},
+                    "text": text,
+                    "entities": [{"type": "bot_command", "offset": 0, "length": 9}],
+                },
+            }
+        )
+    return updates
+
+
+def check(updates, replies, abandoned=()):
+    """
+    Compares replies [(chat_id, reply_to message_id)] with the updates.
+    Returns (missing, duplicated, out of order chats).
+    """
+    expected = {(u["message"]["chat"]["id"], u["message"]["message_id"]) for u in updates}
+    seen = {}
+    order = {}
+    for chat_id, message_id in replies:
+        seen[(chat_id, message_id)] = seen.get((chat_id, message_id), 0) + 1
+        order.setdefault(chat_id, []).append(message_id)
+    missing = expected - set(seen) - set(abandoned)
+    duplicated = [key for key, count in seen.items() if count > 1]
+    unordered = [chat_id for chat_id, ids in order.items() if ids != sorted(ids)]
+    return missing, duplicated, unordered
+
+
+def report(updates, replies, abandoned, wall, distribution):
+    missing, duplicated, unordered = check(updates, replies, abandoned)
+    print("{0} updates answered in {1:.2f}s ({2:.1f} updates/s)".format(len(replies), wall, len(replies) / wall))
+    print("Per replica: {0}".format(json.dumps(distribution, sort_keys=True)))
+    print("Abandoned {0}, missing {1}, duplicated {2}, chats out of order {3}".format(
+        len(abandoned), len(missing), len(duplicated), len(unordered)
+    ))
+    return not (missing or duplicated or unordered)
+
+
+def wait(condition, timeout):
+    start = time.perf_counter()
+    while not condition() and time.perf_counter() - start < timeout:
+        time.sleep(0.05)
+    return condition()
+
+
+def abandoned_updates(db):
+    return [
+        (document["chat_id"], document["update"]["message"]["message_id"])
+        for document in db.updates.find({"state": "abandoned"})
+    ]
+
+
+def run_threads(args, updates):
+    import mongomock
+
+    import cluster
+
+    db = mongomock.MongoClient().hamfurs
+    replies = []
+    lock = threading.Lock()
+    distribution = {}
+
+    def replica(name):
+        member = cluster.Cluster(db, name, args.workers, lease_ttl=args.lease_ttl, linger=args.linger)
+
+        def process(parsed):
+            for update in parsed:
+                # Roughly what a /distance reply costs
+                time.sleep(0.002)
+                with lock:
+                    replies.append((update.message.chat.id, update.message.message_id))
+                    distribution[name] = distribution.get(name, 0) + 1
+
+        member.start(process)
+        return member
+
+    members = [replica("replica-{0}".format(number)) for number in range(args.replicas)]
+    if not wait(lambda: any(member.is_leader for member in members), args.lease_ttl * 2):
+        print("No leader elected")
+        return False
+
+    # The leader's intake, fed in batches like getUpdates returns them
+    start = time.perf_counter()
+    half = len(updates) // 2
+    for offset in range(0, len(updates), 100):
+        if args.kill_leader and offset >= half and members[0].running:
+            leader = next(member for member in members if member.is_leader)
+            print("Stopping leader {0}".format(leader.replica_id))
+            leader.running = False
+            wait(lambda: any(member.is_leader for member in members if member.running), args.lease_ttl * 2)
+        leader = next(member for member in members if member.running and member.is_leader)
+        leader.push(updates[offset : offset + 100])
+        leader.push(updates[max(0, offset - 50) : offset + 50])
+
+    wait(lambda: len(replies) + len(abandoned_updates(db)) >= len(updates), 60)
+    wall = time.perf_counter() - start
+    for member in members:
+        member.stop()
+    return report(updates, replies, abandoned_updates(db), wall, distribution)
+
+
+def run_processes(args, updates):
+    import pymongo
+
+    host = os.environ.setdefault("HAMFURS_MONGO_HOST", "localhost")
+    db = pymongo.MongoClient(host).hamfurs
+    for name in ("updates", "leases", "chat_locks"):
+        db[name].drop()
+
+    upstream = fakes.FakeUpstream(latency=args.latency).start()
+    upstream.feed = updates
+    replicas = {}
+    for number in range(args.replicas):
+        name = "replica-{0}".format(number)
+        replicas[name] = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--child", name, "--upstream", upstream.url,
+             "--workers", str(args.workers)],
+        )
+
+    def replies():
+        with upstream.lock:
+            return [(s["chat_id"], s["reply_to"]) for s in upstream.sent if s["reply_to"]]
+
+    start = time.perf_counter()
+    try:
+        if args.kill_leader:
+            wait(lambda: len(replies()) >= len(updates) // 2, 60)
+            lease = db.leases.find_one({"_id": "leader"})
+            if lease is not None and lease["owner"] in replicas:
+                print("Killing leader {0}".format(lease["owner"]))
+                replicas.pop(lease["owner"]).send_signal(signal.SIGKILL)
+        wait(lambda: len(replies()) + len(abandoned_updates(db)) >= len(updates), 120)
+        wall = time.perf_counter() - start
+    finally:
+        for process in replicas.values():
+            process.terminate()
+        for process in replicas.values():
+            process.wait()
+
+    distribution = {}
+    for document in db.updates.find({"state": "done"}, {"owner": True}):
+        name = document["owner"].split("/")[0]
+        distribution[name] = distribution.get(name, 0) + 1
+    return report(updates, replies(), abandoned_updates(db), wall, distribution)
+
+
+def child(args):
+    """
+    One replica process: the real bot, polling the fake Telegram.
+    """
+    import replay
+
+    upstream = argparse.Namespace(url=args.upstream)
+    bot_main = replay.setup(argparse.Namespace(mongomock=False), upstream)
+    bot_main.bot.cluster_mode(args.child, args.workers)
+    bot_main.bot.polling(none_stop=True, timeout=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=4, help="workers per replica")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--updates", type=int, default=600)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--kill-leader", action="store_true")
+    parser.add_argument("--threads", action="store_true", help="in-process replicas on mongomock")
+    parser.add_argument("--lease-ttl", type=float, default=3, help="leader lease TTL with --threads")
+    parser.add_argument("--linger", type=float, default=2, help="chat linger with --threads")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--upstream", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+    random.seed(args.seed)
+    updates = make_updates(args.updates, args.chats)
+    ok = run_threads(args, updates) if args.threads else run_processes(args, updates)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
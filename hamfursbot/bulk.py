@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+Looks up many callsigns at once, e.g. a net control check-in list.
+
+Callsigns are grouped by the callbook that should hold them: the local
+IC and Nkom callbooks are read with one `$in` query each, and everything
+else goes to callook.info/HamQTH concurrently through the `remote`
+callable.  Used by /lookup_many and by cron/lookup/routes.py.
+"""
+
+import re
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import callbook
+
+logger = logging.getLogger("HamfursBot.bulk")
+
+MAX_CALLSIGNS = 50
+WORKERS = 8
+
+CALLSIGN_REGEX = re.compile(r"^[A-Z0-9]{1,3}[0-9][A-Z0-9]{0,4}(/[A-Z0-9]{1,4})?$")
+SEPARATORS = re.compile(r"[\s,;]+")
+
+COLUMNS = (("Call", 10), ("Name", 22), ("Location", 22), ("Src", 7))
+
+
+def parse_callsigns(text):
+    """
+    Returns the distinct, upper-cased callsigns in `text` and a list of
+    the words that didn't look like one.
+    """
+    callsigns = []
+    invalid = []
+    for word in SEPARATORS.split(text.upper()):
+        if not word:
+            continue
+        if CALLSIGN_REGEX.match(word):
+            if word not in callsigns:
+                callsigns.append(word)
+        else:
+            invalid.append(word)
+    return callsigns, invalid
+
+
+class BulkLookup(object):
+    def __init__(self, client, remote, workers=WORKERS):
+        """
+        `client` is a MongoClient; `remote(callsign)` returns a Record
+        (or None) from the remote callbooks.
+        """
+        self.client = client
+        self.remote = remote
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="BulkLookup")
+
+    def lookup(self, callsigns):
+        """
+        Returns an OrderedDict of callsign -> Record (None when not found)
+        in the order given.
+        """
+        groups = {}
+        for callsign in callsigns:
+            groups.setdefault(callbook.source_for(callsign), []).append(callsign)
+
+        # Start the slow remote lookups first so they overlap the local ones
+        remote = groups.get(callbook.CALLOOK, [])
+        futures = [self.executor.submit(self.remote_one, c) for c in remote]
+
+        found = {}
+        if callbook.IC in groups:
+            found.update(
+                self.local(self.client.ic.callbook, groups[callbook.IC], callbook.from_ic)
+            )
+        if callbook.NKOM in groups:
+            found.update(
+                self.local(
+                    self.client.nkom.callbook, groups[callbook.NKOM], callbook.from_nkom
+                )
+            )
+        for callsign, future in zip(remote, futures):
+            found[callsign] = future.result()
+
+        return OrderedDict((c, found.get(c)) for c in callsigns)
+
+    def local(self, collection, callsigns, adapter):
+        return {
+            document["callsign"]: adapter(document)
+            for document in collection.find({"callsign": {"$in": callsigns}})
+        }
+
+    def remote_one(self, callsign):
+        try:
+            return self.remote(callsign)
+        except Exception as e:
+            logger.error("Remote lookup of {0} failed: {1}".format(callsign, e))
+            return None
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def location(record):
+    if record.source == callbook.CALLOOK:
+        return record.address
+    if record.source == callbook.IC:
+        return "{0}, {1}".format(record.city, record.region)
+    return "{0}, {1}".format(record.city, record.country)
+
+
+def display_name(record):
+    if record.source == callbook.IC and record.kind == "Club":
+        return record.club
+    return " ".join(part for part in (record.name, record.surname) if part)
+
+
+def clip(value, width):
+    value = "" if value is None else str(value)
+    if len(value) > width:
+        return value[: width - 1] + "~"
+    return value.ljust(width)
+
+
+def rows(results):
+    """
+    Returns one (callsign, name, location, source) tuple per result.
+    """
+    for callsign, record in results.items():
+        if record is None:
+            yield callsign, "not found", "", ""
+        else:
+            yield record.callsign, display_name(record), location(record), record.source
+
+
+def table(results):
+    """
+    Formats lookup results as a fixed-width table for a Markdown code
+    block.
+    """
+    lines = [" ".join(clip(title, width) for title, width in COLUMNS).rstrip()]
+    for row in rows(results):
+        cells = zip(row, COLUMNS)
+        lines.append(
+            " ".join(clip(cell, width) for cell, (_, width) in cells)
+            .rstrip()
+            .replace("`", "'")
+        )
+    return "\n".join(lines)
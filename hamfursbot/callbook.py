@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+"""
+Source-independent callbook records.
+
+Each source (IC, Nkom, callook.info, HamQTH) has an adapter that flattens
+its document into a `Record`, and every record renders through a
+template compiled once at import.  Records pack into small BSON
+documents with one-letter keys, which is what `RecordCache` keeps for
+remote lookups so repeated /callsign requests don't hit callook.info or
+HamQTH again.
+"""
+
+import time
+import string
+import threading
+from collections import OrderedDict
+
+import bson
+import requests
+
+IC = "ic"
+NKOM = "nkom"
+CALLOOK = "callook"
+HAMQTH = "hamqth"
+
+CANADA_PREFIXES = ("VE", "VA", "VO", "VY", "CY")
+NORWAY_PREFIXES = ("JW", "JX", "3Y") + tuple(
+    "L" + chr(c) for c in range(ord("A"), ord("N") + 1)
+)
+
+IC_QUALIFICATIONS = (
+    ("basic", "Basic"),
+    ("5wpm", "5WPM"),
+    ("12wpm", "12WPM"),
+    ("advanced", "Advanced"),
+    ("basic_honours", "Basic Honours"),
+)
+
+
+class Template(object):
+    """
+    A `str.format` template with plain field names, split into literal
+    and field parts up front.  Fields are looked up on the record first
+    and then in the keyword arguments passed to render().
+    """
+
+    def __init__(self, text):
+        self.parts = tuple(
+            (literal, field)
+            for literal, field, _, _ in string.Formatter().parse(text)
+        )
+
+    def render(self, record, **extra):
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is not None:
+                if field in extra:
+                    value = extra[field]
+                else:
+                    value = getattr(record, field)
+                out.append(str(value))
+        return "".join(out)
+
+
+TEMPLATES = {
+    (IC, "Person"): Template(
+        u"""\U0001f1e8\U0001f1e6 *{callsign}* - (Person) {oper_class}
+*Name:* {name} {surname}
+*Alias:* {alias}
+*Location:* {city}, {region} {postcode}"""
+    ),
+    (IC, "Club"): Template(
+        u"""\U0001f1e8\U0001f1e6 *{callsign}* - (Club)
+*Name*: {club} {club2}
+*Trustee*: {name} {surname}
+*Club location*: {club_city}, {club_region} {club_postcode}"""
+    ),
+    NKOM: Template(
+        u"""\U0001f1f3\U0001f1f4 *{callsign}* - ({kind})
+*Name:* {name} {surname}{club}
+*Updated:* {updated}
+*Location:* {city}, {country} {postcode}"""
+    ),
+    (NKOM, "alias"): Template(
+        u"""\U0001f1f3\U0001f1f4 *{callsign}* - ({kind})
+*Name:* {name} {surname}{club}
+*Alias:* {alias}
+*Updated:* {updated}
+*Location:* {city}, {country} {postcode}"""
+    ),
+    CALLOOK: Template(
+        u"""\U0001f1fa\U0001f1f8 *{callsign}* - ({kind}) {oper_class} {ve}
+*Name:* {name}
+*Alias:* {alias}{dmr}
+*Location:* {address} ({grid})
+*Granted:* {granted}
+*Expiry:* {expires}
+[ULS license page]({url})
+"""
+    ),
+    (CALLOOK, "trustee"): Template(u"*Trustee:* {trustee}, {trustee_name}"),
+    HAMQTH: Template(
+        u"""{flag} *{callsign}* (UTC{utc_offset})
+*Name:* {name} ({nick})
+*Alias:* {alias}
+*Location:* {city}, {country} {postcode} ({grid})
+[HamQTH Profile](https://www.hamqth.com/{callsign})
+"""
+    ),
+}
+
+
+class Record(object):
+    # Slot name -> key in the packed document
+    FIELDS = OrderedDict(
+        (
+            ("source", "s"),
+            ("callsign", "c"),
+            ("kind", "k"),
+            ("name", "n"),
+            ("surname", "sn"),
+            ("oper_class", "o"),
+            ("address", "a"),
+            ("city", "ci"),
+            ("region", "r"),
+            ("postcode", "p"),
+            ("country", "co"),
+            ("grid", "g"),
+            ("latitude", "la"),
+            ("longitude", "lo"),
+            ("flag", "f"),
+            ("nick", "ni"),
+            ("utc_offset", "u"),
+            ("club", "cl"),
+            ("club2", "cl2"),
+            ("club_city", "cc"),
+            ("club_region", "cr"),
+            ("club_postcode", "cp"),
+            ("trustee", "t"),
+            ("trustee_name", "tn"),
+            ("granted", "gr"),
+            ("expires", "e"),
+            ("updated", "up"),
+            ("url", "url"),
+        )
+    )
+    KEYS = dict((key, field) for field, key in FIELDS.items())
+
+    __slots__ = tuple(FIELDS)
+
+    def __init__(self, source, callsign, **fields):
+        self.source = source
+        self.callsign = callsign
+        for field in self.__slots__[2:]:
+            setattr(self, field, fields.pop(field, None))
+        if fields:
+            raise TypeError("Unknown record fields: {0}".format(", ".join(fields)))
+
+    def __repr__(self):
+        return "<Record {0} {1}>".format(self.source, self.callsign)
+
+    def template(self, alias=None):
+        if self.source == IC:
+            return TEMPLATES[(IC, self.kind)]
+        if self.source == NKOM and alias is not None:
+            return TEMPLATES[(NKOM, "alias")]
+        return TEMPLATES[self.source]
+
+    def render(self, alias=None, dmr_id=None, ve=None, trustee_alias=None):
+        """
+        Renders the Markdown reply for this record.  `alias` is the
+        escaped alias text, `ve` the callook VE session count line and
+        `trustee_alias` the alias document for a club's trustee.
+        """
+        dmr = "" if dmr_id is None else "\n*DMR ID*: {0}".format(dmr_id)
+        if self.source == CALLOOK:
+            text = self.template().render(self, alias=alias, dmr=dmr, ve=ve or "")
+            if self.kind == "Club":
+                trustee_name = self.trustee_name
+                if trustee_alias:
+                    trustee_name = "@{0}".format(trustee_alias["user_name"])
+                text += TEMPLATES[(CALLOOK, "trustee")].render(
+                    self, trustee_name=trustee_name
+                )
+            return text
+        return self.template(alias).render(self, alias=alias) + dmr
+
+    def to_document(self):
+        """
+        Returns the compact BSON-ready form, leaving out empty fields.
+        """
+        document = {}
+        for field, key in self.FIELDS.items():
+            value = getattr(self, field)
+            if value is not None:
+                document[key] = value
+        return document
+
+    @classmethod
+    def from_document(cls, document):
+        fields = dict((cls.KEYS[key], value) for key, value in document.items())
+        return cls(**fields)
+
+    def pack(self):
+        return bson.encode(self.to_document())
+
+    @classmethod
+    def unpack(cls, data):
+        return cls.from_document(bson.decode(data))
+
+
+def source_for(callsign):
+    """
+    Returns the callbook that should hold `callsign`: IC or NKOM for
+    Canadian and Norwegian prefixes, otherwise CALLOOK (with HamQTH as
+    its fallback).
+    """
+    prefix = callsign.upper()[:2]
+    if prefix in CANADA_PREFIXES:
+        return IC
+    if prefix in NORWAY_PREFIXES:
+        return NKOM
+    return CALLOOK
+
+
+def fetch_callook(url, callsign, session=requests):
+    """
+    Queries callook.info (`url` has a {0} for the callsign) and returns
+    (status, record), where status is None if the request failed.
+    Raises ValueError on a malformed response.
+    """
+    req = session.get(url.format(callsign))
+    if req.status_code != requests.codes.ok:
+        return None, None
+    result = req.json()
+    return result["status"], from_callook(result)
+
+
+def from_ic(document):
+    club = document.get("club")
+    if club is None:
+        qualifications = document["qualifications"]
+        return Record(
+            IC,
+            document["callsign"],
+            kind="Person",
+            name=document["name"],
+            surname=document["surname"],
+            oper_class=", ".join(
+                label for key, label in IC_QUALIFICATIONS if qualifications[key]
+            ),
+            address=document.get("address"),
+            city=document["city"],
+            region=document["province"],
+            postcode=document["postcode"],
+            country="Canada",
+            updated=document.get("updated"),
+        )
+    return Record(
+        IC,
+        document["callsign"],
+        kind="Club",
+        name=document["name"],
+        surname=document["surname"],
+        address=document.get("address"),
+        city=document.get("city"),
+        region=document.get("province"),
+        postcode=document.get("postcode"),
+        country="Canada",
+        club=club["name"],
+        club2=club["name2"],
+        club_city=club["city"],
+        club_region=club["province"],
+        club_postcode=club["postcode"],
+        updated=document.get("updated"),
+    )
+
+
+def from_nkom(document):
+    return Record(
+        NKOM,
+        document["callsign"],
+        kind=document["type"],
+        name=document["name"],
+        surname=document["surname"],
+        club=document["club"],
+        address=document.get("address"),
+        city=document["city"],
+        postcode=document["postcode"],
+        country=document["country"],
+        updated=document["updated"],
+    )
+
+
+def from_callook(document):
+    """
+    Returns a Record for a callook.info response, or None unless its
+    status is VALID.
+    """
+    if document.get("status") != "VALID":
+        return None
+    current = document["current"]
+    location = document["location"]
+    other = document["otherInfo"]
+    trustee = document.get("trustee") or {}
+    return Record(
+        CALLOOK,
+        current["callsign"],
+        kind=document["type"].title(),
+        name=document["name"],
+        oper_class=current["operClass"],
+        address=document["address"]["line2"],
+        country="United States",
+        grid=location["gridsquare"],
+        latitude=as_float(location.get("latitude")),
+        longitude=as_float(location.get("longitude")),
+        trustee=trustee.get("callsign") or None,
+        trustee_name=trustee.get("name") or None,
+        granted=other["grantDate"],
+        expires=other["expiryDate"],
+        url=other["ulsUrl"],
+    )
+
+
+def from_hamqth(data, flags=None):
+    """
+    Returns a Record for a HamQTH search result.  `flags` maps country
+    names to flag emoji.
+    """
+    country = data.get("country")
+    return Record(
+        HAMQTH,
+        data["callsign"].upper(),
+        name=data.get("adr_name", "[None]"),
+        nick=data.get("nick", "?"),
+        utc_offset=data.get("utc_offset", "?"),
+        city=data.get("adr_city", "?"),
+        country=data.get("adr_country", "?"),
+        postcode=data.get("adr_zip", ""),
+        grid=data.get("grid", "?"),
+        latitude=as_float(data.get("latitude")),
+        longitude=as_float(data.get("longitude")),
+        flag=(flags or {}).get(country, ""),
+    )
+
+
+def as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RecordCache(object):
+    """
+    Bounded LRU of packed records with a TTL.  A callsign can also be
+    cached as not found by putting None.
+    """
+
+    def __init__(self, capacity=5000, ttl=3600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry is not None and time.monotonic() - entry[1] <= self.ttl
+
+    def get(self, key):
+        """
+        Returns the cached Record (or None for a cached miss), raising
+        KeyError if `key` isn't cached.
+        """
+        with self.lock:
+            data, stored = self.entries[key]
+            if time.monotonic() - stored > self.ttl:
+                del self.entries[key]
+                raise KeyError(key)
+            self.entries.move_to_end(key)
+        if not data:
+            return None
+        return Record.unpack(data)
+
+    def put(self, key, record):
+        data = b"" if record is None else record.pack()
+        with self.lock:
+            self.entries[key] = (data, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""
+Per-chat metadata the greeter and admin commands need on every event:
+the `hamfurs.chat` settings document, the pinned message and the list
+of administrators.  Everything is cached with a TTL and invalidated
+explicitly when we see it change (pin service messages, chat member
+updates, /set_join_message), so a join flood costs one Mongo read and
+one getChat per chat rather than one per join.
+
+JoinBatcher collects joins per chat for a short window so that a burst
+of joins gets a single greeting naming everyone.
+"""
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger("HamfursBot.chats")
+
+MISSING = object()
+
+
+class TTLCache(object):
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            return MISSING
+        return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class ChatCache(object):
+    def __init__(self, collection, bot, settings_ttl=600, pinned_ttl=600, admin_ttl=600):
+        self.collection = collection
+        self.bot = bot
+        self.settings_cache = TTLCache(settings_ttl)
+        self.pinned_cache = TTLCache(pinned_ttl)
+        self.admin_cache = TTLCache(admin_ttl)
+
+    def settings(self, chat_id):
+        """
+        Returns the settings document for `chat_id`, or None.
+        """
+        settings = self.settings_cache.get(chat_id)
+        if settings is MISSING:
+            settings = self.collection.find_one({"chat_id": chat_id})
+            self.settings_cache.set(chat_id, settings)
+        return settings
+
+    def set_settings(self, chat_id, settings):
+        """
+        Call after writing `settings` to Mongo to keep the cache current.
+        """
+        self.settings_cache.set(chat_id, settings)
+
+    # Settings are keyed on whatever the settings document was stored
+    # under; Telegram-side state is keyed on the numeric chat id.
+
+    def pinned_message(self, chat_id):
+        pinned = self.pinned_cache.get(int(chat_id))
+        if pinned is MISSING:
+            pinned = self.bot.get_chat(chat_id).pinned_message
+            self.pinned_cache.set(int(chat_id), pinned)
+        return pinned
+
+    def set_pinned_message(self, chat_id, message):
+        self.pinned_cache.set(int(chat_id), message)
+
+    def administrators(self, chat_id):
+        """
+        Returns the set of user ids administering `chat_id`.
+        """
+        administrators = self.admin_cache.get(int(chat_id))
+        if administrators is MISSING:
+            rows = self.bot.get_chat_administrators(chat_id=chat_id)
+            administrators = frozenset(row.user.id for row in rows)
+            self.admin_cache.set(int(chat_id), administrators)
+        return administrators
+
+    def invalidate(self, chat_id):
+        self.settings_cache.invalidate(chat_id)
+        self.pinned_cache.invalidate(int(chat_id))
+        self.admin_cache.invalidate(int(chat_id))
+
+    def invalidate_administrators(self, chat_id):
+        self.admin_cache.invalidate(int(chat_id))
+
+
+class JoinBatcher(object):
+    """
+    Buffers joining users per chat.  The first join in a chat starts a
+    `delay` second timer; when it fires, `callback(message, users)` is
+    called once with the first join message and everyone who joined
+    in the meantime.
+    """
+
+    def __init__(self, callback, delay=10):
+        self.callback = callback
+        self.delay = delay
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, message, users):
+        chat_id = message.chat.id
+        with self.lock:
+            batch = self.pending.get(chat_id)
+            if batch is not None:
+                seen = set(user.id for user in batch[1])
+                batch[1].extend(user for user in users if user.id not in seen)
+                return
+            self.pending[chat_id] = (message, list(users))
+        timer = threading.Timer(self.delay, self.flush, args=(chat_id,))
+        timer.daemon = True
+        timer.start()
+
+    def flush(self, chat_id):
+        with self.lock:
+            batch = self.pending.pop(chat_id, None)
+        if batch is None:
+            return
+        try:
+            self.callback(*batch)
+        except Exception as e:
+            logger.exception(e)
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+"""
+Clustered mode: several bot replicas sharing one Mongo.
+
+One replica at a time is the leader, by holding a lease document in
+`hamfurs.leases` that it renews every third of its TTL.  The leader
+owns everything that must only happen once: update intake (getUpdates,
+or registering the webhook), the RBN stream, scheduled jobs and APRS
+message relaying.  If it stops renewing, another replica takes over
+once the lease expires.
+
+Intake doesn't process updates itself.  They are written to
+`hamfurs.updates`, keyed by update_id so a redelivered update is
+dropped, and every replica runs workers that claim a chat by taking its
+lock (another lease, in `hamfurs.chat_locks`) and then process that
+chat's pending updates in update_id order.  Each update is handled
+exactly once and each chat in order, while different chats spread over
+the replicas.  A worker keeps each chat for `linger` seconds after its
+last update, even while it works on other chats, taking the oldest
+pending update of all the chats it holds.  Bursts (joins batched into
+one greeting, an edit of a message just answered) therefore stay on one
+replica, and a chat held that way waits for at most one update of
+another chat.  While an update is being processed its chat lock is
+renewed by a heartbeat, so a slow handler keeps its chat.
+
+An update that was being processed when its replica died is marked
+abandoned rather than run again, so nothing is ever sent twice.
+
+Leases compare wall clock times across replicas; keep them NTP synced.
+
+  HAMFURS_CLUSTER=1 HAMFURS_REPLICA_ID=bot-1 python3 main.py
+"""
+
+import os
+import time
+import socket
+import logging
+import datetime
+import threading
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from telebot import Handler, types
+from telebot.handler_backends import HandlerBackend
+
+import webhook
+
+logger = logging.getLogger("HamfursBot.cluster")
+
+LEASE_TTL = 15
+CHAT_LOCK_TTL = 30
+# Longer than chats.JoinBatcher's delay
+CHAT_LINGER = 15
+POLL_INTERVAL = 0.05
+CANDIDATES = 50
+# Processed updates are kept this long so redeliveries are recognised
+DONE_TTL = 24 * 3600
+# Unanswered ForceReply prompts are forgotten after this long
+REPLY_TTL = 48 * 3600
+
+
+class Lease(object):
+    """
+    A named, expiring lock held by `owner`.  acquire() both takes and
+    renews it.
+    """
+
+    def __init__(self, collection, name, owner, ttl):
+        self.collection = collection
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+        self.expires = 0
+
+    def acquire(self, ttl=None):
+        now = time.time()
+        expires = now + (ttl or self.ttl)
+        try:
+            document = self.collection.find_one_and_update(
+                {
+                    "_id": self.name,
+                    "$or": [{"owner": self.owner}, {"expires": {"$lt": now}}],
+                },
+                {"$set": {"owner": self.owner, "expires": expires}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Held by someone else; the upsert collided with their document
+            return False
+        if document is None or document["owner"] != self.owner:
+            return False
+        self.expires = expires
+        return True
+
+    def release(self):
+        self.expires = 0
+        self.collection.delete_one({"_id": self.name, "owner": self.owner})
+
+    @property
+    def held(self):
+        # Stop acting a little before the lease runs out
+        return time.time() < self.expires - 1
+
+
+class Cluster(object):
+    def __init__(self, db, replica_id=None, workers=4, lease_ttl=LEASE_TTL, linger=CHAT_LINGER):
+        self.db = db
+        self.replica_id = replica_id or "{0}:{1}".format(socket.gethostname(), os.getpid())
+        self.workers = workers
+        self.linger = linger
+        self.updates = db.updates
+        self.chat_locks = db.chat_locks
+        self.leader = Lease(db.leases, "leader", self.replica_id, lease_ttl)
+        self.on_elected = []
+        self.on_demoted = []
+        self.election_lock = threading.Lock()
+        # owner: the chat lock of the update it is processing
+        self.busy = {}
+        self.busy_lock = threading.Lock()
+        self.process = None
+        self.running = False
+        self.processed = 0
+
+    @property
+    def is_leader(self):
+        return self.leader.held
+
+    def ensure_indexes(self):
+        self.updates.create_index([("state", ASCENDING), ("_id", ASCENDING)])
+        self.updates.create_index([("chat_id", ASCENDING), ("state", ASCENDING), ("_id", ASCENDING)])
+        self.updates.create_index("done", expireAfterSeconds=DONE_TTL)
+
+    def start(self, process):
+        """
+        Starts the election and `workers` threads feeding claimed updates
+        to `process([update])`, e.g. bot.process_new_updates.
+        """
+        self.process = process
+        self.running = True
+        self.ensure_indexes()
+        threading.Thread(target=self.elect, name="Election", daemon=True).start()
+        threading.Thread(target=self.heartbeat, name="ChatLockHeartbeat", daemon=True).start()
+        for number in range(self.workers):
+            owner = "{0}/{1}".format(self.replica_id, number)
+            threading.Thread(
+                target=self.work, args=(owner,), name="ClusterWorker-{0}".format(number), daemon=True
+            ).start()
+        logger.info("Replica {0} started with {1} workers".format(self.replica_id, self.workers))
+
+    def stop(self):
+        self.running = False
+        with self.election_lock:
+            if self.leader.held:
+                self.leader.release()
+                self.notify(self.on_demoted)
+
+    def when_elected(self, callback):
+        """
+        Adds `callback` to on_elected, calling it straight away if this
+        replica is already the leader.
+        """
+        with self.election_lock:
+            self.on_elected.append(callback)
+            if self.leader.held:
+                self.notify([callback])
+
+    def elect(self):
+        while self.running:
+            with self.election_lock:
+                was_leader = self.leader.held
+                try:
+                    leader = self.leader.acquire()
+                except PyMongoError as e:
+                    logger.error("Unable to renew the leader lease: {0}".format(e))
+                    leader = self.leader.held
+                if leader and not was_leader:
+                    logger.info("Replica {0} is now the leader".format(self.replica_id))
+                    self.notify(self.on_elected)
+                elif was_leader and not leader:
+                    logger.warning("Replica {0} lost the leader lease".format(self.replica_id))
+                    self.notify(self.on_demoted)
+            time.sleep(self.leader.ttl / 3.0)
+
+    def notify(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.exception(e)
+
+    def push(self, updates):
+        """
+        Queues raw update JSON documents for the workers.  Updates that
+        are already queued (or were processed recently) are ignored.
+        """
+        now = time.time()
+        documents = [
+            {
+                "_id": update["update_id"],
+                "chat_id": webhook.get_chat_id(update) or 0,
+                "update": update,
+                "state": "pending",
+                "queued": now,
+            }
+            for update in updates
+        ]
+        if not documents:
+            return
+        try:
+            self.updates.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            errors = [error for error in e.details["writeErrors"] if error["code"] != 11000]
+            if errors:
+                raise
+
+    def work(self, owner):
+        # chat_id: lease, for the chats this worker holds; each is kept
+        # for `linger` seconds after its last update
+        held = {}
+        while self.running:
+            try:
+                for chat_id, lease in list(held.items()):
+                    if not lease.held:
+                        del held[chat_id]
+                document = self.next_update(owner, held)
+                if document is None:
+                    chat = self.claim(owner)
+                    if chat is None:
+                        time.sleep(POLL_INTERVAL)
+                    else:
+                        held[chat[0]] = chat[1]
+                    continue
+                lease = held[document["chat_id"]]
+                if self.run(document, lease, owner):
+                    # Keep the chat for a while rather than releasing it
+                    lease.acquire(self.linger)
+                else:
+                    del held[document["chat_id"]]
+            except PyMongoError as e:
+                logger.error("Cluster worker {0}: {1}".format(owner, e))
+                time.sleep(1)
+
+    def next_update(self, owner, held):
+        """
+        Takes the oldest pending update of the chats in `held`, so a chat
+        this worker lingers on is served between another chat's updates.
+        """
+        if not held:
+            return None
+        return self.updates.find_one_and_update(
+            {"chat_id": {"$in": list(held)}, "state": "pending"},
+            {"$set": {"state": "processing", "owner": owner, "started": time.time()}},
+            sort=[("_id", ASCENDING)],
+        )
+
+    def claim(self, owner):
+        """
+        Takes the lock of the first chat with pending updates that no
+        other worker holds.  Returns (chat_id, lease) or None.
+        """
+        pending = self.updates.find({"state": "pending"}, {"chat_id": True}).sort("_id", ASCENDING).limit(CANDIDATES)
+        tried = set()
+        for document in pending:
+            chat_id = document["chat_id"]
+            if chat_id in tried:
+                continue
+            tried.add(chat_id)
+            lease = Lease(self.chat_locks, "chat:{0}".format(chat_id), owner, CHAT_LOCK_TTL)
+            if lease.acquire():
+                self.skip_abandoned(chat_id, owner)
+                return chat_id, lease
+        return None
+
+    def heartbeat(self):
+        """
+        Renews the chat locks of updates being processed, so a handler
+        slower than CHAT_LOCK_TTL doesn't lose its chat to another worker.
+        """
+        while self.running:
+            time.sleep(CHAT_LOCK_TTL / 3.0)
+            # Renewing under the lock: once run() has taken a lease out
+            # of `busy`, it can release it without it coming back
+            with self.busy_lock:
+                for owner, lease in list(self.busy.items()):
+                    try:
+                        lease.acquire()
+                    except PyMongoError as e:
+                        logger.error("Unable to renew the chat lock for {0}: {1}".format(owner, e))
+
+    def skip_abandoned(self, chat_id, owner):
+        # Holding the lock, anything still "processing" was left by a
+        # worker that died mid-update
+        abandoned = self.updates.update_many(
+            {"chat_id": chat_id, "state": "processing", "owner": {"$ne": owner}},
+            {"$set": {"state": "abandoned", "done": datetime.datetime.utcnow()}},
+        )
+        if abandoned.modified_count:
+            logger.warning(
+                "Skipped {0} updates for chat {1} left by a dead worker".format(
+                    abandoned.modified_count, chat_id
+                )
+            )
+
+    def run(self, document, lease, owner):
+        """
+        Processes a claimed update.  Returns False, putting the update
+        back, if the chat lock was lost in the meantime.
+        """
+        # Renewed after every update; only go to Mongo when the lock may
+        # run out before the heartbeat gets to it
+        if lease.expires - time.time() < CHAT_LOCK_TTL / 3.0 + 2 and not lease.acquire():
+            # E.g. stalled on Mongo; the chat's new owner will get to it
+            self.updates.update_one(
+                {"_id": document["_id"], "state": "processing", "owner": owner},
+                {"$set": {"state": "pending"}},
+            )
+            return False
+        with self.busy_lock:
+            self.busy[owner] = lease
+        try:
+            self.process([types.Update.de_json(document["update"])])
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            with self.busy_lock:
+                del self.busy[owner]
+        self.updates.update_one(
+            {"_id": document["_id"]},
+            {"$set": {"state": "done", "done": datetime.datetime.utcnow()}},
+        )
+        self.processed += 1
+        return True
+
+
+class ReplyHandlers(HandlerBackend):
+    """
+    Keeps register_for_reply() handlers in Mongo, so the answer to a
+    ForceReply prompt is handled by whichever replica gets it.
+    Callbacks are stored by name and must be among `callbacks`.
+    """
+
+    def __init__(self, collection, callbacks):
+        super().__init__()
+        self.collection = collection
+        self.callbacks = {callback.__name__: callback for callback in callbacks}
+        self.indexed = False
+
+    def register_handler(self, handler_group_id, handler):
+        name = handler["callback"].__name__
+        if self.callbacks.get(name) is not handler["callback"]:
+            raise ValueError("{0} is not a registered reply callback".format(name))
+        if not self.indexed:
+            self.collection.create_index("created", expireAfterSeconds=REPLY_TTL)
+            self.indexed = True
+        self.collection.update_one(
+            {"_id": handler_group_id},
+            {
+                "$push": {
+                    "handlers": {"callback": name, "args": list(handler["args"]), "kwargs": handler["kwargs"]}
+                },
+                "$setOnInsert": {"created": datetime.datetime.utcnow()},
+            },
+            upsert=True,
+        )
+
+    def clear_handlers(self, handler_group_id):
+        self.collection.delete_one({"_id": handler_group_id})
+
+    def get_handlers(self, handler_group_id):
+        document = self.collection.find_one_and_delete({"_id": handler_group_id})
+        if document is None:
+            return None
+        return [
+            Handler(self.callbacks[handler["callback"]], *handler["args"], **handler["kwargs"])
+            for handler in document["handlers"]
+            if handler["callback"] in self.callbacks
+        ]
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+"""
+Read-only JSON API over every callbook the bot keeps
+
+Runs as the `api` service in docker-compose.yml, or by hand:
+
+  pip install flask gunicorn
+  HAMFURS_MONGO_HOST=... gunicorn -w 4 --threads 8 -b 0.0.0.0:8000 routes:app
+
+Records are served with an ETag derived from the import generation of
+their collection (hamfurs.generations, bumped by cron/importer.py on
+every swap) and a Cache-Control max-age, so clients and proxies can
+revalidate without a Mongo round trip.  Install orjson for faster
+encoding.
+
+By callsign:
+============
+
+  GET /ic/<callsign>              Industry Canada callbook
+  GET /nkom/<callsign>            Nkom (Norway) callbook
+  GET /dmr/<callsign>             list of DMR-MARC/RadioID registrations
+  GET /dmr/id/<radio id>          a single DMR-MARC/RadioID registration
+  GET /arrl/counts/<callsign>     ARRL VE session count
+  GET /aliases/<callsign>         Telegram handle registered for a callsign
+
+    e.g. http://rechner.us.to/api/ic/ve3fxy
+
+  Responses are the stored documents (without _id), see cron/ic/routes.py
+  and cron/arrl/routes.py for their fields.  404 if not found.
+
+Listings:
+=========
+
+  GET /ic/, /nkom/, /dmr/, /aliases/
+  GET /arrl/counts/?state=<state>
+
+  Paged by callsign: ?limit=<n> (default 500, at most 5000) and
+  ?after=<next> to continue from the previous page's "next".  Some
+  callsigns have several rows (DMR), so the cursor is the callsign and
+  the row's id, "<callsign>,<id>"; a bare callsign starts after every
+  row for it.
+
+  Response
+  --------
+  {
+    "results" : list of documents above, ordered by callsign
+    "next" : cursor to pass as after= for the next page, or null
+  }
+
+Dumps:
+======
+
+  GET /export/<ic|nkom|dmr|arrl>
+
+  The whole collection streamed as a JSON array, or as NDJSON with
+  ?format=ndjson (or Accept: application/x-ndjson).
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import threading
+from collections import OrderedDict
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from flask import Flask, abort, request, Response
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import export
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# Imports run daily, aliases change whenever someone uses /register
+MAX_AGE = {
+  'ic' : 3600,
+  'nkom' : 3600,
+  'dmr-marc' : 3600,
+  'arrl' : 3600,
+  'aliases' : 60
+}
+# hamfurs.generations ids -> resource
+NAMESPACES = {
+  'ic.callbook' : 'ic',
+  'nkom.callbook' : 'nkom',
+  'dmr_marc.users' : 'dmr-marc',
+  'arrl.ve_session_counts' : 'arrl'
+}
+GENERATION_TTL = 10
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 5000
+BATCH_SIZE = 1000
+CACHE_SIZE = 20000
+
+PROJECTION = { '_id' : False }
+ALIAS_PROJECTION = { '_id' : False, 'callsign' : True, 'user_name' : True, 'updated' : True }
+
+app = Flask(__name__)
+
+# One pooled client for the whole process; pymongo is thread safe
+client = MongoClient(host=os.environ.get('HAMFURS_MONGO_HOST'), maxPoolSize=100)
+
+if orjson is not None:
+  encode = orjson.dumps
+else:
+  def encode(obj):
+    return json.dumps(obj, separators=(',', ':'), default=str).encode('utf-8')
+
+
+class Generations(object):
+  """
+  The import generation of each collection, re-read at most every
+  `ttl` seconds.
+  """
+  def __init__(self, client, ttl=GENERATION_TTL):
+    self.client = client
+    self.ttl = ttl
+    self.values = {}
+    self.loaded = 0
+    self.lock = threading.Lock()
+
+  def load(self):
+    values = {}
+    for generation in self.client.hamfurs.generations.find({}, { 'generation' : True }):
+      if generation['_id'] in NAMESPACES:
+        values[NAMESPACES[generation['_id']]] = generation['generation']
+    latest = self.client.hamfurs.aliases.find_one({}, { 'updated' : True }, sort=[('updated', DESCENDING)])
+    # max(updated) doesn't change when /unregister deletes an alias, so
+    # the deletion count it keeps goes in the low bits
+    state = self.client.hamfurs.state.find_one({ '_id' : 'aliases' }) or {}
+    updated = int((latest or {}).get('updated', 0))
+    values['aliases'] = updated << 20 | state.get('deletions', 0) % (1 << 20)
+    return values
+
+  def get(self, resource):
+    with self.lock:
+      if time.monotonic() - self.loaded > self.ttl:
+        self.values = self.load()
+        self.loaded = time.monotonic()
+      return self.values.get(resource, 0)
+
+
+class ResponseCache(object):
+  """
+  LRU of encoded single-record responses, keyed on the collection's
+  generation so an import makes old entries unreachable.
+  """
+  def __init__(self, capacity=CACHE_SIZE):
+    self.capacity = capacity
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      body = self.entries.get(key)
+      if body is not None:
+        self.entries.move_to_end(key)
+      return body
+
+  def put(self, key, body):
+    with self.lock:
+      self.entries[key] = body
+      while len(self.entries) > self.capacity:
+        self.entries.popitem(last=False)
+
+
+generations = Generations(client)
+responses = ResponseCache()
+
+
+def revalidate(resource):
+  """
+  Returns (etag, not_modified) for the current request.
+  """
+  generation = generations.get(resource)
+  etag = '{0}-{1:x}-{2:x}'.format(resource, generation, zlib.crc32(request.full_path.encode('utf-8')))
+  return etag, request.if_none_match.contains(etag)
+
+def respond(body, resource, etag, status=200):
+  response = Response(body, status=status, mimetype='application/json')
+  response.set_etag(etag)
+  response.cache_control.public = True
+  response.cache_control.max_age = MAX_AGE[resource]
+  return response
+
+def not_modified(resource, etag):
+  return respond(b'', resource, etag, status=304)
+
+def single(resource, find):
+  """
+  Serves the result of `find()`, a document or list of documents.
+  """
+  etag, fresh = revalidate(resource)
+  if fresh:
+    return not_modified(resource, etag)
+  key = (etag, request.full_path)
+  body = responses.get(key)
+  if body is None:
+    result = find()
+    if not result:
+      abort(404)
+    body = encode(result)
+    responses.put(key, body)
+  return respond(body, resource, etag)
+
+def after_query(after):
+  """
+  The query for rows after a page cursor, "<callsign>,<id>" or a bare
+  callsign.  Raises ValueError for a malformed cursor.
+  """
+  callsign, _, row = after.partition(',')
+  callsign = callsign.upper()
+  if not row:
+    return { 'callsign' : { '$gt' : callsign } }
+  try:
+    row = ObjectId(row)
+  except InvalidId:
+    raise ValueError(after)
+  return { '$or' : [
+    { 'callsign' : { '$gt' : callsign } },
+    { 'callsign' : callsign, '_id' : { '$gt' : row } }
+  ] }
+
+def page(resource, collection, query, projection=PROJECTION):
+  """
+  Streams one page of `collection` ordered by callsign (and _id, as
+  callsigns aren't unique everywhere).
+  """
+  etag, fresh = revalidate(resource)
+  if fresh:
+    return not_modified(resource, etag)
+  try:
+    limit = min(int(request.args.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+  except ValueError:
+    abort(400)
+  if limit < 1:
+    abort(400)
+  after = request.args.get('after')
+  if after:
+    try:
+      query = { '$and' : [query, after_query(after)] }
+    except ValueError:
+      abort(400)
+  # The cursor needs each row's _id, even where the results leave it out
+  fields = { k : v for k, v in projection.items() if k != '_id' } or None
+  cursor = collection.find(query, fields) \
+    .sort([('callsign', ASCENDING), ('_id', ASCENDING)]).limit(limit).batch_size(min(limit, BATCH_SIZE))
+  keep_id = projection.get('_id', True)
+
+  def generate():
+    count = 0
+    last = None
+    yield b'{"results":['
+    for document in cursor:
+      last = '{0},{1}'.format(document.get('callsign'), document['_id'])
+      if not keep_id:
+        del document['_id']
+      if count:
+        yield b',' + encode(document)
+      else:
+        yield encode(document)
+      count += 1
+    yield b'],"next":' + encode(last if count == limit else None) + b'}'
+
+  return respond(generate(), resource, etag)
+
+
+EXPORTS = {
+  'ic' : ('ic', client.ic.callbook),
+  'nkom' : ('nkom', client.nkom.callbook),
+  'dmr' : ('dmr-marc', client.dmr_marc.users),
+  'arrl' : ('arrl', client.arrl.ve_session_counts)
+}
+
+@app.route('/')
+def index():
+  return __doc__, 200, {'Content-Type': 'text/plain'}
+
+@app.route('/ic/<callsign>')
+def ic(callsign):
+  return single('ic', lambda: client.ic.callbook.find_one({ 'callsign' : callsign.upper() }, PROJECTION))
+
+@app.route('/ic/')
+def ic_list():
+  return page('ic', client.ic.callbook, {})
+
+@app.route('/nkom/<callsign>')
+def nkom(callsign):
+  return single('nkom', lambda: client.nkom.callbook.find_one({ 'callsign' : callsign.upper() }, PROJECTION))
+
+@app.route('/nkom/')
+def nkom_list():
+  return page('nkom', client.nkom.callbook, {})
+
+@app.route('/dmr/<callsign>')
+def dmr(callsign):
+  return single('dmr-marc', lambda: list(client.dmr_marc.users.find({ 'callsign' : callsign.upper() }, PROJECTION)))
+
+@app.route('/dmr/id/<int:radio_id>')
+def dmr_id(radio_id):
+  return single('dmr-marc', lambda: client.dmr_marc.users.find_one({ 'radio_id' : radio_id }, PROJECTION))
+
+@app.route('/dmr/')
+def dmr_list():
+  return page('dmr-marc', client.dmr_marc.users, {})
+
+@app.route('/arrl/counts/<callsign>')
+def arrl_counts(callsign):
+  return single('arrl', lambda: client.arrl.ve_session_counts.find_one({ 'callsign' : callsign.upper() }, PROJECTION))
+
+@app.route('/arrl/counts/')
+def arrl_counts_list():
+  query = {}
+  if request.args.get('state'):
+    query['state'] = request.args['state'].upper()
+  return page('arrl', client.arrl.ve_session_counts, query)
+
+@app.route('/aliases/<callsign>')
+def alias(callsign):
+  return single('aliases', lambda: client.hamfurs.aliases.find_one({ 'callsign' : callsign.upper() }, ALIAS_PROJECTION))
+
+@app.route('/aliases/')
+def alias_list():
+  return page('aliases', client.hamfurs.aliases, {}, ALIAS_PROJECTION)
+
+@app.route('/export/<name>')
+def dump(name):
+  if name not in EXPORTS:
+    abort(404)
+  resource, collection = EXPORTS[name]
+  etag, fresh = revalidate(resource)
+  if fresh:
+    return not_modified(resource, etag)
+  response = export.response(export.find(collection), lambda document: encode(document).decode('utf-8'))
+  response.set_etag(etag)
+  response.cache_control.public = True
+  response.cache_control.max_age = MAX_AGE[resource]
+  return response
+
+if __name__ == '__main__':
+  app.run(host='0.0.0.0', threaded=True)
@@ -8,11 +8,16 @@ http://www.arrl.org/ve-session-counts?state=VA
 """
 
 import os
+import sys
 import time
 import requests
 from bs4 import BeautifulSoup
 from pymongo import MongoClient
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import runstats
+import importer
+
 STATES = [ "Non-US", "AL", "AK", "AS", "AZ", "AR", "CA",
    "CO", "CT", "DE", "DC", "FL", "GA", "GU", "HI", "ID",
    "IL", "IN", "IA", "KS", "KY", "LA", "ME", "MD", "MA",
@@ -21,7 +26,8 @@ STATES = [ "Non-US", "AL", "AK", "AS", "AZ", "AR", "CA",
    "PR", "RI", "SC", "SD", "TN", "TX", "UT", "VT", "VI",
    "VA", "WA", "WV", "WI", "WY" ]
 
-def main(collection):
+def main(swap, live):
+    total = 0
     for state in STATES:
         timestamp = time.time()
         print("Processing {0}... ".format(state), end='')
@@ -33,9 +39,12 @@ def main(collection):
         try:
             table_body = soup.find_all('table')[0]
         except IndexError:
-            print(" ->FAIL<- no table found")
-            import pdb; pdb.set_trace()
-            #time.sleep(10)
+            # Keep the state's last good counts rather than dropping
+            # them from the live collection on commit()
+            kept = list(live.find({'state' : state}, {'_id' : False}))
+            swap.insert_many(kept)
+            total += len(kept)
+            print(" ->FAIL<- no table found, kept {0} previous records".format(len(kept)))
             continue
         rows = table_body.find_all('tr')
         for row in rows:
@@ -50,15 +59,23 @@ def main(collection):
             name = parts[1].strip(')')
             final_list.append({'callsign' : callsign, 'name' : name, 'count' : int(row[1]), 'state' : state, 'updated' : timestamp})
 
-        # Delete the old collection and re-insert the latest:
-        collection.delete_many({'state' : state})
-        collection.insert_many(final_list)
+        swap.insert_many(final_list)
         print(' -> OK <- ({0} records)'.format(len(data[1:])))
+        total += len(final_list)
 
         time.sleep(5)
+    return total
 
 if __name__ == '__main__':
     client = MongoClient(host=os.environ['HAMFURS_MONGO_HOST'])
     db = client.arrl
-    collection = db.ve_session_counts
-    main(collection)
+    stats = runstats.RunStats('arrl', client)
+    # Every state goes into staging; the live collection is replaced in one go
+    swap = importer.Swap(db, 've_session_counts')
+    rows = main(swap, db.ve_session_counts)
+    try:
+        generation = swap.commit()
+        stats.finish(rows=rows, generation=generation['generation'])
+    except importer.ValidationError as e:
+        print("Not swapping in the import: {0}".format(e))
+        stats.finish(rows=rows, success=False)
@@ -32,15 +32,20 @@ By state:
 
   Response
   --------
-  JSON list of elements above
+  JSON list of elements above (without _id), streamed.  Add
+  ?format=ndjson (or send Accept: application/x-ndjson) to get one
+  element per line instead.
 """
 
+import os
+import sys
 from pymongo import MongoClient
 from flask import Flask, abort, g, jsonify
-from flask.json import JSONEncoder
-from bson import ObjectId
 from bson.json_util import dumps
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import export
+
 app = Flask(__name__)
 
 def get_db():
@@ -71,26 +76,11 @@ def by_state(state=None):
   db = get_db()
   collection = db.ve_session_counts
 
-  rows = None
-  results = []
-  if state is None:
-    rows = collection.find({})
-  else:
-    rows = collection.find({ 'state' : state.upper() })
-
-  if rows is None:
-    abort(404)
-
-  for row in rows:
-    results.append(row)
-
-  return dumps(results)
+  query = {}
+  if state is not None:
+    query['state'] = state.upper()
 
-class JSONEncoder(JSONEncoder):
-  def default(self, obj):
-    if isinstance(obj, ObjectId):
-      return str(obj)
-    return json.JSONEncoder.default(self, obj)
+  return export.response(export.find(collection, query))
 
 if __name__ == '__main__':
   app.run(host='0.0.0.0', debug=True)
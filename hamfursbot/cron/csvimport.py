@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+Parallel CSV import engine for the big government callbook files.
+
+The input is cut into chunks of whole lines: byte ranges of a file,
+which worker processes read themselves, or blocks read off a stream.
+A process pool parses and transforms each chunk into documents, and a
+single writer thread hands them to `sink` in order.  Only a few chunks
+are in flight at a time, so a slow sink (Mongo) holds the parsers back
+instead of letting parsed documents pile up in memory.
+
+Chunks are split on b'\\n', which is only safe for single byte encodings
+(iso8859-14, cp865, ...) and files without newlines inside quoted
+fields; both hold for the IC and Nkom files.
+
+  count = csvimport.run('amateur_delim.txt', transform, swap.insert_many,
+                        encoding='iso8859-14', header=True)
+
+`transform(row, **context)` turns a list of fields into a document (or
+None to skip the row); it has to be a module level function so it can be
+sent to the workers.
+
+To benchmark an importer's transform without a database:
+
+  python3 cron/csvimport.py nkom cron/nkom/test.csv --workers 1 2 4 --chunk-size 65536
+  python3 cron/csvimport.py ic cron/ic/amateur_delim.zip
+"""
+
+import io
+import os
+import sys
+import csv
+import time
+import queue
+import zipfile
+import argparse
+import functools
+import threading
+import importlib.util
+import multiprocessing
+
+CHUNK_SIZE = 1024 * 1024
+# Chunks parsed ahead of the writer, per worker
+READ_AHEAD = 2
+QUEUE_SIZE = 4
+
+def file_ranges(filename, chunk_size=CHUNK_SIZE, header=False):
+  """
+  Yields (start, end) byte ranges of `filename` that begin and end on a
+  line boundary.
+  """
+  size = os.path.getsize(filename)
+  with open(filename, 'rb') as f:
+    start = 0
+    if header:
+      f.readline()
+      start = f.tell()
+    while start < size:
+      f.seek(min(start + chunk_size, size))
+      f.readline()
+      end = min(f.tell(), size)
+      yield start, end
+      start = end
+
+def stream_chunks(stream, chunk_size=CHUNK_SIZE, header=False):
+  """
+  Yields blocks of whole lines read from a binary stream.
+  """
+  if header:
+    stream.readline()
+  while True:
+    data = stream.read(chunk_size)
+    if not data:
+      return
+    if not data.endswith(b'\n'):
+      data += stream.readline()
+    yield data
+
+def read_range(filename, start, end):
+  with open(filename, 'rb') as f:
+    f.seek(start)
+    return f.read(end - start)
+
+def parse(job):
+  """
+  Runs in the workers: decodes and parses one chunk and returns its
+  documents.
+  """
+  chunk, encoding, delimiter, transform = job
+  if isinstance(chunk, tuple):
+    chunk = read_range(*chunk)
+  reader = csv.reader(io.StringIO(chunk.decode(encoding), newline=''), delimiter=delimiter)
+  documents = []
+  for row in reader:
+    if not row:
+      continue
+    document = transform(row)
+    if document is not None:
+      documents.append(document)
+  return documents
+
+def writer(batches, sink, errors):
+  while True:
+    documents = batches.get()
+    if documents is None:
+      return
+    try:
+      sink(documents)
+    except Exception as e:
+      errors.append(e)
+      # Keep draining so the producer never blocks on a dead writer
+      while batches.get() is not None:
+        pass
+      return
+
+def run_chunks(chunks, transform, sink, encoding, delimiter=';', workers=None, progress=None):
+  """
+  Parses `chunks` (byte strings or (filename, start, end) ranges) in a
+  process pool and feeds the documents to `sink` from one thread.
+  Returns the number of documents written.
+  """
+  workers = workers or os.cpu_count() or 1
+  batches = queue.Queue(QUEUE_SIZE)
+  errors = []
+  thread = threading.Thread(target=writer, args=(batches, sink, errors), name='CSVWriter')
+  thread.start()
+
+  count = 0
+  pending = []
+  try:
+    # fork, so transforms defined in a script's __main__ reach the workers
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+      for chunk in chunks:
+        pending.append(pool.apply_async(parse, ((chunk, encoding, delimiter, transform),)))
+        if len(pending) >= workers * READ_AHEAD:
+          count += hand_off(pending.pop(0).get(), batches, errors, progress)
+      while pending:
+        count += hand_off(pending.pop(0).get(), batches, errors, progress)
+  finally:
+    batches.put(None)
+    thread.join()
+  if errors:
+    raise errors[0]
+  return count
+
+def hand_off(documents, batches, errors, progress):
+  if errors:
+    raise errors[0]
+  batches.put(documents)
+  if progress is not None and documents:
+    progress(documents[-1])
+  return len(documents)
+
+def run(filename, transform, sink, encoding, delimiter=';', header=False, workers=None, chunk_size=CHUNK_SIZE, progress=None):
+  """
+  Imports a CSV file on disk, see run_chunks().
+  """
+  ranges = ((filename, start, end) for start, end in file_ranges(filename, chunk_size, header))
+  return run_chunks(ranges, transform, sink, encoding, delimiter, workers, progress)
+
+def run_stream(stream, transform, sink, encoding, delimiter=';', header=False, workers=None, chunk_size=CHUNK_SIZE, progress=None):
+  """
+  Imports a CSV from a binary stream (HTTP response, zip member),
+  see run_chunks().
+  """
+  chunks = stream_chunks(stream, chunk_size, header)
+  return run_chunks(chunks, transform, sink, encoding, delimiter, workers, progress)
+
+def load_importer(name):
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name, 'fetch.py')
+  spec = importlib.util.spec_from_file_location('{0}_fetch'.format(name), path)
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[spec.name] = module
+  spec.loader.exec_module(module)
+  return module
+
+def benchmark(importer, filename, workers, repeat, chunk_size):
+  module = load_importer(importer)
+  transform = functools.partial(module.transform, timestamp=int(time.time()))
+  for count in workers:
+    best = None
+    for _ in range(repeat):
+      start = time.perf_counter()
+      if filename.endswith('.zip'):
+        with zipfile.ZipFile(filename) as archive, archive.open(module.MEMBER) as member:
+          rows = run_stream(member, transform, lambda documents: None, module.ENCODING, header=True, workers=count, chunk_size=chunk_size)
+      else:
+        rows = run(filename, transform, lambda documents: None, module.ENCODING, header=True, workers=count, chunk_size=chunk_size)
+      elapsed = time.perf_counter() - start
+      best = elapsed if best is None else min(best, elapsed)
+    print("{0:>3} workers: {1} rows in {2:.3f}s ({3:.0f} rows/s)".format(count, rows, best, rows / best))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark an importer\'s parsing without a database')
+  parser.add_argument('importer', help='ic or nkom')
+  parser.add_argument('filename')
+  parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+  args = parser.parse_args()
+  benchmark(args.importer, args.filename, args.workers, args.repeat, args.chunk_size)
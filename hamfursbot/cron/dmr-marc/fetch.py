@@ -1,20 +1,31 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import requests
 from pymongo import MongoClient
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import runstats
+import importer
+
 #DUMP_URL = "http://www.dmr-marc.net/cgi-bin/trbo-database/datadump.cgi?table=users&format=json"
 DUMP_URL = "https://www.radioid.net/static/users.json"
 
 client = MongoClient(host=os.environ['HAMFURS_MONGO_HOST'])
 db = client.dmr_marc
+stats = runstats.RunStats('dmr-marc', client)
 
 r = requests.get(DUMP_URL)
 
 dmr_document = r.json()
 
-# Delete and re-insert the entire database
-db.users.delete_many({})
-
-db.users.insert_many(dmr_document['users'])
+# Load the dump into a staging collection and swap it in whole
+swap = importer.Swap(db, 'users')
+swap.insert_many(dmr_document['users'])
+try:
+  generation = swap.commit()
+  stats.finish(rows=swap.rows, generation=generation['generation'])
+except importer.ValidationError as e:
+  print("Not swapping in the import: {0}".format(e))
+  stats.finish(rows=swap.rows, success=False)
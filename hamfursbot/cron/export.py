@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+"""
+Streams whole collections (or large queries) out of the route apps
+straight from the Mongo cursor, as NDJSON or as a chunked JSON array, so
+a dump never holds more than one cursor batch in memory.
+
+  @app.route('/dump')
+  def dump():
+    return export.response(export.find(db.callbook))
+
+Clients get NDJSON by asking for ?format=ndjson or by sending
+`Accept: application/x-ndjson`; the default is a JSON array.
+"""
+
+import json
+from flask import Response, request, stream_with_context
+
+BATCH_SIZE = 1000
+PROJECTION = { '_id' : False }
+
+NDJSON = 'application/x-ndjson'
+
+def encode(document):
+  return json.dumps(document, separators=(',', ':'), default=str)
+
+def ndjson(cursor, encode=encode):
+  for document in cursor:
+    yield encode(document) + '\n'
+
+def json_array(cursor, encode=encode):
+  first = True
+  yield '['
+  for document in cursor:
+    if first:
+      first = False
+      yield encode(document)
+    else:
+      yield ',' + encode(document)
+  yield ']\n'
+
+def wants_ndjson():
+  if request.args.get('format') == 'ndjson':
+    return True
+  return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+def find(collection, query=None, projection=PROJECTION, batch_size=BATCH_SIZE):
+  return collection.find(query or {}, projection, batch_size=batch_size)
+
+def response(cursor, encode=encode):
+  """
+  A streamed Flask response for `cursor` in the format the client
+  asked for.
+  """
+  if wants_ndjson():
+    return Response(stream_with_context(ndjson(cursor, encode)), mimetype=NDJSON)
+  return Response(stream_with_context(json_array(cursor, encode)), mimetype='application/json')
@@ -1,68 +1,156 @@
 #!/usr/bin/env python3
 
+"""
+Imports the Industry Canada amateur callbook.
+
+  fetch.py [--force] <url, .zip or .txt>
+
+The CSV is read straight out of the zip archive (downloaded into memory
+when given a URL) without unpacking it to disk.  If the archive is the
+same as the last successful import the run is skipped; --force imports
+it anyway.
+
+Records are placed at the centre of their postcode's forward sortation
+area (see postcodes.py).
+"""
+
+import io
 import os
 import sys
-import csv
 import time
+import hashlib
+import zipfile
+import functools
+import requests
 from pymongo import MongoClient
 
-if len(sys.argv) != 2:
-  print("Usage: {0} <inputfile>".format(sys.argv[0]))
-  sys.exit(1)
-filename = sys.argv[1]
-
-client = MongoClient(os.environ['HAMFURS_MONGO_HOST'])
-db = client.ic
-collection = db.callbook
-
-count = 0
-updated = 0
-
-# Import CSV
-try:
-  with open(sys.argv[1], encoding='iso8859-14') as csvfile:
-    timestamp = int(time.time())
-    reader = csv.reader(csvfile, delimiter=';')
-    for row in reader:
-      document = {
-        'callsign' : row[0],
-        'name' : row[1],
-        'surname' : row[2],
-        'address' : row[3],
-        'city' : row[4],
-        'province' : row[5],
-        'postcode' : row[6],
-        'qualifications' : {
-          'basic' : True if row[7] == 'A' else False,
-          '5wpm' : True if row[8] == 'B' else False,
-          '12wpm' : True if row[9] == 'C' else False,
-          'advanced' : True if row[10] == 'D' else False,
-          'basic_honours' : True if row[11] == 'E' else False
-        },
-        'club' : None if row[12] == '' else {
-          'name' : row[12],
-          'name2' : row[13],
-          'address' : row[14],
-          'city' : row[15],
-          'province' : row[16],
-          'postcode' : row[17]
-        },
-        'updated' : timestamp
-      }
-
-      # NOTE: Drop all and insert seems to be much faster than update
-      #collection.insert_one(document)
-      r = collection.replace_one({'callsign' : row[0]}, document, upsert=True)
-      updated += r.modified_count
-
-      count += 1
-      sys.stderr.write("Processing {0}    \r".format(row[0]))
-
-
-except FileNotFoundError as e:
-  print("No such file: {0}.\n{1}".format(sys.argv[1], e))
-
-print("\n[ OK ]")
-print("  Processed: {0}".format(count))
-print("    Updated: {0}".format(updated))
-print("        New: {0}".format(count - updated))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import runstats
+import importer
+import csvimport
+import postcodes
+
+ENCODING = 'iso8859-14'
+MEMBER = 'amateur_delim.txt'
+# Filled in before the parser processes fork, so they inherit it
+POSTCODES = {}
+
+def transform(row, timestamp):
+  return {
+    'callsign' : row[0],
+    'name' : row[1],
+    'surname' : row[2],
+    'address' : row[3],
+    'city' : row[4],
+    'province' : row[5],
+    'postcode' : row[6],
+    'location' : postcodes.location(POSTCODES, row[6], 3),
+    'qualifications' : {
+      'basic' : True if row[7] == 'A' else False,
+      '5wpm' : True if row[8] == 'B' else False,
+      '12wpm' : True if row[9] == 'C' else False,
+      'advanced' : True if row[10] == 'D' else False,
+      'basic_honours' : True if row[11] == 'E' else False
+    },
+    'club' : None if row[12] == '' else {
+      'name' : row[12],
+      'name2' : row[13],
+      'address' : row[14],
+      'city' : row[15],
+      'province' : row[16],
+      'postcode' : row[17]
+    },
+    'updated' : timestamp
+  }
+
+def download(url):
+  """
+  Returns the archive at `url` as a seekable in-memory file and its
+  SHA-256.
+  """
+  digest = hashlib.sha256()
+  archive = io.BytesIO()
+  with requests.get(url, stream=True, timeout=60) as response:
+    response.raise_for_status()
+    for block in response.iter_content(64 * 1024):
+      digest.update(block)
+      archive.write(block)
+  archive.seek(0)
+  return archive, digest.hexdigest()
+
+def checksum(filename):
+  digest = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(64 * 1024), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+def progress(document):
+  sys.stderr.write("Processing {0}    \r".format(document['callsign']))
+
+if __name__ == '__main__':
+  arguments = [argument for argument in sys.argv[1:] if argument != '--force']
+  force = '--force' in sys.argv[1:]
+  if len(arguments) != 1:
+    print("Usage: {0} [--force] <url, .zip or .txt>".format(sys.argv[0]))
+    sys.exit(1)
+  source = arguments[0]
+
+  client = MongoClient(os.environ['HAMFURS_MONGO_HOST'])
+  db = client.ic
+  stats = runstats.RunStats('ic', client)
+
+  count = 0
+  previous = 0
+  success = True
+  digest = None
+  row_transform = functools.partial(transform, timestamp=int(time.time()))
+
+  try:
+    if source.startswith(('http://', 'https://')):
+      archive, digest = download(source)
+    elif source.endswith('.zip'):
+      archive, digest = source, checksum(source)
+    else:
+      archive = None
+  except (OSError, requests.RequestException) as e:
+    print("Unable to read {0}.\n{1}".format(source, e))
+    stats.finish(success=False)
+    sys.exit(1)
+
+  last = stats.last()
+  if digest is not None and not force and last and last.get('success') and last.get('checksum') == digest:
+    print("[ SKIPPED ] {0} is unchanged since the last import ({1})".format(source, digest))
+    stats.finish(success=True, skipped=True, checksum=digest, generation=last.get('generation'))
+    sys.exit(0)
+
+  swap = importer.Swap(db, 'callbook')
+  POSTCODES.update(postcodes.load('CA'))
+
+  # Import CSV; parsed in parallel, loaded into a staging collection
+  # and swapped in once complete
+  try:
+    if archive is None:
+      count = csvimport.run(source, row_transform, swap.insert_many, ENCODING, header=True, progress=progress)
+    else:
+      with zipfile.ZipFile(archive) as z, z.open(MEMBER) as member:
+        count = csvimport.run_stream(member, row_transform, swap.insert_many, ENCODING, header=True, progress=progress)
+  except (FileNotFoundError, KeyError, zipfile.BadZipFile) as e:
+    print("Unable to read {0}.\n{1}".format(source, e))
+    success = False
+
+  generation = None
+  if success:
+    previous = swap.live_rows()
+    try:
+      generation = swap.commit()['generation']
+    except importer.ValidationError as e:
+      print("\nNot swapping in the import: {0}".format(e))
+      success = False
+
+  stats.finish(rows=count, success=success, previous=previous, generation=generation, checksum=digest)
+
+  print("\n[ {0} ]".format('OK' if success else 'FAILED'))
+  print("  Processed: {0}".format(count))
+  print("   Previous: {0}".format(previous))
+  print(" Generation: {0}".format(generation))
@@ -1,13 +1,8 @@
 #!/bin/bash
 
-process () {
-  cd /code/cron/ic
-  unzip amateur_delim.zip
-  ./fetch.py amateur_delim.txt
-  echo -n "Finished "
-  date
-} 
-  
+# fetch.py reads the CSV straight out of the downloaded archive and skips
+# the import when the archive hasn't changed since the last run
 cd /code/cron/ic
-rm *.zip *amat*.txt
-wget http://apc-cap.ic.gc.ca/datafiles/amateur_delim.zip && process
+./fetch.py http://apc-cap.ic.gc.ca/datafiles/amateur_delim.zip
+echo -n "Finished "
+date
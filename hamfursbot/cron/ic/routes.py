@@ -39,14 +39,29 @@ By callsign:
     "_id" : serialised BSON nonsense (don't worry about it)
   }
 
+Everything:
+===========
+
+  GET http://rechner.us.to/ic/callbook/
+
+  Response
+  --------
+  JSON list of elements above (without _id), streamed.  Add
+  ?format=ndjson (or send Accept: application/x-ndjson) to get one
+  element per line instead.
+
 """
 
+import os
+import sys
+
 from pymongo import MongoClient
 from flask import Flask, abort, g, jsonify
-from flask.json import JSONEncoder
-from bson import ObjectId
 from bson.json_util import dumps
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import export
+
 app = Flask(__name__)
 
 def get_db():
@@ -70,12 +85,10 @@ def by_callsign(callsign):
     abort(404)
   return dumps(result)
 
+@app.route('/callbook/')
+def dump():
+  return export.response(export.find(get_db().callbook))
 
-class JSONEncoder(JSONEncoder):
-  def default(self, obj):
-    if isinstance(obj, ObjectId):
-      return str(obj)
-    return json.JSONEncoder.default(self, obj)
 
 if __name__ == '__main__':
   app.run(host='0.0.0.0', debug=True)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+Blue/green collection swaps for the cron importers.
+
+Each import is written into a staging collection, indexed, checked
+against the size of the live collection and then renamed over it, so
+readers only ever see the old generation or the new one, never a half
+written mix.  The generation being replaced is kept as <name>_previous
+for rollback, and every swap is recorded in `hamfurs.generations` so
+readers can tell when the data changed.
+
+  swap = importer.Swap(client.ic, 'callbook')
+  for document in documents:
+    swap.insert(document)
+  swap.commit()
+
+To put the previous generation back:
+
+  python3 cron/importer.py rollback ic callbook
+"""
+
+import os
+import sys
+import time
+from pymongo import MongoClient, ReturnDocument
+
+BATCH_SIZE = 1000
+# Refuse to swap in an import with fewer rows than this fraction of
+# the live collection (e.g. a truncated download)
+MIN_RATIO = 0.9
+
+# Built on the staging collection before it goes live
+# (callsign, _id) also serves cron/api's paged listings
+INDEXES = {
+  'ic.callbook' : [([('callsign', 1), ('_id', 1)], {}), ([('location', '2dsphere')], {})],
+  'nkom.callbook' : [([('callsign', 1), ('_id', 1)], {}), ([('location', '2dsphere')], {})],
+  'dmr_marc.users' : [([('callsign', 1), ('_id', 1)], {}), ('radio_id', {})],
+  'arrl.ve_session_counts' : [([('callsign', 1), ('_id', 1)], {}), ('state', {})]
+}
+
+class ValidationError(Exception):
+  pass
+
+def record_generation(client, namespace, rows):
+  """
+  Bumps the generation of `namespace` (e.g. 'ic.callbook') and returns
+  the new generation document.
+  """
+  return client.hamfurs.generations.find_one_and_update(
+    { '_id' : namespace },
+    { '$inc' : { 'generation' : 1 }, '$set' : { 'swapped' : time.time(), 'rows' : rows } },
+    upsert=True,
+    return_document=ReturnDocument.AFTER
+  )
+
+class Swap(object):
+  def __init__(self, db, name, indexes=None, min_ratio=MIN_RATIO, batch_size=BATCH_SIZE):
+    """
+    `indexes` is a list of (keys, options) pairs for create_index(),
+    by default the ones listed in INDEXES.
+    """
+    self.db = db
+    self.name = name
+    self.staging_name = name + '_staging'
+    self.previous_name = name + '_previous'
+    if indexes is None:
+      indexes = INDEXES.get(self.namespace, [])
+    self.indexes = indexes
+    self.min_ratio = min_ratio
+    self.batch_size = batch_size
+    self.buffer = []
+    self.rows = 0
+
+    # Leftovers from a failed run
+    self.db.drop_collection(self.staging_name)
+    self.staging = self.db[self.staging_name]
+
+  @property
+  def namespace(self):
+    return '{0}.{1}'.format(self.db.name, self.name)
+
+  def insert(self, document):
+    self.buffer.append(document)
+    if len(self.buffer) >= self.batch_size:
+      self.flush()
+
+  def insert_many(self, documents):
+    for document in documents:
+      self.insert(document)
+
+  def flush(self):
+    if self.buffer:
+      self.staging.insert_many(self.buffer, ordered=False)
+      self.rows += len(self.buffer)
+      self.buffer = []
+
+  def live_rows(self):
+    if self.name not in self.db.list_collection_names():
+      return 0
+    return self.db[self.name].estimated_document_count()
+
+  def validate(self):
+    previous = self.live_rows()
+    rows = self.staging.count_documents({})
+    if rows == 0:
+      raise ValidationError('{0}: import is empty'.format(self.namespace))
+    if rows < previous * self.min_ratio:
+      raise ValidationError('{0}: only {1} rows, the live collection has {2}'.format(self.namespace, rows, previous))
+    return rows, previous
+
+  def build_indexes(self, collection):
+    for keys, options in self.indexes:
+      collection.create_index(keys, **options)
+
+  def commit(self, force=False):
+    """
+    Validates the staging collection and swaps it in, returning the new
+    generation document.  On a ValidationError the live collection is
+    left alone and the staging collection kept for inspection.
+    """
+    self.flush()
+    if force:
+      rows, previous = self.staging.count_documents({}), self.live_rows()
+    else:
+      rows, previous = self.validate()
+    self.build_indexes(self.staging)
+
+    if previous:
+      # Snapshot the live generation server-side; renaming it away
+      # instead would leave a moment with no collection at all
+      self.db[self.name].aggregate([{ '$match' : {} }, { '$out' : self.previous_name }])
+    self.staging.rename(self.name, dropTarget=True)
+    return record_generation(self.db.client, self.namespace, rows)
+
+  def abort(self):
+    self.buffer = []
+    self.db.drop_collection(self.staging_name)
+
+def rollback(db, name):
+  """
+  Swaps <name>_previous back in over `name`.
+  """
+  namespace = '{0}.{1}'.format(db.name, name)
+  previous = db[name + '_previous']
+  if previous.estimated_document_count() == 0:
+    raise ValidationError('{0}: no previous generation to roll back to'.format(namespace))
+  for keys, options in INDEXES.get(namespace, []):
+    previous.create_index(keys, **options)
+  previous.rename(name, dropTarget=True)
+  return record_generation(db.client, namespace, db[name].estimated_document_count())
+
+if __name__ == '__main__':
+  if len(sys.argv) != 4 or sys.argv[1] != 'rollback':
+    print("Usage: {0} rollback <database> <collection>".format(sys.argv[0]))
+    sys.exit(1)
+  client = MongoClient(host=os.environ['HAMFURS_MONGO_HOST'])
+  generation = rollback(client[sys.argv[2]], sys.argv[3])
+  print("Rolled back {0} to generation {1} ({2} rows)".format(generation['_id'], generation['generation'], generation['rows']))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""
+Bulk callsign lookup across the IC, Nkom, callook.info and HamQTH
+callbooks (the HTTP side of the bot's /lookup_many)
+
+  GET http://rechner.us.to/lookup/?callsigns=<callsign>,<callsign>,...
+  POST http://rechner.us.to/lookup/ with the callsigns in the body,
+    separated by commas, spaces or newlines
+
+    e.g. http://rechner.us.to/lookup/?callsigns=kf3rry,ve3xyz,la1abc
+
+  Add format=text for the same fixed-width table the bot sends.  At most
+  50 callsigns per request.  HamQTH is only used as a fallback when
+  HAMFURS_HAMQTH_USER and HAMFURS_HAMQTH_PASS are set.
+
+  Response
+  --------
+  {
+    "results" : [
+      {
+        "callsign" : string
+        "found" : boolean
+        "source" : "ic", "nkom", "callook" or "hamqth" (when found)
+        ... the remaining non-empty callbook record fields: name,
+            surname, kind, oper_class, address, city, region, postcode,
+            country, grid, latitude, longitude, ...
+      }
+    ]
+    "invalid" : list of strings that didn't look like callsigns
+  }
+"""
+
+import os
+import sys
+import json
+import threading
+
+# bulk, hamqth and callbook are shared with the bot; Dockerfile-cron
+# copies them into the image alongside cron/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import requests
+from pymongo import MongoClient
+from flask import Flask, abort, request, Response
+
+import bulk
+import hamqth
+import callbook
+
+CALLOOK_URL = 'https://callook.info/{0}/json'
+
+app = Flask(__name__)
+
+client = MongoClient(host=os.environ.get('HAMFURS_MONGO_HOST'))
+session = requests.Session()
+hamqth_client = None
+hamqth_lock = threading.Lock()
+if os.environ.get('HAMFURS_HAMQTH_USER'):
+  hamqth_client = hamqth.HamQTH(os.environ['HAMFURS_HAMQTH_USER'], os.environ['HAMFURS_HAMQTH_PASS'])
+
+def remote_lookup(callsign):
+  status, record = callbook.fetch_callook(CALLOOK_URL, callsign, session)
+  if record is None and hamqth_client is not None:
+    with hamqth_lock:
+      data = hamqth_client.callbook(callsign)
+    if data is not None:
+      record = callbook.from_hamqth(data)
+  return record
+
+lookup = bulk.BulkLookup(client, remote_lookup)
+
+def as_json(callsign, record):
+  if record is None:
+    return { 'callsign' : callsign, 'found' : False }
+  result = { 'found' : True }
+  for field in callbook.Record.__slots__:
+    value = getattr(record, field)
+    if value is not None:
+      result[field] = value
+  return result
+
+@app.route('/', methods=['GET', 'POST'])
+def lookup_many():
+  if request.method == 'POST':
+    text = request.get_data(as_text=True)
+  else:
+    text = request.args.get('callsigns', '')
+  if not text:
+    return __doc__, 501, {'Content-Type': 'text/plain'}
+
+  callsigns, invalid = bulk.parse_callsigns(text)
+  if len(callsigns) > bulk.MAX_CALLSIGNS:
+    abort(413)
+  results = lookup.lookup(callsigns)
+
+  if request.args.get('format') == 'text':
+    return Response(bulk.table(results) + '\n', mimetype='text/plain')
+  body = {
+    'results' : [as_json(c, r) for c, r in results.items()],
+    'invalid' : invalid
+  }
+  return Response(json.dumps(body), mimetype='application/json')
+
+if __name__ == '__main__':
+  # Development only; in production it runs under gunicorn (docker-compose.yml)
+  app.run(host='0.0.0.0', threaded=True)
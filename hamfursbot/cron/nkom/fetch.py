@@ -2,22 +2,20 @@
 
 import os
 import sys
-import csv
 import time
 import datetime
+import functools
 from pymongo import MongoClient
 
-if len(sys.argv) != 2:
-  print("Usage: {0} <inputfile>".format(sys.argv[0]))
-  sys.exit(1)
-filename = sys.argv[1]
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import runstats
+import importer
+import csvimport
+import postcodes
 
-client = MongoClient(os.environ['HAMFURS_MONGO_HOST'])
-db = client.nkom
-collection = db.callbook
-
-count = 0
-updated = 0
+ENCODING = 'cp865'
+# Filled in before the parser processes fork, so they inherit it
+POSTCODES = {}
 
 TYPES = {
   'Personlig' : 'Person',
@@ -27,53 +25,76 @@ TYPES = {
   'Skole' : 'School'
 }
 
-# Import CSV
-try:
-  with open(sys.argv[1], encoding='cp865') as csvfile:
-    timestamp = int(time.time())
-    reader = csv.reader(csvfile, delimiter=';')
-    for row in reader:
-      if row[9] in TYPES.keys():
-        record_type = TYPES[row[9]]
-      else:
-        record_type = row[9]
+def transform(row, timestamp):
+  if row[9] in TYPES.keys():
+    record_type = TYPES[row[9]]
+  else:
+    record_type = row[9]
+
+  try:
+    updated_date = datetime.datetime.strptime(row[12], '%d.%m.%Y').strftime('%Y-%m-%d')
+  except:
+    updated_date = row[12]
+
+  return {
+    'callsign' : row[0],
+    'club' : row[1],
+    'name' : row[2],
+    'surname' : row[3],
+    'address' : row[4],
+    'address2' : row[5],
+    'city' : row[7],
+    'country' : row[8],
+    'type' : record_type,
+    'postcode' : row[6],
+    'location' : postcodes.location(POSTCODES, row[6]),
+    'cached' : timestamp,
+    'updated' : updated_date,
+    'valid' : row[10],
+    'expiration' : row[11],
+    'comment' : row[13]
+  }
+
+def progress(document):
+  sys.stderr.write("Processing {0}    \r".format(document['callsign']))
 
-      try:
-        updated_date = datetime.datetime.strptime(row[12], '%d.%m.%Y').strftime('%Y-%m-%d')
-      except:
-        updated_date = row[12]
+if __name__ == '__main__':
+  if len(sys.argv) != 2:
+    print("Usage: {0} <inputfile>".format(sys.argv[0]))
+    sys.exit(1)
+  filename = sys.argv[1]
 
-      document = {
-        'callsign' : row[0],
-        'club' : row[1],
-        'name' : row[2],
-        'surname' : row[3],
-        'address' : row[4],
-        'address2' : row[5],
-        'city' : row[7],
-        'country' : row[8],
-        'type' : record_type,
-        'postcode' : row[6],
-        'cached' : timestamp,
-        'updated' : updated_date,
-        'valid' : row[10],
-        'expiration' : row[11],
-        'comment' : row[13]
-      }
+  client = MongoClient(os.environ['HAMFURS_MONGO_HOST'])
+  db = client.nkom
+  stats = runstats.RunStats('nkom', client)
+  swap = importer.Swap(db, 'callbook')
+  POSTCODES.update(postcodes.load('NO'))
 
-      # NOTE: Drop all and insert seems to be much faster than update
-      #collection.insert_one(document)
-      r = collection.replace_one({'callsign' : row[0]}, document, upsert=True)
-      updated += r.modified_count
+  count = 0
+  previous = 0
+  success = True
 
-      count += 1
-      sys.stderr.write("Processing {0}    \r".format(row[0]))
+  # Import CSV; parsed in parallel, loaded into a staging collection
+  # and swapped in once complete
+  try:
+    count = csvimport.run(filename, functools.partial(transform, timestamp=int(time.time())), swap.insert_many,
+                          ENCODING, header=True, progress=progress)
+  except FileNotFoundError as e:
+    print("No such file: {0}.\n{1}".format(filename, e))
+    success = False
 
+  generation = None
+  if success:
+    previous = swap.live_rows()
+    try:
+      generation = swap.commit()['generation']
+    except importer.ValidationError as e:
+      print("\nNot swapping in the import: {0}".format(e))
+      success = False
 
-except FileNotFoundError as e:
-  print("No such file: {0}.\n{1}".format(sys.argv[1], e))
+  stats.finish(rows=count, success=success, previous=previous, generation=generation)
 
-print("\n[ OK ]")
-print("  Processed: {0}".format(count))
-print("    Updated: {0}".format(updated))
-print("        New: {0}".format(count - updated))
+  print("\n[ {0} ]".format('OK' if success else 'FAILED'))
+  print("  Processed: {0}".format(count))
+  print("   Previous: {0}".format(previous))
+  print(" Generation: {0}".format(generation))
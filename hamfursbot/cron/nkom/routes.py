@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+A JSON API for the Nkom (Norway) Amateur Radio callbook
+
+By callsign:
+============
+
+  GET http://rechner.us.to/nkom/callbook/<callsign>
+
+    e.g. http://rechner.us.to/nkom/callbook/la1abc
+
+  Response
+  --------
+  {
+    "callsign" : string
+    "name" : string
+    "surname" : string
+    "club" : string
+    "address" : string
+    "address2" : string
+    "postcode" : string
+    "city" : string
+    "country" : string
+    "type" : string, e.g. "Person" or "Organisation"
+    "valid" : string
+    "expiration" : string
+    "comment" : string
+    "updated" : string, YYYY-MM-DD
+    "cached" : int UTC UNIX timestamp of the import
+  }
+
+Everything:
+===========
+
+  GET http://rechner.us.to/nkom/callbook/
+
+  Response
+  --------
+  JSON list of elements above, streamed.  Add ?format=ndjson (or send
+  Accept: application/x-ndjson) to get one element per line instead.
+
+"""
+
+import os
+import sys
+from pymongo import MongoClient
+from flask import Flask, abort, g
+from bson.json_util import dumps
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import export
+
+app = Flask(__name__)
+
+def get_db():
+  db = getattr(g, 'database', None)
+  if db is None:
+    g.client = MongoClient()
+    g.database = g.client.nkom
+  return g.database
+
+@app.route('/')
+def index():
+  return __doc__, 501, {'Content-Type': 'text/plain'}
+
+@app.route('/callbook/<callsign>')
+def by_callsign(callsign):
+  result = get_db().callbook.find_one({ 'callsign' : callsign.upper() }, export.PROJECTION)
+  if result is None:
+    abort(404)
+  return dumps(result)
+
+@app.route('/callbook/')
+def dump():
+  return export.response(export.find(get_db().callbook))
+
+if __name__ == '__main__':
+  app.run(host='0.0.0.0', debug=True)
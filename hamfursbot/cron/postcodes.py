@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""
+Postcode centroids from GeoNames (https://download.geonames.org/export/zip/,
+CC BY 4.0), used by the IC and Nkom imports to give every record a
+GeoJSON `location` for the bot's /nearby and /distance.
+
+Canadian entries are forward sortation areas (the first three characters
+of a postcode), Norwegian ones whole four digit postcodes.
+
+  table = postcodes.load('CA')
+  postcodes.location(table, 'K1A 0A1', 3)
+"""
+
+import io
+import zipfile
+import requests
+
+URL = 'https://download.geonames.org/export/zip/{0}.zip'
+
+def normalise(postcode, length=None):
+  postcode = postcode.replace(' ', '').upper()
+  return postcode[:length] if length else postcode
+
+def parse(lines):
+  # country, postcode, place, admin names and codes..., latitude, longitude, accuracy
+  table = {}
+  for line in lines:
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) < 11:
+      continue
+    try:
+      table[normalise(fields[1])] = (float(fields[9]), float(fields[10]))
+    except ValueError:
+      continue
+  return table
+
+def load(country, source=None):
+  """
+  Returns {postcode: (latitude, longitude)} for a two letter country
+  code, from `source` (a GeoNames .zip or .txt) or downloaded.  Returns
+  an empty table if it can't be had, so an import carries on without
+  locations.
+  """
+  member = '{0}.txt'.format(country)
+  try:
+    if source is None:
+      response = requests.get(URL.format(country), timeout=60)
+      response.raise_for_status()
+      source = io.BytesIO(response.content)
+    elif source.endswith('.txt'):
+      with open(source, encoding='utf-8') as f:
+        return parse(f)
+    with zipfile.ZipFile(source) as archive, archive.open(member) as f:
+      return parse(io.TextIOWrapper(f, encoding='utf-8'))
+  except (OSError, KeyError, zipfile.BadZipFile, requests.RequestException) as e:
+    print("Unable to load {0} postcodes, importing without locations.\n{1}".format(country, e))
+    return {}
+
+def location(table, postcode, length=None):
+  """
+  Returns a GeoJSON point for `postcode`, or None.
+  """
+  found = table.get(normalise(postcode, length)) if postcode else None
+  if found is None:
+    return None
+  latitude, longitude = found
+  return { 'type' : 'Point', 'coordinates' : [longitude, latitude] }
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+"""
+Records the outcome of each cron job run in `hamfurs.cron_runs`, one
+document per job, so the bot can export them on its /metrics endpoint.
+
+  stats = runstats.RunStats('ic')
+  ...
+  stats.finish(rows=count)
+"""
+
+import os
+import time
+from pymongo import MongoClient
+
+
+class RunStats(object):
+  def __init__(self, job, client=None):
+    self.job = job
+    self.client = client
+    self.started = time.time()
+
+  def get_client(self):
+    if self.client is None:
+      self.client = MongoClient(host=os.environ['HAMFURS_MONGO_HOST'])
+    return self.client
+
+  def last(self):
+    """
+    Returns the document recorded by the previous run of this job, or None.
+    """
+    return self.get_client().hamfurs.cron_runs.find_one({'job' : self.job})
+
+  def finish(self, rows=0, success=True, **extra):
+    client = self.get_client()
+    finished = time.time()
+    document = {
+      'job' : self.job,
+      'started' : self.started,
+      'finished' : finished,
+      'duration' : finished - self.started,
+      'rows' : rows,
+      'success' : success
+    }
+    document.update(extra)
+    client.hamfurs.cron_runs.replace_one({'job' : self.job}, document, upsert=True)
+    return document
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""
+Tracks which bot reply belongs to which user message, so that editing a
+/callsign or /define request edits our answer instead of sending a new
+one.
+
+Recent mappings live in a bounded in-memory LRU; new ones are written
+behind to Mongo in batches by a background thread.  A TTL index drops
+them from Mongo once Telegram no longer lets anyone edit the message.
+
+Mongo is only consulted on an LRU miss for a message old enough that the
+LRU can't vouch for it (sent before we started, or before the oldest
+entry we have evicted), so answering a fresh message never blocks on it.
+
+A reply still waiting in the outbox is registered with expect(); until
+Telegram answers, get() returns its Future so an early edit can follow
+the reply instead of sending a second one.
+
+With `shared` (clustered mode) another replica may have answered the
+message, so a miss always goes to Mongo, and new mappings are written
+as soon as the reply is sent rather than on the next flush.
+"""
+
+import time
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+
+from pymongo import ReplaceOne
+
+logger = logging.getLogger("HamfursBot.editstore")
+
+# Telegram stops allowing edits to messages after 48 hours
+EDIT_WINDOW = 48 * 60 * 60
+
+
+class EditStore(object):
+    def __init__(self, collection, capacity=10000, ttl=EDIT_WINDOW, flush_interval=5, shared=False):
+        self.collection = collection
+        self.shared = shared
+        self.capacity = capacity
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cache = OrderedDict()
+        self.pending = []
+        # (chat_id, user_message_id): Future of a reply not yet sent
+        self.sending = {}
+        # Any message dated after this has a complete record in the LRU
+        self.complete_since = time.time()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.indexed = False
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="EditStore", daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.cache)
+
+    def get(self, chat_id, user_message_id, date=None):
+        """
+        Returns the id of our reply to the given user message, or None.
+        If the reply is still being sent, returns the Future from
+        expect() instead.  `date` is the user message's Telegram
+        timestamp.
+        """
+        key = (chat_id, user_message_id)
+        with self.lock:
+            sending = self.sending.get(key)
+            if sending is not None:
+                return sending
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+                return entry[0]
+            if date is not None and date >= self.complete_since and not self.shared:
+                return None
+        if date is not None and time.time() - date > self.ttl:
+            return None
+
+        document = self.collection.find_one(
+            {"chat_id": chat_id, "user_message_id": user_message_id}
+        )
+        if document is None:
+            return None
+        self.remember(key, document["bot_message_id"], date)
+        return document["bot_message_id"]
+
+    def put(self, chat_id, user_message_id, bot_message_id, date=None):
+        if date is None:
+            date = time.time()
+        key = (chat_id, user_message_id)
+        with self.lock:
+            self.pending.append((key, bot_message_id, date))
+        self.remember(key, bot_message_id, date)
+        if self.shared:
+            self.wake.set()
+
+    def expect(self, chat_id, user_message_id, sent, date=None):
+        """
+        Registers `sent`, the Future of our reply (a Message) to the
+        given user message, and put()s the mapping once it is sent.
+        """
+        key = (chat_id, user_message_id)
+        with self.lock:
+            self.sending[key] = sent
+
+        def done(future):
+            if future.exception() is None:
+                self.put(chat_id, user_message_id, future.result().message_id, date)
+            with self.lock:
+                if self.sending.get(key) is future:
+                    del self.sending[key]
+
+        sent.add_done_callback(done)
+
+    def remember(self, key, bot_message_id, date):
+        with self.lock:
+            self.cache[key] = (bot_message_id, date)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.capacity:
+                _, (_, evicted) = self.cache.popitem(last=False)
+                self.complete_since = max(self.complete_since, evicted)
+
+    def ensure_indexes(self):
+        self.collection.create_index([("chat_id", 1), ("user_message_id", 1)])
+        self.collection.create_index("created", expireAfterSeconds=self.ttl)
+        # Mappings written before the TTL index existed would never expire
+        self.collection.delete_many({"created": {"$exists": False}})
+        self.indexed = True
+
+    def flush(self):
+        if not self.pending:
+            return 0
+        if not self.indexed:
+            self.ensure_indexes()
+        with self.lock:
+            pending, self.pending = self.pending, []
+        requests = [
+            ReplaceOne(
+                {"chat_id": chat_id, "user_message_id": user_message_id},
+                {
+                    "chat_id": chat_id,
+                    "user_message_id": user_message_id,
+                    "bot_message_id": bot_message_id,
+                    "created": datetime.datetime.fromtimestamp(date, datetime.timezone.utc),
+                },
+                upsert=True,
+            )
+            for (chat_id, user_message_id), bot_message_id, date in pending
+        ]
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except Exception:
+            with self.lock:
+                self.pending = pending + self.pending
+            raise
+        return len(requests)
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Unable to write edit mappings: {0}".format(e))
+
+    def close(self):
+        self.running = False
+        self.wake.set()
+        self.flush()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+"""
+Maidenhead locators, great circle distances and the geospatial index
+behind /distance and /nearby.
+
+Every collection that knows where a station is keeps a GeoJSON point in
+`location`, with a 2dsphere index:
+
+  ic.callbook, nkom.callbook  postcode centroids, added by the cron imports
+  hamfurs.locations           callook.info (ULS) and HamQTH answers,
+                              recorded whenever a callsign is looked up
+  hamfurs.aliases             set by the user with /setgrid
+
+so a nearby query is one $nearSphere per collection, answered from the
+index without any upstream calls.  The grid and distance functions take
+NumPy arrays as well as single values.
+"""
+
+import re
+import time
+import logging
+
+import numpy as np
+from pymongo.errors import PyMongoError
+
+import callbook
+
+logger = logging.getLogger("HamfursBot.geo")
+
+EARTH_RADIUS = 6371.0088
+KM_TO_MILES = 0.621371
+GRID = re.compile(r"^[A-R]{2}(?:\d{2}(?:[A-X]{2}(?:\d{2})?)?)?$", re.IGNORECASE)
+
+# Longitude and latitude spanned by each pair of locator characters
+LON_SIZES = np.array([20.0, 2.0, 2.0 / 24, 2.0 / 240])
+LAT_SIZES = np.array([10.0, 1.0, 1.0 / 24, 1.0 / 240])
+# Letters count from "A", digits from "0"
+OFFSETS = np.array([65, 48, 65, 48])
+LIMITS = np.array([18, 10, 24, 10])
+
+MAX_NEARBY = 25
+MAX_RADIUS = 2000
+
+
+def is_grid(text):
+    return bool(GRID.match(text))
+
+
+def grid_to_latlon(grids):
+    """
+    Returns the centre of each Maidenhead locator (2 to 8 characters)
+    as (latitude, longitude).  Takes a single locator or a sequence.
+    """
+    single = isinstance(grids, str)
+    grids = np.atleast_1d(np.asarray(grids, dtype=str))
+    if grids.dtype.itemsize > 8 * 4:
+        raise ValueError("Maidenhead locators are at most 8 characters")
+    # Code points straight out of the unicode buffer, zero padded to 8
+    codes = np.zeros((len(grids), 8), dtype=np.int64)
+    if grids.dtype.itemsize:
+        codes[:, : grids.dtype.itemsize // 4] = grids.view(np.uint32).reshape(len(grids), -1)
+    codes = codes.reshape(-1, 4, 2)
+    lengths = (codes != 0).sum(axis=(1, 2))
+    pairs = lengths // 2
+    # Upper case letters
+    codes -= ((codes >= 97) & (codes <= 122)) * 32
+    values = codes - OFFSETS[None, :, None]
+    # Only the pairs each locator actually has
+    used = np.arange(4)[None, :] < pairs[:, None]
+    valid = (lengths % 2 == 0) & (pairs >= 1)
+    valid &= ((values >= 0) & (values < LIMITS[None, :, None]) | ~used[:, :, None]).all(axis=(1, 2))
+    if not valid.all():
+        raise ValueError("{0} isn't a Maidenhead locator".format(grids[~valid][0]))
+    longitude = -180 + (values[:, :, 0] * LON_SIZES * used).sum(axis=1) + LON_SIZES[pairs - 1] / 2
+    latitude = -90 + (values[:, :, 1] * LAT_SIZES * used).sum(axis=1) + LAT_SIZES[pairs - 1] / 2
+    if single:
+        return float(latitude[0]), float(longitude[0])
+    return latitude, longitude
+
+
+def latlon_to_grid(latitude, longitude, precision=6):
+    """
+    Returns the Maidenhead locator of each point, `precision` characters
+    long (2, 4, 6 or 8).
+    """
+    single = np.isscalar(latitude)
+    pairs = precision // 2
+    lat = np.clip(np.atleast_1d(np.asarray(latitude, dtype=np.float64)) + 90, 0, 180 - 1e-9)
+    lon = np.clip(np.atleast_1d(np.asarray(longitude, dtype=np.float64)) + 180, 0, 360 - 1e-9)
+    codes = np.empty((len(lat), pairs, 2), dtype=np.uint8)
+    for i in range(pairs):
+        lon_index = np.floor(lon / LON_SIZES[i])
+        lat_index = np.floor(lat / LAT_SIZES[i])
+        lon -= lon_index * LON_SIZES[i]
+        lat -= lat_index * LAT_SIZES[i]
+        codes[:, i, 0] = lon_index + OFFSETS[i]
+        codes[:, i, 1] = lat_index + OFFSETS[i]
+    # Subsquares are written in lower case
+    if pairs > 2:
+        codes[:, 2, :] += 32
+    grids = codes.reshape(len(lat), -1).view("S{0}".format(pairs * 2))[:, 0].astype(str)
+    if single:
+        return str(grids[0])
+    return grids
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in km (haversine).
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    """
+    Initial bearing from the first point to the second, in degrees.
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    x = np.sin(lon2 - lon1) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+    return np.degrees(np.arctan2(x, y)) % 360
+
+
+def point(latitude, longitude):
+    return {"type": "Point", "coordinates": [float(longitude), float(latitude)]}
+
+
+def coordinates(document):
+    """
+    Returns (latitude, longitude) of a document's `location`, or None.
+    """
+    location = document.get("location") if document else None
+    if not location:
+        return None
+    longitude, latitude = location["coordinates"]
+    return latitude, longitude
+
+
+class Locator(object):
+    """
+    Finds stations by callsign or by distance across the collections
+    listed above.  `positions` is the APRS gateway's PositionCache, if
+    it's running; a station's last APRS position beats anything else.
+    """
+
+    def __init__(self, client, aliases, positions=None):
+        self.client = client
+        self.aliases = aliases
+        self.positions = positions
+        self.collections = (
+            (callbook.IC, client.ic.callbook),
+            (callbook.NKOM, client.nkom.callbook),
+            ("remote", client.hamfurs.locations),
+            ("alias", client.hamfurs.aliases),
+        )
+
+    def ensure_indexes(self):
+        # The cron imports build the callbook indexes on every swap, but
+        # data imported before that (or not re-imported since) has none
+        for name, collection in self.collections:
+            try:
+                collection.create_index([("location", "2dsphere")])
+            except PyMongoError as e:
+                logger.error("Unable to create the geospatial index on {0}: {1}".format(name, e))
+        try:
+            self.client.hamfurs.locations.create_index("callsign", unique=True)
+        except PyMongoError as e:
+            logger.error("Unable to create the locations index: {0}".format(e))
+
+    def record(self, record):
+        """
+        Remembers where a callook.info or HamQTH record says a station is.
+        """
+        if record is None:
+            return
+        if record.latitude is not None and record.longitude is not None:
+            latitude, longitude = record.latitude, record.longitude
+        elif record.grid and is_grid(record.grid):
+            latitude, longitude = grid_to_latlon(record.grid)
+        else:
+            return
+        try:
+            self.client.hamfurs.locations.update_one(
+                {"callsign": record.callsign},
+                {
+                    "$set": {
+                        "callsign": record.callsign,
+                        "source": record.source,
+                        "location": point(latitude, longitude),
+                        "updated": int(time.time()),
+                    }
+                },
+                upsert=True,
+            )
+        except PyMongoError as e:
+            logger.error("Unable to record location of {0}: {1}".format(record.callsign, e))
+
+    def locate(self, callsign):
+        """
+        Returns (latitude, longitude, source) for `callsign` from local
+        data only, or None.
+        """
+        callsign = callsign.upper()
+        if self.positions is not None:
+            position = self.positions.get(callsign)
+            if position is not None:
+                return position.latitude, position.longitude, "APRS"
+        found = coordinates(self.aliases.by_callsign(callsign))
+        if found is not None:
+            return found + ("alias",)
+        source = callbook.source_for(callsign)
+        for name, collection in self.collections[:3]:
+            if name in (callbook.IC, callbook.NKOM) and name != source:
+                continue
+            found = coordinates(collection.find_one({"callsign": callsign}, {"location": True}))
+            if found is not None:
+                return found + (name,)
+        return None
+
+    def resolve(self, text):
+        """
+        Returns (latitude, longitude, label) for a locator or callsign.
+        Raises ValueError if it can't be placed.
+        """
+        if is_grid(text):
+            latitude, longitude = grid_to_latlon(text)
+            return latitude, longitude, text[:2].upper() + text[2:4] + text[4:].lower()
+        found = self.locate(text)
+        if found is None:
+            raise ValueError("Don't know where {0} is".format(text.upper()))
+        return found[0], found[1], text.upper()
+
+    def nearby(self, latitude, longitude, km, limit=MAX_NEARBY):
+        """
+        Returns up to `limit` (distance km, callsign, grid, source)
+        tuples within `km` of a point, nearest first.
+        """
+        query = {
+            "location": {
+                "$nearSphere": {
+                    "$geometry": point(latitude, longitude),
+                    "$maxDistance": km * 1000,
+                }
+            }
+        }
+        found = {}
+        for name, collection in self.collections:
+            try:
+                documents = list(collection.find(query, {"callsign": True, "location": True}).limit(limit))
+            except PyMongoError as e:
+                # E.g. no 2dsphere index yet; the other collections may still answer
+                logger.error("Unable to search {0} for nearby stations: {1}".format(name, e))
+                continue
+            for document in documents:
+                # Later collections are more specific (a user's own grid)
+                found[document["callsign"]] = (coordinates(document), name)
+        if not found:
+            return []
+        callsigns = list(found)
+        points = np.array([found[c][0] for c in callsigns])
+        distances = distance(latitude, longitude, points[:, 0], points[:, 1])
+        grids = latlon_to_grid(points[:, 0], points[:, 1])
+        order = np.argsort(distances, kind="stable")[:limit]
+        return [(float(distances[i]), callsigns[i], grids[i], found[callsigns[i]][1]) for i in order]
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""
+Syncs glossary sources into `hamfurs.definitions`, the collection behind
+/define.
+
+Sources are JSON files, either the Q-code list in res/qcodes.json
+(objects with code, query and answer) or a plain glossary (objects with
+term, definition and optionally keywords and contributor).  Every entry
+is keyed by its `index` (the lower-cased term) and gets its
+double-metaphone keys computed once per distinct term.  The existing
+documents are read in one query and only entries that are new or
+changed are written, as upserts in one bulk_write, so running the sync
+again changes nothing and never creates duplicates.
+
+Definitions added with /add_definition are left alone unless --force is
+given, and duplicate documents left by older imports are removed; a
+user's copy of a term always wins over the bot's and is never deleted.
+--prune also deletes the bot's own definitions that are in none of the
+sources (e.g. the mangled "[[qsl card|qsl]]" entries import-qcodes.py
+used to write), so give it every source at once.
+
+  python3 glossary.py res/qcodes.json my-glossary.json
+  python3 glossary.py --prune res/qcodes.json my-glossary.json
+  python3 glossary.py --dry-run res/qcodes.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+from functools import lru_cache
+
+from pymongo import MongoClient, DeleteOne, UpdateOne
+from metaphone import doublemetaphone
+
+logger = logging.getLogger("HamfursBot.glossary")
+
+CONTRIBUTOR = "HamFursBot"
+QCODE_SOURCE = "[Source](https://en.wikipedia.org/wiki/Q_code#Q_codes_as_adapted_for_use_in_amateur_radio)"
+DEFAULT_SOURCES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "res", "qcodes.json")]
+BATCH_SIZE = 1000
+WIKI_LINK = re.compile(r"\[\[([^|\]]*)(?:\|([^\]]*))?\]\]")
+
+# The fields a sync owns; anything else on a document is kept
+FIELDS = ("term", "index", "keywords", "definition", "metaphone", "contributor")
+
+
+def unlink(text):
+    """
+    Strips wiki link markup: "[[QSL card|QSL]]" is "QSL".
+    """
+    return WIKI_LINK.sub(lambda m: m.group(2) or m.group(1), text)
+
+
+@lru_cache(maxsize=None)
+def phonetic(term):
+    return list(doublemetaphone(term))
+
+
+def entry(term, definition, keywords=None, contributor=CONTRIBUTOR):
+    term = term.strip()
+    return {
+        "term": term,
+        "index": term.lower(),
+        "keywords": [k.strip().lower() for k in keywords or term.split()],
+        "definition": definition,
+        "metaphone": phonetic(term),
+        "contributor": contributor,
+    }
+
+
+def load(filename):
+    """
+    Returns the glossary entries in a source file.
+    """
+    with open(filename) as f:
+        items = json.load(f)
+    entries = []
+    for item in items:
+        if "code" in item:
+            definition = "*Question:* _{0}_\n*Answer:* {1}\n{2}".format(
+                unlink(item["query"]), unlink(item["answer"]), QCODE_SOURCE
+            )
+            entries.append(entry(unlink(item["code"]), definition))
+        else:
+            entries.append(
+                entry(
+                    item["term"],
+                    item["definition"],
+                    item.get("keywords"),
+                    item.get("contributor", CONTRIBUTOR),
+                )
+            )
+    return entries
+
+
+def plan(collection, entries, force=False, prune=False):
+    """
+    Diffs `entries` against the collection.  Returns (operations,
+    counts), where counts has inserted, updated, unchanged, kept (user
+    contributed, not overwritten), duplicates (the bot's own extra
+    copies of a term) and, with `prune`, the bot's own definitions no
+    source has any more.
+    """
+    counts = dict.fromkeys(("inserted", "updated", "unchanged", "kept", "duplicates", "pruned"), 0)
+    wanted = {}
+    for e in entries:
+        # A later source overrides an earlier one
+        wanted[e["index"]] = e
+
+    found = {}
+    for document in collection.find(
+        {"index": {"$in": list(wanted)}}, dict.fromkeys(FIELDS, True)
+    ).sort("_id", 1):
+        found.setdefault(document["index"], []).append(document)
+
+    existing = {}
+    operations = []
+    for index, documents in found.items():
+        # The oldest user contributed copy survives, else the oldest copy
+        users = [d for d in documents if d.get("contributor") != CONTRIBUTOR]
+        existing[index] = (users or documents)[0]
+        for document in documents:
+            if document is existing[index]:
+                continue
+            if document.get("contributor") == CONTRIBUTOR:
+                operations.append(DeleteOne({"_id": document["_id"]}))
+                counts["duplicates"] += 1
+            else:
+                counts["kept"] += 1
+    if prune:
+        for document in collection.find(
+            {"contributor": CONTRIBUTOR, "index": {"$nin": list(wanted)}}, {"_id": True}
+        ):
+            operations.append(DeleteOne({"_id": document["_id"]}))
+            counts["pruned"] += 1
+
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for index, e in wanted.items():
+        document = existing.get(index)
+        if document is None:
+            counts["inserted"] += 1
+        elif all(document.get(field) == e[field] for field in FIELDS):
+            counts["unchanged"] += 1
+            continue
+        elif document.get("contributor") != e["contributor"] and not force:
+            counts["kept"] += 1
+            continue
+        else:
+            counts["updated"] += 1
+        # The document that survives deduplication, by _id
+        selector = {"index": index} if document is None else {"_id": document["_id"]}
+        operations.append(UpdateOne(selector, {"$set": dict(e, last_edit=now)}, upsert=True))
+    return operations, counts
+
+
+def sync(collection, entries, force=False, prune=False, dry_run=False):
+    collection.create_index("index")
+    operations, counts = plan(collection, entries, force, prune)
+    if dry_run:
+        return counts
+    for start in range(0, len(operations), BATCH_SIZE):
+        collection.bulk_write(operations[start : start + BATCH_SIZE], ordered=False)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("sources", nargs="*", default=DEFAULT_SOURCES, help="glossary JSON files")
+    parser.add_argument("--force", action="store_true", help="overwrite user contributed definitions")
+    parser.add_argument(
+        "--prune", action="store_true", help="delete {0} definitions not in the sources".format(CONTRIBUTOR)
+    )
+    parser.add_argument("--dry-run", action="store_true", help="only report what would change")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    start = time.perf_counter()
+    entries = []
+    for source in args.sources:
+        entries.extend(load(source))
+    client = MongoClient(host=os.environ.get("HAMFURS_MONGO_HOST", "localhost"))
+    collection = client.hamfurs.definitions
+    counts = sync(collection, entries, args.force, args.prune, args.dry_run)
+    logger.info(
+        "{0} entries from {1} sources in {2:.2f}s{3}: {4}; {5} definitions".format(
+            len(entries),
+            len(args.sources),
+            time.perf_counter() - start,
+            " (dry run)" if args.dry_run else "",
+            ", ".join("{0} {1}".format(v, k) for k, v in counts.items()),
+            collection.count_documents({}),
+        )
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
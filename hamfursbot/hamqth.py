@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import time
 from xml.etree import ElementTree
 import requests
 
@@ -11,6 +12,9 @@ ENDPOINTS = {
 __version__ = '0.0.1'
 
 USERAGENT = "pyHamQTH v{0}".format(__version__)
+TIMEOUT = 10
+# After a failed login, fail fast for this long instead of trying again
+LOGIN_RETRY = 60
 
 class Error(Exception):
   pass
@@ -25,13 +29,23 @@ class NotFoundError(RequestError):
   pass
 
 class HamQTH(object):
-  def __init__(self, username, password, agent=USERAGENT):
+  def __init__(self, username, password, agent=USERAGENT, login=True, timeout=TIMEOUT):
+    """
+    With login=False no request is made until login() or the first
+    callbook() call, e.g. to log in from a background thread.
+    """
     self.username = username
     self.password = password
     self.user_agent = agent
+    self.timeout = timeout
     self.session_id = None
     self.retries = None
+    self.login_failed = None
 
+    if login:
+      self._refresh_session()
+
+  def login(self):
     self._refresh_session()
 
   def _check_session(self, tree):
@@ -54,14 +68,19 @@ class HamQTH(object):
       'username' : self.username,
       'password' : self.password
     }
-    response = requests.get(endpoint.format(**arguments))
-
-    tree = ElementTree.fromstring(response.content)
+    try:
+      response = requests.get(endpoint.format(**arguments), timeout=self.timeout)
+      tree = ElementTree.fromstring(response.content)
+    except (requests.RequestException, ElementTree.ParseError) as e:
+      self.login_failed = time.monotonic()
+      raise RequestError('Unable to log in: {0}'.format(e))
     assert tree.tag == '{https://www.hamqth.com}HamQTH'
 
     if tree[0][0].tag == '{https://www.hamqth.com}session_id':
       self.session_id = tree[0][0].text
+      self.login_failed = None
     elif tree[0][0].tag == '{https://www.hamqth.com}error':
+      self.login_failed = time.monotonic()
       raise AuthenticationError(tree[0][0].text)
 
   def _increment_retry(self):
@@ -73,6 +92,10 @@ class HamQTH(object):
       raise RequestError('Maximum retries exceeded')
 
   def callbook(self, callsign):
+    if self.session_id is None:
+      if self.login_failed is not None and time.monotonic() - self.login_failed < LOGIN_RETRY:
+        raise RequestError('Not logged in to HamQTH')
+      self._refresh_session()
     self._increment_retry()
     endpoint = ENDPOINTS['callbook']
     arguments = {
@@ -80,9 +103,13 @@ class HamQTH(object):
       'callsign' : callsign,
       'agent' : self.user_agent
     }
-    response = requests.get(endpoint.format(**arguments))
-    #import pdb; pdb.set_trace()
-    tree = ElementTree.fromstring(response.content)
+    try:
+      response = requests.get(endpoint.format(**arguments), timeout=self.timeout)
+      tree = ElementTree.fromstring(response.content)
+    except (requests.RequestException, ElementTree.ParseError) as e:
+      # Timeouts and dropped connections are as transient as a bad session
+      self.retries = None
+      raise RequestError('HamQTH request failed: {0}'.format(e))
 
     try:
       retry = self._check_session(tree)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+"""
+Non-blocking structured logging.
+
+Loggers only build the LogRecord and drop it on a bounded queue; a
+background thread formats it (one JSON object per line, or the old text
+format) and writes it out.  When the queue is full the record is
+dropped and counted rather than making a handler wait on stderr.
+
+Structured fields go in `extra` and end up as JSON keys:
+
+  rbn_log.info("Heard %s", callsign, extra={"callsign": callsign, "snr": snr})
+
+Configured from the environment by setup():
+
+  HAMFURS_LOG_FORMAT  json (default) or text
+  HAMFURS_LOG_LEVELS  per-logger levels on top of LEVELS, e.g.
+                      "TeleBot=WARNING,HamfursBot.aprs=DEBUG" (a bare level
+                      sets the root logger)
+  HAMFURS_LOG_SAMPLE  fraction of records kept for high-volume loggers, on
+                      top of SAMPLE, e.g. "HamfursBot.rbn=0.01"; warnings
+                      are always kept
+  HAMFURS_LOG_QUEUE   queue size (default 10000)
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import datetime
+import logging.handlers
+
+import metrics
+
+LEVELS = "INFO,TeleBot=INFO"
+# RBN spots and file_id debugging can arrive many times a second
+SAMPLE = "HamfursBot.rbn=0.1,HamfursBot.file_ids=0.1"
+QUEUE_SIZE = 10000
+
+TEXT_FORMAT = '%(asctime)s (%(filename)s:%(lineno)d %(threadName)s) %(levelname)s - %(name)s: "%(message)s"'
+
+# Everything a LogRecord has before `extra` is applied
+RESERVED = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime", "sample_rate"}
+
+dropped = metrics.REGISTRY.counter(
+    "hamfurs_log_dropped_total", "Log records not written, by reason.", "reason"
+)
+
+listener = None
+
+
+def parse_pairs(text):
+    """
+    "a=1,b=2,3" -> {"a": "1", "b": "2", "": "3"}
+    """
+    pairs = {}
+    for item in (text or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, value = item.rpartition("=")
+        pairs[name.strip()] = value.strip()
+    return pairs
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        document = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+            "src": "{0}:{1}".format(record.filename, record.lineno),
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED:
+                document[key] = value
+        if getattr(record, "sample_rate", 1) < 1:
+            document["sample_rate"] = record.sample_rate
+        if record.exc_info:
+            document["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            document["exc"] = record.exc_text
+        if record.stack_info:
+            document["stack"] = record.stack_info
+        return json.dumps(document, default=str, ensure_ascii=False)
+
+
+class Sampler(logging.Filter):
+    """
+    Keeps a fraction of the records below WARNING from the loggers in
+    `rates` (and their children), marking the kept ones with
+    `sample_rate` so counts can be scaled back up.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.cache = {}
+
+    def rate(self, name):
+        rate = self.cache.get(name)
+        if rate is None:
+            rate = 1.0
+            parts = name.split(".")
+            for i in range(len(parts), 0, -1):
+                prefix = ".".join(parts[:i])
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+            self.cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        if rate >= 1:
+            return True
+        if random.random() < rate:
+            record.sample_rate = rate
+            return True
+        dropped.inc("sampled")
+        return False
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Never blocks: a full queue drops the record.  Unlike the stock
+    handler, formatting is left to the listener's thread.
+    """
+
+    def prepare(self, record):
+        # Resolve the message now, the arguments may change once we return
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped.inc("queue_full")
+
+
+class QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # At exit it's fine to wait for a full queue to drain
+        self.queue.put(self._sentinel)
+
+
+def setup(stream=None, environ=os.environ):
+    """
+    Routes all logging through the queue.  Safe to call more than once.
+    Returns the QueueListener.
+    """
+    global listener
+    if listener is not None:
+        return listener
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    if environ.get("HAMFURS_LOG_FORMAT", "json") == "text":
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+    else:
+        output.setFormatter(JSONFormatter())
+
+    records = queue.Queue(int(environ.get("HAMFURS_LOG_QUEUE", QUEUE_SIZE)))
+    handler = QueueHandler(records)
+    rates = parse_pairs(SAMPLE)
+    rates.update(parse_pairs(environ.get("HAMFURS_LOG_SAMPLE")))
+    rates = {name: float(rate) for name, rate in rates.items()}
+    handler.addFilter(Sampler(rates))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    # pyTelegramBotAPI writes to stderr itself; send it through the queue too
+    logging.getLogger("TeleBot").handlers = []
+    levels = parse_pairs(LEVELS)
+    levels.update(parse_pairs(environ.get("HAMFURS_LOG_LEVELS")))
+    for name, level in levels.items():
+        logging.getLogger(name or None).setLevel(level.upper())
+
+    listener = QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -2,65 +2,106 @@
 
 import os
 import re
+import atexit
 import time
 import datetime
 import math
 import random
 import requests
+import urllib.parse
 import json
 import schedule
 import telebot
 from io import BytesIO
+from concurrent.futures import Future
 from telebot import apihelper, types
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 import threading
 import logging
-from metaphone import doublemetaphone
-from PIL import Image, ImageDraw, ImageFont
+import functools
 
+import startup
 import reversebeacon
+import aprs
+import aliases
+import bulk
+import callbook
+import chats
+import cluster
+import geo
+import editstore
+import media
+import metrics
+import webhook
+import outbox
+import profiler
+import ratelimit
+import spots
 import hamqth
 import callsigns
+import logpipe
+
+# Only some commands need these; they are imported on first use
+synth = startup.lazy("synth")
+metaphone = startup.lazy("metaphone")
+Image = startup.lazy("PIL.Image")
+ImageDraw = startup.lazy("PIL.ImageDraw")
+ImageFont = startup.lazy("PIL.ImageFont")
+startup.clock.mark("imports")
 
 API_TOKEN = os.environ["TELEGRAM_API_TOKEN"]
 HAMFURS = os.environ["HAMFURS_CHAT_ID"]
-APRS_FI_KEY = os.environ["HAMFURS_APRS_FI_KEY"]
 HAMQTH_USER = os.environ["HAMFURS_HAMQTH_USER"]
 HAMQTH_PASS = os.environ["HAMFURS_HAMQTH_PASS"]
 
+# Leave HAMFURS_WEBHOOK_URL unset to fall back to long polling
+WEBHOOK_URL = os.environ.get("HAMFURS_WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("HAMFURS_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("HAMFURS_WEBHOOK_PORT", 8443))
+WEBHOOK_SECRET = os.environ.get("HAMFURS_WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.environ.get("HAMFURS_WEBHOOK_WORKERS", 4))
+# Telegram needs HTTPS; leave these unset when a proxy terminates TLS
+WEBHOOK_CERT = os.environ.get("HAMFURS_WEBHOOK_CERT")
+WEBHOOK_KEY = os.environ.get("HAMFURS_WEBHOOK_KEY")
+# /metrics is only served on its own port, never the public webhook one
+METRICS_PORT = os.environ.get("HAMFURS_METRICS_PORT")
+# Set HAMFURS_CLUSTER to run several replicas against one Mongo (see cluster.py)
+CLUSTER = bool(os.environ.get("HAMFURS_CLUSTER"))
+REPLICA_ID = os.environ.get("HAMFURS_REPLICA_ID")
+CLUSTER_WORKERS = int(os.environ.get("HAMFURS_CLUSTER_WORKERS", 4))
+# "mongo" shares command rate limits between processes (see ratelimit.py)
+RATELIMIT_BACKEND = os.environ.get("HAMFURS_RATELIMIT_BACKEND", "mongo" if CLUSTER else "memory")
+
 ENABLE_REVERSEBEACON = False
 
-logger = telebot.logger
-hamfurs_log = logging.getLogger("HamfursBot")
-formatter = logging.Formatter(
-    "%(asctime)s (%(filename)s:%(lineno)d %(threadName)s) "
-    '%(levelname)s - %(name)s: "%(message)s"'
-)
+# Leave HAMFURS_APRS_SERVER unset to run without the APRS-IS gateway
+APRS_SERVER = os.environ.get("HAMFURS_APRS_SERVER")
+APRS_CALLSIGN = os.environ.get("HAMFURS_APRS_CALLSIGN", "KF3RRY-5")
+# Appended to the gateway's own filter, e.g. "r/45.4/-75.7/100"
+APRS_FILTER = os.environ.get("HAMFURS_APRS_FILTER", "")
 
-# console_output_handler = logging.StreamHandler(sys.stderr)
-# console_output_handler.setFormatter(formatter)
-# logger.addHandler(console_output_handler)
-# hamfurs_log.addHandler(console_output_handler)
+# chat_member updates are only delivered when asked for explicitly
+ALLOWED_UPDATES = ["message", "edited_message", "chat_member"]
 
-logger.setLevel(logging.INFO)
-hamfurs_log.setLevel(logging.INFO)
+CALLOOK_URL = "https://callook.info/{0}/json"
+QSV_CLIPS = {"CW": "res/qsv.ogg", "RTTY": "res/rtty.ogg", "HELL": "res/hell.ogg"}
+CONDITIONS_URL = "http://www.hamqsl.com/solar101vhf.php"
+# hamqsl.com redraws the banner every few hours
+CONDITIONS_TTL = 600
+
+# Levels, sampling and format come from HAMFURS_LOG_* (see logpipe.py)
+logpipe.setup()
+logger = telebot.logger
+hamfurs_log = logging.getLogger("HamfursBot")
+# High-volume, sampled by default
+rbn_log = logging.getLogger("HamfursBot.rbn")
+file_id_log = logging.getLogger("HamfursBot.file_ids")
 
 definition_regex = re.compile(r"(.*?):(.*?)([^\\]\#\w.*)?$")
 
 # Pretty print a list
 oxford_string = lambda data: ", ".join(data[:-2] + [" and ".join(data[-2:])])
 
-NORWAY_CALL_PREFIXES = ["JW", "JX", "3Y"]
-NORWAY_CALL_PREFIXES += ["L" + a for a in list(map(chr, range(ord("A"), ord("N") + 1)))]
-
-
-class HamQTHStub(object):
-    def __init__(self, *args, **kwargs):
-        pass
-
-    def callbook(self, *args, **kwargs):
-        pass
-
 
 # Override to handle processing spotter stream
 class NotifyTelebot(telebot.TeleBot):
@@ -70,42 +111,142 @@ class NotifyTelebot(telebot.TeleBot):
         self.logger = logging.getLogger("Telebot")
         super().__init__(*args, **kwargs)
 
-        self.oneminute_spots = {}
-        self.muted = False
-        if ENABLE_REVERSEBEACON:
-            self.reload_callsigns()
-            self.reversebeacon = reversebeacon.ReverseBeaconClient("KF3RRY")
-            schedule.every(10).minutes.do(self.reload_callsigns)
-            schedule.every(1).minutes.do(self.one_minute_cron)
+        self.outbox = outbox.Outbox(self)
+        self.commands = None
+        self.spots = spots.SpotAggregator()
+        self.muted_until = 0
+        self.muted_checked = 0
+        self.aliases = aliases.AliasDirectory(self.db.aliases)
+        self.aliases.start()
+        self.reversebeacon = None
+        self.cluster = None
+
+    @property
+    def is_leader(self):
+        return self.cluster is None or self.cluster.is_leader
+
+    @property
+    def muted(self):
+        if self.cluster is not None and time.monotonic() - self.muted_checked > 5:
+            # /mute may have been handled by another replica
+            self.muted_checked = time.monotonic()
+            state = self.db.state.find_one({"_id": "spots"})
+            self.muted_until = (state or {}).get("muted_until", 0)
+        return time.time() < self.muted_until
 
     def mute_spots(self):
-        self.muted = True
+        self.set_muted(time.time() + 3600)
         self.logger.debug("Spotter notifications muted")
-        if ENABLE_REVERSEBEACON:
-            schedule.every(60).minutes.do(self.unmute_spots)
 
     def unmute_spots(self):
-        self.muted = False
+        self.set_muted(0)
         self.logger.debug("Spotter notifications unmuted")
-        if ENABLE_REVERSEBEACON:
-            return schedule.CancelJob
 
-    def reload_callsigns(self):
-        logger.debug("Refreshing callsign watch list")
-        rv = self.db.aliases.find({}, {"callsign": 1})
-        self.callsigns = [row["callsign"] for row in rv]
+    def set_muted(self, until):
+        self.muted_until = until
+        if self.cluster is not None:
+            self.db.state.replace_one(
+                {"_id": "spots"}, {"_id": "spots", "muted_until": until}, upsert=True
+            )
+
+    def cluster_mode(self, replica_id=None, workers=4, reply_callbacks=()):
+        """
+        Joins the cluster: updates are queued in Mongo and processed by
+        every replica, and only the leader takes in updates, follows the
+        RBN stream and runs scheduled jobs.  `reply_callbacks` are the
+        functions passed to register_for_reply(), which are kept in
+        Mongo so any replica can run them.
+        """
+        self.reply_backend = cluster.ReplyHandlers(self.db.reply_handlers, reply_callbacks)
+        self.cluster = cluster.Cluster(self.db, replica_id, workers)
+        self.cluster.on_demoted.append(self.close_rbn)
+        self.cluster.start(self.process_new_updates)
+
+    def close_rbn(self):
+        if self.reversebeacon is not None:
+            self.reversebeacon.close()
+            self.reversebeacon = None
 
-    def one_minute_cron(self):
-        logger.debug("Culling one minute spots")
-        for key in list(self.oneminute_spots.keys()):
-            if int(time.time()) - self.oneminute_spots[key]["time"] > 60:
-                logger.debug("{0} stale, culling".format(key))
-                del self.oneminute_spots[key]
+    def update_label(self, update):
+        """
+        Names an update for metrics: its command if it is one we handle,
+        otherwise its content type.
+        """
+        if self.commands is None:
+            self.commands = set()
+            for handler in self.message_handlers + self.edited_message_handlers:
+                self.commands.update(handler["filters"].get("commands") or [])
+        message = update.message or update.edited_message
+        if message is None:
+            return "other"
+        prefix = "edited_" if update.message is None else ""
+        if message.content_type == "text" and message.text.startswith("/"):
+            command = message.text.split()[0].split("@")[0][1:]
+            if command not in self.commands:
+                command = "unknown_command"
+            return prefix + command
+        return prefix + message.content_type
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            label = self.update_label(update)
+            with metrics.span(label, metrics.handler_seconds, metrics.handler_errors):
+                super().process_new_updates([update])
+            startup.clock.handled()
 
     def polling(self, none_stop=False, interval=0, timeout=10):
-        print("Call polling()")
+        logger.debug("Call polling()")
         self.__non_threaded_polling(none_stop, interval, timeout)
 
+    def webhook(self, url, listen="0.0.0.0", port=8443, secret=None, workers=4, cert=None, key=None):
+        """
+        Receive updates over a webhook instead of polling.  The HTTP server
+        runs in the background; this thread keeps ticking the RBN stream
+        and scheduled jobs like the polling loop does.
+        """
+        path = urllib.parse.urlparse(url).path or "/"
+        server = webhook.WebhookServer(
+            self,
+            listen=listen,
+            port=port,
+            path=path,
+            secret=secret,
+            workers=workers,
+            sink=self.cluster.push if self.cluster is not None else None,
+            cert=cert,
+            key=key,
+        )
+        threading.Thread(target=server.serve_forever, name="Webhook", daemon=True).start()
+
+        def register():
+            self.remove_webhook()
+            self.set_webhook(
+                url=url,
+                secret_token=secret,
+                # A new leader takes over whatever is still pending
+                drop_pending_updates=self.cluster is None,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+
+        if self.cluster is None:
+            register()
+        else:
+            # Every replica accepts webhook posts (e.g. behind a load
+            # balancer), only the leader points Telegram at the URL.  The
+            # election is already running, we may have won it
+            self.cluster.when_elected(register)
+        logger.info("Listening for webhook updates on {0}:{1}{2}".format(listen, port, path))
+
+        try:
+            while True:
+                self.process_rbn()
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info("KeyboardInterrupt received.")
+        finally:
+            server.shutdown()
+            self.close_rbn()
+
     def __retrieve_updates(self, timeout=20):
         """
         Retrieves any updates from the Telegram API.
@@ -116,9 +257,31 @@ class NotifyTelebot(telebot.TeleBot):
         if self.skip_pending:
             logger.debug("Skipped {0} pending messages".format(self.__skip_updates()))
             self.skip_pending = False
-        updates = self.get_updates(offset=(self.last_update_id + 1), timeout=timeout)
+        if self.cluster is not None:
+            self.__queue_updates(timeout)
+            return
+        updates = self.get_updates(
+            offset=(self.last_update_id + 1),
+            timeout=timeout,
+            allowed_updates=ALLOWED_UPDATES,
+        )
         self.process_new_updates(updates)
 
+    def __queue_updates(self, timeout):
+        """
+        Cluster mode: the leader polls and queues the raw updates for the
+        replicas' workers; everyone else just waits.
+        """
+        if not self.cluster.is_leader:
+            time.sleep(1)
+            return
+        updates = apihelper.get_updates(
+            self.token, self.last_update_id + 1, None, timeout, ALLOWED_UPDATES, timeout
+        )
+        if updates:
+            self.cluster.push(updates)
+            self.last_update_id = max(update["update_id"] for update in updates)
+
     def __non_threaded_polling(self, none_stop=False, interval=0, timeout=5):
         logger.info("Started polling.")
         self.__stop_polling = threading.Event()
@@ -132,12 +295,18 @@ class NotifyTelebot(telebot.TeleBot):
                 self.__retrieve_updates(timeout)
                 error_interval = 0.25
             except apihelper.ApiException as e:
+                retry_after = outbox.get_retry_after(e)
+                if retry_after is not None:
+                    logger.warning(
+                        "Flood control on getUpdates, retrying in {0}s".format(retry_after)
+                    )
+                    time.sleep(retry_after)
+                    continue
                 raise
                 logger.error(e)
                 if not none_stop:
                     self.__stop_polling.set()
-                    if ENABLE_REVERSEBEACON:
-                        self.reversebeacon.close()
+                    self.close_rbn()
                     logger.info("Exception occurred. Stopping.")
                 else:
                     raise
@@ -149,94 +318,169 @@ class NotifyTelebot(telebot.TeleBot):
             except KeyboardInterrupt:
                 logger.info("KeyboardInterrupt received.")
                 self.__stop_polling.set()
-                if ENABLE_REVERSEBEACON:
-                    self.reversebeacon.close()
+                self.close_rbn()
                 break
 
         logger.info("Stopped polling.")
 
     def process_rbn(self):
+        # Scheduled jobs and spots are the leader's alone, so they happen once
+        if not self.is_leader:
+            return
         schedule.run_pending()
         if not ENABLE_REVERSEBEACON:
             return
-        skimmer_line = "(via {skimmer}, {rate} {units} @ {snr} dB, {time})"
+        if self.reversebeacon is None:
+            self.reversebeacon = reversebeacon.ReverseBeaconClient("KF3RRY")
         chunk = self.reversebeacon.read_chunk()
         for line in chunk:
-            # Do something with the info
-            if line.callsign in self.callsigns:
+            if line.callsign in self.aliases:
                 if self.muted:
-                    logger.info(
-                        "Heard {0}, but notifications are muted".format(line.callsign)
+                    rbn_log.info(
+                        "Heard %s, but notifications are muted",
+                        line.callsign,
+                        extra={"callsign": line.callsign, "muted": True},
                     )
                     continue
 
-                logger.info("Heard {0} - process notification".format(line.callsign))
-                # Check if they were heard in the last minute:
-                if line.callsign in self.oneminute_spots.keys():
-                    # Increment the spot counter and update matching telegram message:
-                    self.oneminute_spots[line.callsign]["count"] += 1
-                    message = self.oneminute_spots[line.callsign]["message"]
-                    text = message.text + "\n" + skimmer_line.format(**line)
-                    message = bot.edit_message_text(
-                        chat_id=HAMFURS, message_id=message.message_id, text=text
-                    )
-                    if message:
-                        logger.warn(
-                            "Tried to edit message for {0}, but last message was unchanged".format(
-                                line.callsign
-                            )
-                        )
-                    else:
-                        self.oneminute_spots[line.callsign]["message"] = message
-                else:
-                    # Send message and add them to self.oneminute_spots
-                    text = (
-                        "Heard *{callsign}* calling {match} on {frequency} operating {mode}\n"
-                        + skimmer_line
-                    )
-                    logger.info(text.format(**line))
-                    message = self.send_message(
-                        HAMFURS, text=text.format(**line), parse_mode="Markdown"
-                    )
-                    self.oneminute_spots[line.callsign] = {
-                        "message": message,
-                        "count": 1,
-                        "time": int(time.time()),
-                    }
-
-            # logger.debug("Heard: {0}".format(line.callsign))
+                rbn_log.debug(
+                    "Heard %s - queue notification",
+                    line.callsign,
+                    extra={"callsign": line.callsign, "skimmer": line.skimmer, "snr": line.snr},
+                )
+                self.spots.add(line)
+
+        self.flush_spots()
+
+    def flush_spots(self):
+        # At most one send or edit per callsign per window, within the
+        # chat's rate limit.  Anything held back goes out on a later tick.
+        for window in self.spots.ready(HAMFURS):
+            if window.message is not None and not window.message.done():
+                # Alert still in the outbox; fold this update into the next window
+                window.dirty = True
+                continue
+            if window.message is not None and window.message.exception() is None:
+                self.outbox.edit_message_text(
+                    window.summary(),
+                    chat_id=HAMFURS,
+                    message_id=window.message.result().message_id,
+                    parse_mode="Markdown",
+                )
+            else:
+                rbn_log.info(window.summary(), extra={"callsign": window.callsign, "spots": window.count})
+                window.message = self.outbox.send_message(
+                    HAMFURS, text=window.summary(), parse_mode="Markdown"
+                )
 
 
 # bot = telebot.TeleBot(API_TOKEN)
 mongo_client = MongoClient(host=os.environ["HAMFURS_MONGO_HOST"])
 mongo_db = mongo_client.arrl
 bot = NotifyTelebot(API_TOKEN, threaded=False, db=mongo_client.hamfurs)
+# Replicas share what they have replied to, and settings are always read
+# from Mongo since another replica may have changed them
+edit_store = editstore.EditStore(mongo_client.hamfurs.bot_messages, shared=CLUSTER)
+atexit.register(edit_store.close)
+chat_cache = chats.ChatCache(mongo_client.hamfurs.chat, bot, settings_ttl=0 if CLUSTER else 600)
+# callook.info and HamQTH answers, the local callbooks are queried directly
+remote_records = callbook.RecordCache()
+assets = media.MediaRegistry(mongo_client.hamfurs.media, bot.outbox, API_TOKEN)
+hamqth_lock = threading.Lock()
+# Set while the background login holds hamqth_lock
+hamqth_logging_in = threading.Event()
+aprs_gateway = None
+if APRS_SERVER:
+    aprs_gateway = aprs.Gateway(
+        APRS_CALLSIGN,
+        bot.aliases.all_callsigns,
+        lambda message: relay_aprs(message),
+        server=APRS_SERVER,
+        extra_filter=APRS_FILTER,
+        leader=lambda: bot.is_leader,
+    )
+    aprs_gateway.start()
+locator = geo.Locator(
+    mongo_client, bot.aliases, aprs_gateway.positions if aprs_gateway else None
+)
+startup.clock.background("geo_indexes", locator.ensure_indexes)
+sampler = profiler.SamplingProfiler()
+memory = profiler.MemoryTracker()
+memory.watch("spot_windows", lambda: len(bot.spots))
+memory.watch("reply_handlers", lambda: sum(map(len, bot.reply_backend.handlers.values())))
+memory.watch("next_step_handlers", lambda: sum(map(len, bot.next_step_backend.handlers.values())))
+memory.watch("edit_store", lambda: len(edit_store))
+memory.watch("remote_records", lambda: len(remote_records))
+memory.watch("chat_settings", lambda: len(chat_cache.settings_cache.entries))
+memory.watch("chat_administrators", lambda: len(chat_cache.admin_cache.entries))
+memory.watch("media_file_ids", lambda: len(assets))
+memory.watch("aliases", lambda: len(bot.aliases))
+memory.watch("outbox", lambda: len(bot.outbox))
+if aprs_gateway is not None:
+    memory.watch("aprs_positions", lambda: len(aprs_gateway.positions))
+
+# Logs in from the background.  While that is in flight (and for a while
+# after it fails) HamQTH lookups raise hamqth.RequestError straight away
+# rather than waiting on the login's timeout
+hamqth_client = hamqth.HamQTH(HAMQTH_USER, HAMQTH_PASS, login=False)
+
+
+def hamqth_login():
+    hamqth_logging_in.set()
+    try:
+        with hamqth_lock:
+            hamqth_client.login()
+    finally:
+        hamqth_logging_in.clear()
+
+
+startup.clock.background("hamqth_login", hamqth_login)
+startup.clock.mark("clients")
 
-try:
-    hamqth_client = hamqth.HamQTH(HAMQTH_USER, HAMQTH_PASS)
-    # hamqth_client = HamQTHStub()
-except TimeoutError as e:
-    # We didn't need you anyways
-    logger.error(e)
-    logger.error("Unable to use HamQTH (is it down?) - those lookup calls will fail")
-    hamqth_client = HamQTHStub()
-    pass
 
-with open("res/flags.json") as f:
-    flag_json = json.load(f)
-FLAG_EMOJI = {row["name"]: row["emoji"] for row in flag_json}
+@functools.lru_cache(maxsize=None)
+def flag_emoji():
+    with open("res/flags.json") as f:
+        return {row["name"]: row["emoji"] for row in json.load(f)}
+
+
+@metrics.REGISTRY.collector
+def cron_metrics():
+    """
+    Exports the last run of each cron job, as recorded by cron/runstats.py
+    """
+    gauges = (
+        ("finished", "hamfurs_cron_last_run_timestamp", "When the job last finished."),
+        ("duration", "hamfurs_cron_last_duration_seconds", "How long the last run took."),
+        ("rows", "hamfurs_cron_last_rows", "Rows processed by the last run."),
+        ("success", "hamfurs_cron_last_success", "1 if the last run succeeded."),
+    )
+    runs = list(mongo_client.hamfurs.cron_runs.find({}))
+    for key, name, help in gauges:
+        yield "# HELP {0} {1}".format(name, help)
+        yield "# TYPE {0} gauge".format(name)
+        for run in runs:
+            yield '{0}{{job="{1}"}} {2}'.format(name, run["job"], float(run.get(key, 0)))
+
+    # Bumped by cron/importer.py each time an import is swapped in
+    name = "hamfurs_import_generation"
+    yield "# HELP {0} Generation of each imported collection.".format(name)
+    yield "# TYPE {0} gauge".format(name)
+    for generation in mongo_client.hamfurs.generations.find({}):
+        yield '{0}{{collection="{1}"}} {2}'.format(
+            name, generation["_id"], float(generation["generation"])
+        )
+
+
+metrics.REGISTRY.collector(bot.outbox.collect_metrics)
 
 
 def is_canadian(callsign):
-    if callsign.upper()[:2] in ("VE", "VA", "VO", "VY", "CY"):
-        return True
-    return False
+    return callbook.source_for(callsign) == callbook.IC
 
 
 def is_norwegian(callsign):
-    if callsign.upper()[:2] in NORWAY_CALL_PREFIXES:
-        return True
-    return False
+    return callbook.source_for(callsign) == callbook.NKOM
 
 
 def is_australian(callsign):
@@ -246,8 +490,7 @@ def is_australian(callsign):
 
 
 def get_pinned_message(chat_id):
-    chat = bot.get_chat(chat_id)
-    return chat.pinned_message
+    return chat_cache.pinned_message(chat_id)
 
 
 def get_message_url(message):
@@ -261,13 +504,14 @@ def get_message_url(message):
 # @bot.message_handler(content_types=['join_chat_member',])
 
 
+def register_callsign_interactive(message):
+    register_alias(message, message.text)
+
+
 @bot.message_handler(commands=["register"])
 def register_callsign(message):
     chat_id = message.chat.id
 
-    def register_callsign_interactive(message):
-        register_alias(message, message.text)
-
     if " " not in message.text:
         # interactive
         markup = types.ForceReply(selective=True)
@@ -286,10 +530,15 @@ def unregister_callsign(message):
     chat_id = message.chat.id
     db = mongo_client.hamfurs.aliases
     r = db.delete_one({"user_id": message.from_user.id})
+    bot.aliases.remove(message.from_user.id)
     if r.deleted_count > 0:
-        bot.send_message(chat_id=chat_id, text="Removed callsign alias for {0}".format(format_user(message.from_user)))
+        # Deletions don't show in max(updated); the API's ETags count them
+        mongo_client.hamfurs.state.update_one(
+            {"_id": "aliases"}, {"$inc": {"deletions": 1}}, upsert=True
+        )
+        bot.outbox.send_message(chat_id=chat_id, text="Removed callsign alias for {0}".format(format_user(message.from_user)))
     else:
-        bot.send_message(chat_id=chat_id, text="Callsign alias for {0} does not exist".format(format_user(message.from_user)))
+        bot.outbox.send_message(chat_id=chat_id, text="Callsign alias for {0} does not exist".format(format_user(message.from_user)))
 
 
 def register_alias(message, callsign):
@@ -320,15 +569,16 @@ def register_alias(message, callsign):
         r = db.replace_one(
             {"user_name": message.from_user.username}, document, upsert=True
         )
+    bot.aliases.put(document)
     if r.modified_count:
-        bot.send_message(
+        bot.outbox.send_message(
             chat_id=chat_id,
             text="Updated callsign alias for {0}".format(
                 format_user(message.from_user)
             ),
         )
     else:
-        bot.send_message(
+        bot.outbox.send_message(
             chat_id=chat_id,
             text="Created callsign alias for {0}".format(
                 format_user(message.from_user)
@@ -357,24 +607,36 @@ def escape_markdown(text):
 def is_administrator(message):
     if message.from_user.username == "rechner":
         return True
-    administrators = bot.get_chat_administrators(chat_id=message.chat.id)
-    administrator_ids = [row.user.id for row in administrators]
-    if message.from_user.id in administrator_ids:
+    if message.from_user.id in chat_cache.administrators(message.chat.id):
         return True
     return False
 
 
+def is_operator(message):
+    """
+    For process-wide diagnostics: the owner or an administrator of the
+    HAMFURS chat, whichever chat the command is sent in.
+    """
+    if message.from_user.username == "rechner":
+        return True
+    try:
+        return message.from_user.id in chat_cache.administrators(HAMFURS)
+    except apihelper.ApiException as e:
+        hamfurs_log.error("Unable to get the administrators of {0}: {1}".format(HAMFURS, e))
+        return False
+
+
 # @bot.message_handler(commands=['nuke',])
 def nuke_aliasdb(message):
     return
     hamfurs = mongo_client.hamfurs.aliases
     hamfurs.drop()
-    print("Dropped all records")
+    hamfurs_log.warning("Dropped all records")
 
 
 @bot.message_handler(commands=["freebeer", "beer"])
 def beer(message):
-    bot.send_message(chat_id=message.chat.id, text="\U0001f37a\U0001f37b\U0001f37a")
+    bot.outbox.send_message(chat_id=message.chat.id, text="\U0001f37a\U0001f37b\U0001f37a")
 
 
 @bot.message_handler(
@@ -383,7 +645,7 @@ def beer(message):
     ]
 )
 def dead_horse(message):
-    bot.send_document(message.chat.id, "BQADAQADUgADlek7ChDvVWLw6qmQAg")
+    bot.outbox.send_document(message.chat.id, "BQADAQADUgADlek7ChDvVWLw6qmQAg")
 
 
 @bot.message_handler(
@@ -392,7 +654,7 @@ def dead_horse(message):
     ]
 )
 def old_yote(message):
-    bot.send_sticker(message.chat.id, "CAADAQADWxoAAq8ZYgfnwh72WkV5nwI")
+    bot.outbox.send_sticker(message.chat.id, "CAADAQADWxoAAq8ZYgfnwh72WkV5nwI")
 
 
 @bot.message_handler(
@@ -401,7 +663,7 @@ def old_yote(message):
     ]
 )
 def silly_walk(message):
-    bot.send_document(message.chat.id, "BQADAQADZQEAAptvSAb_CoDNeA8cTAI")
+    bot.outbox.send_document(message.chat.id, "BQADAQADZQEAAptvSAb_CoDNeA8cTAI")
 
 
 @bot.message_handler(
@@ -410,7 +672,7 @@ def silly_walk(message):
     ]
 )
 def old_fox_yells_at_dmr(message):
-    bot.send_sticker(message.chat.id, "CAADAQAD7wEAAllaGgIYbpRM1Bw8TwI")
+    bot.outbox.send_sticker(message.chat.id, "CAADAQAD7wEAAllaGgIYbpRM1Bw8TwI")
 
 
 @bot.message_handler(
@@ -419,7 +681,7 @@ def old_fox_yells_at_dmr(message):
     ]
 )
 def awoo(message):
-    bot.send_sticker(message.chat.id, "CAADAQADdAEAAptvSAZR8ElrZgRavQI")
+    bot.outbox.send_sticker(message.chat.id, "CAADAQADdAEAAptvSAZR8ElrZgRavQI")
 
 
 @bot.message_handler(
@@ -437,16 +699,16 @@ def fcc(message):
     ]
     choice = random.choice(stickers)
     if choice == "PHOTO":
-        bot.send_photo(
+        bot.outbox.send_photo(
             message.chat.id, "AgADAQAD6K8xG5tvSAYabOrZ1Tw3J9WF5y8ABEuc83jwVjWY1DwAAgI"
         )
     else:
-        bot.send_sticker(message.chat.id, choice)
+        bot.outbox.send_sticker(message.chat.id, choice)
 
 
 @bot.message_handler(commands=["races", "ares", "skywarn"])
 def races(message):
-    bot.send_photo(
+    bot.outbox.send_photo(
         message.chat.id, "AgADAQADqacxG-f_kUQcHb3a_EhrTpyg5y8ABPaeF5Kdq-w1LaEAAgI"
     )
 
@@ -468,7 +730,7 @@ def whacker(message):
         "AgADAQADr6cxG6wquEVYe0_gM2__hqeA3i8ABEWnbvkhEkqx03gAAgI",
         "AgADAQADr6cxG6wquEVYe0_gM2__hqeA3i8ABEWnbvkhEkqx03gAAgI",
     ]
-    bot.send_photo(message.chat.id, random.choice(photos))
+    bot.outbox.send_photo(message.chat.id, random.choice(photos))
 
 
 @bot.message_handler(
@@ -481,7 +743,7 @@ def tane(message):
         "AgADAQADvqcxGy3eoUSlnk70w6-Gy_mT3i8ABAI-_zIdKdPYOcMAAgI",
         "AgADAQADr6cxG6wquEVYe0_gM2__hqeA3i8ABEWnbvkhEkqx03gAAgI",
     ]
-    bot.send_photo(message.chat.id, random.choice(photos))
+    bot.outbox.send_photo(message.chat.id, random.choice(photos))
 
 
 # @bot.message_handler(commands=['whereistane', 'whereintheworldistane', 'whereintheworldiscarmensandiego', 'lokitty'])
@@ -490,22 +752,66 @@ def locate_tane(message):
     tokens = message.text.split()
     if len(tokens) > 1 and tokens[1].isdigit():
         ssid = tokens[1]
+    send_position(message, "XXXXX-{0}".format(ssid))
 
-    try:
-        r = requests.get(
-            "https://api.aprs.fi/api/get?name=XXXXX-{1}&what=loc&apikey={0}&format=json".format(
-                APRS_FI_KEY, ssid
-            )
-        )
-        if "found" not in r.json() or r.json()["found"] == 0:
-            bot.send_message(message.chat.id, "Error while fetching APRS location")
+
+@bot.edited_message_handler(commands=["where"])
+@bot.message_handler(commands=["where"])
+def where(message):
+    tokens = message.text.split()
+    if len(tokens) != 2:
+        bot.outbox.reply_to(message, "Usage: /where <callsign or @handle>")
+        return
+    callsign = tokens[1]
+    if callsign.startswith("@"):
+        alias = bot.aliases.by_handle(callsign[1:])
+        if alias is None:
+            bot.outbox.reply_to(message, "{0} hasn't registered a callsign".format(callsign))
             return
-        location = r.json()["entries"][0]
-        bot.send_location(
-            message.chat.id, float(location["lat"]), float(location["lng"])
+        callsign = alias["callsign"]
+    send_position(message, callsign)
+
+
+def send_position(message, callsign):
+    """
+    Replies with the last APRS position heard from `callsign`, from the
+    gateway's cache.  Only stations with a registered alias are followed.
+    """
+    if aprs_gateway is None:
+        bot.outbox.reply_to(message, "The APRS gateway isn't running")
+        return
+    position = aprs_gateway.positions.get(callsign)
+    if position is None:
+        bot.outbox.reply_to(
+            message,
+            "Haven't heard {0} on APRS lately".format(callsign.upper()),
         )
-    except:
-        bot.send_message(message.chat.id, "Error while processing APRS location")
+        return
+    bot.outbox.reply_to(message, position.summary())
+    bot.outbox.send_location(message.chat.id, position.latitude, position.longitude)
+
+
+def relay_aprs(message):
+    """
+    Delivers an APRS message sent to us or to the HAMFURS group:
+    "@handle text" (or "@CALLSIGN text") goes privately to that user,
+    anything else to the group chat.
+    """
+    sender = message.source
+    alias = bot.aliases.by_callsign(aprs.base_callsign(sender))
+    if alias is not None and alias.get("user_name"):
+        sender += " (@{0})".format(alias["user_name"])
+
+    chat_id = HAMFURS
+    text = message.text
+    if text.startswith("@"):
+        target, _, text = text[1:].partition(" ")
+        alias = bot.aliases.by_handle(target) or bot.aliases.by_callsign(target)
+        if alias is None:
+            aprs_gateway.send_message(message.source, "No Telegram user @{0}".format(target))
+            return
+        chat_id = alias["user_id"]
+    bot.outbox.send_message(chat_id, "APRS message from {0}:\n{1}".format(sender, text))
 
 
 @bot.message_handler(
@@ -523,7 +829,7 @@ def standards(message):
     #    bot.send_photo(message.chat.id, "AgADAQADvacxG7Kc6USJW2G9OVs4dp6f3i8ABLPRlggDdF94vt8BAAEC")
     #    return
     hamfurs = mongo_client.hamfurs.chat
-    settings = hamfurs.find_one({"chat_id": chat_id})
+    settings = chat_cache.settings(chat_id)
     if settings is None:
         settings = {"chat_id": chat_id, "standards": 2}
         hamfurs.insert_one(settings)
@@ -541,69 +847,74 @@ def standards(message):
     draw.text((375, 148), str(standards + 1).rjust(2), font=font)
 
     im.save(std_buffer, "PNG")
-    std_buffer.seek(0)
 
-    bot.send_photo(chat_id=chat_id, photo=("standards.png", std_buffer))
+    assets.send_bytes("send_photo", chat_id, std_buffer.getvalue(), "standards.png")
 
     # standards++
     if standards > 99:
         standards = 1
     standards += 1
     hamfurs.update_one({"chat_id": chat_id}, {"$set": {"standards": standards}})
+    chat_cache.set_settings(chat_id, dict(settings, standards=standards))
+
+
+def greet(message, users):
+    chat_id = message.chat.id
+    if chat_id > 0:
+        chat_id = HAMFURS
+    settings = chat_cache.settings(chat_id)
+    if settings is None:
+        return
+    if not settings.get("greeter_enabled"):
+        return
+    greeter_text = settings["greeter_text"]
+    users_text = oxford_string(
+        [escape_markdown(format_user(user, True)) for user in users]
+    )
+    pinned_message = get_message_url(get_pinned_message(chat_id))
+    greeter_text_formatted = greeter_text.format(
+        user=users_text, pinned_message=pinned_message
+    )
+    bot.outbox.send_message(
+        message.chat.id,
+        text=greeter_text_formatted,
+        parse_mode="Markdown",
+        disable_web_page_preview=True,
+    )
+
+
+# Joins within a few seconds of each other share one greeting
+join_batcher = chats.JoinBatcher(greet)
 
 
 @bot.message_handler(func=lambda m: True, content_types=["new_chat_member"])
 def greet_user(message, new_chat_member=None):
-    # if message.chat.id == HAMFURS Or message.chat.id > 0:
-    if True:
-        new_member = new_chat_member or message.new_chat_member
-        chat_id = message.chat.id
-        if chat_id > 0:
-            chat_id = HAMFURS
-        hamfurs = mongo_client.hamfurs.chat
-        settings = hamfurs.find_one({"chat_id": chat_id})
-        if settings is None:
-            return
-        if not settings["greeter_enabled"]:
-            return
-        greeter_text = settings["greeter_text"]
-        pinned_message = get_message_url(get_pinned_message(chat_id))
-        users_text = escape_markdown(format_user(new_member, True))
-        greeter_text_formatted = greeter_text.format(
-            user=users_text, pinned_message=pinned_message
-        )
-        bot.send_message(
-            message.chat.id,
-            text=greeter_text_formatted,
-            parse_mode="Markdown",
-            disable_web_page_preview=True,
-        )
+    if new_chat_member is not None:
+        # /test_join_message: greet straight away
+        greet(message, [new_chat_member])
+        return
+    join_batcher.add(message, [message.new_chat_member])
 
 
 @bot.message_handler(func=lambda m: True, content_types=["new_chat_members"])
 def greet_users(message, new_chat_members=None):
     if message.chat.id == HAMFURS or message.chat.id > 0:
-        new_members = new_chat_members or message.new_chat_members
-        chat_id = message.chat.id
-        if chat_id > 0:
-            chat_id = HAMFURS
-        hamfurs = mongo_client.hamfurs.chat
-        settings = hamfurs.find_one({"chat_id": chat_id})
-        if settings is None:
-            return
-        if not settings["greeter_enabled"]:
-            return
-        greeter_text = settings["greeter_text"]
-        users_text = oxford_string(
-            [escape_markdown(format_user(user, True)) for user in new_members]
-        )
-        pinned_message = get_message_url(get_pinned_message(chat_id))
-        greeter_text_formatted = greeter_text.format(
-            user=users_text, pinned_message=pinned_message
-        )
-        bot.send_message(
-            message.chat.id, text=greeter_text_formatted, parse_mode="Markdown"
-        )
+        join_batcher.add(message, new_chat_members or message.new_chat_members)
+
+
+@bot.message_handler(func=lambda m: True, content_types=["pinned_message"])
+def pinned_message_changed(message):
+    chat_cache.set_pinned_message(message.chat.id, message.pinned_message)
+
+
+@bot.message_handler(func=lambda m: True, content_types=["left_chat_member"])
+def chat_member_left(message):
+    chat_cache.invalidate_administrators(message.chat.id)
+
+
+@bot.chat_member_handler()
+def chat_member_changed(update):
+    chat_cache.invalidate_administrators(update.chat.id)
 
 
 @bot.message_handler(
@@ -614,13 +925,13 @@ def greet_users(message, new_chat_members=None):
 def return_pinned_message(message):
     pinned_message = get_pinned_message(message.chat.id)
     if pinned_message is not None:
-        bot.send_message(
+        bot.outbox.send_message(
             message.chat.id,
             text="Click to see the pinned message",
             reply_to_message_id=pinned_message.message_id,
         )
     else:
-        bot.send_message(message.chat.id, text="No pinned message has been set")
+        bot.outbox.send_message(message.chat.id, text="No pinned message has been set")
 
 
 def unparse_markdown(message):
@@ -643,7 +954,7 @@ def set_join_message(message):
     if is_administrator(message):
         chat_id = message.chat.id
         hamfurs = mongo_client.hamfurs.chat
-        settings = hamfurs.find_one({"chat_id": chat_id})
+        settings = chat_cache.settings(chat_id)
         standards = 2
         if settings is not None:
             standards = settings["standards"]
@@ -660,7 +971,8 @@ def set_join_message(message):
         }
 
         hamfurs.replace_one({"chat_id": chat_id}, document, upsert=True)
-        bot.send_message(message.chat.id, "OK")
+        chat_cache.set_settings(chat_id, document)
+        bot.outbox.send_message(message.chat.id, "OK")
 
 
 @bot.message_handler(commands=["test_join_message"])
@@ -695,40 +1007,125 @@ def disable_join_message(message):
     #    bot.send_message(message.chat.id, "OK")
 
 
+def send_report(chat_id, text, filename, caption):
+    if bot.cluster is not None:
+        caption = "{0} on {1}".format(caption, bot.cluster.replica_id)
+    bot.outbox.send_document(
+        chat_id, (filename, BytesIO(text.encode("utf-8"))), caption=caption
+    )
+
+
+@bot.message_handler(commands=["profile"])
+def profile(message):
+    """
+    /profile [seconds] [svg]: samples every thread's stack and sends the
+    collapsed stacks, or a flame graph with "svg".
+    """
+    if not is_operator(message):
+        return
+    words = message.text.split()[1:]
+    seconds = 30
+    if words and words[0].isdigit():
+        seconds = min(int(words.pop(0)), profiler.MAX_SECONDS)
+    svg = "svg" in words
+    chat_id = message.chat.id
+
+    def run():
+        try:
+            stacks, samples = sampler.profile(seconds)
+        except profiler.ProfilerBusy as e:
+            bot.outbox.reply_to(message, str(e))
+            return
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        caption = "{0} samples over {1}s".format(samples, seconds)
+        if svg:
+            send_report(
+                chat_id, profiler.flamegraph(stacks, caption), "profile-{0}.svg".format(stamp), caption
+            )
+        else:
+            send_report(chat_id, profiler.collapsed(stacks), "profile-{0}.txt".format(stamp), caption)
+
+    bot.outbox.reply_to(message, "Profiling for {0}s".format(seconds))
+    # Off the polling thread, so the profile sees the bot at work
+    threading.Thread(target=run, name="Profiler", daemon=True).start()
+
+
+@bot.message_handler(commands=["memsnap"])
+def memory_snapshot(message):
+    """
+    Starts tracemalloc (if needed) and takes the baseline /memdiff compares with.
+    """
+    if not is_operator(message):
+        return
+    report = memory.snapshot()
+    send_report(message.chat.id, report, "memsnap.txt", "Baseline taken, /memdiff to compare")
+
+
+@bot.message_handler(commands=["memdiff"])
+def memory_diff(message):
+    if not is_operator(message):
+        return
+    report = memory.diff()
+    if report is None:
+        bot.outbox.reply_to(message, "No baseline, use /memsnap first")
+        return
+    send_report(message.chat.id, report, "memdiff.txt", "Growth since /memsnap")
+
+
+@bot.message_handler(commands=["startup"])
+def startup_report(message):
+    if not is_administrator(message):
+        return
+    bot.outbox.reply_to(message, startup.clock.report())
+
+
+@bot.message_handler(commands=["memstop"])
+def memory_stop(message):
+    if not is_operator(message):
+        return
+    memory.stop()
+    bot.outbox.reply_to(message, "Stopped tracing allocations")
+
+
 @bot.message_handler(func=lambda m: True, content_types=["document"])
 def debug_document(message):
-    print("Got document file ID: {0}".format(message.document.file_id))
+    file_id_log.info("Got document file ID: %s", message.document.file_id, extra={"kind": "document", "file_id": message.document.file_id})
 
 
 @bot.message_handler(func=lambda m: True, content_types=["video"])
 def debug_video(message):
-    print("Got video file ID: {0}".format(message.video.file_id))
+    file_id_log.info("Got video file ID: %s", message.video.file_id, extra={"kind": "video", "file_id": message.video.file_id})
 
 
 @bot.message_handler(func=lambda m: True, content_types=["photo"])
 def debug_photo(message):
-    print("Got photo file ID: {0}".format(message.photo[0].file_id))
+    file_id_log.info("Got photo file ID: %s", message.photo[0].file_id, extra={"kind": "photo", "file_id": message.photo[0].file_id})
 
 
 @bot.message_handler(func=lambda m: True, content_types=["audio"])
 def debug_audio(message):
-    print("Got audio file ID: {0}".format(message.audio.file_id))
+    file_id_log.info("Got audio file ID: %s", message.audio.file_id, extra={"kind": "audio", "file_id": message.audio.file_id})
 
 
 @bot.message_handler(func=lambda m: True, content_types=["voice"])
 def debug_voice(message):
-    print("Got voice file ID: {0}".format(message.voice.file_id))
+    file_id_log.info("Got voice file ID: %s", message.voice.file_id, extra={"kind": "voice", "file_id": message.voice.file_id})
 
 
 @bot.message_handler(func=lambda m: True, content_types=["sticker"])
 def debug_sticker(message):
-    print(
-        "{1} Got sticker file ID: {0}".format(
-            message.sticker.file_id, message.message_id
-        )
+    file_id_log.info(
+        "%s Got sticker file ID: %s",
+        message.message_id,
+        message.sticker.file_id,
+        extra={"kind": "sticker", "file_id": message.sticker.file_id},
     )
 
 
+def lookup_definition_interactive(message):
+    process_definition(message, message.text)
+
+
 @bot.edited_message_handler(
     commands=[
         "define",
@@ -742,9 +1139,6 @@ def debug_sticker(message):
 def lookup_definition(message):
     chat_id = message.chat.id
 
-    def lookup_definition_interactive(message):
-        process_definition(message, message.text)
-
     if " " not in message.text:
         markup = types.ForceReply(selective=True)
         try:
@@ -771,7 +1165,7 @@ def process_definition(message, term):
 
     # Search by metaphone
     if definition is None:
-        definition = term_db.find_one({"metaphone": doublemetaphone(term)})
+        definition = term_db.find_one({"metaphone": metaphone.doublemetaphone(term)})
 
     if definition is None:
         send_editable_message(
@@ -804,7 +1198,7 @@ def add_definition(message):
     match = definition_regex.match(entry)
 
     if match is None:
-        bot.send_message(
+        bot.outbox.send_message(
             chat_id,
             "Definition format is as follows:\n`Term: Definition #optional #keywords #here`\nUse \\n for a literal newline in definition field.",
             parse_mode="Markdown",
@@ -822,7 +1216,7 @@ def add_definition(message):
     definition = definition.replace("\\n", "\n")
 
     if term == "" or definition == "":
-        bot.send_message(
+        bot.outbox.send_message(
             chat_id,
             "Incorrect format. Definition format is as follows:\n`Term: Definition #optional #keywords #here`",
             parse_mode="Markdown",
@@ -838,7 +1232,7 @@ def add_definition(message):
         "index": term.lower(),
         "keywords": keywords,
         "definition": definition,
-        "metaphone": doublemetaphone(term),
+        "metaphone": metaphone.doublemetaphone(term),
         "contributor": escape_markdown(format_user(message.from_user)),
         "last_edit": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
@@ -846,14 +1240,14 @@ def add_definition(message):
     txt = "*{term}*: {definition}\n(Contributed by {contributor} _{last_edit}_)".format(
         **doc
     )
-    print(txt)
+    hamfurs_log.info("New definition of %s", term, extra={"term": term, "chat_id": chat_id})
     try:
         msg = bot.send_message(
             chat_id, txt, parse_mode="Markdown", disable_web_page_preview=True
         )
     except Exception as e:
-        print(e)
-        bot.send_message(
+        hamfurs_log.warning("Definition of %s rejected: %s", term, e)
+        bot.outbox.send_message(
             chat_id,
             "Error in definition format (check your Markdown! These literals must be escaped: ][*_`)",
         )
@@ -862,31 +1256,29 @@ def add_definition(message):
     term_db = mongo_client.hamfurs.definitions
     rv = term_db.replace_one({"index": term.lower()}, doc, upsert=True)
 
-    bot.send_message(chat_id, "Added definition successfully")
+    bot.outbox.send_message(chat_id, "Added definition successfully")
 
 
-@bot.edited_message_handler(func=lambda m: hasattr(m, "reply_to_message"))
+# Edited commands have their own handlers, registered after this one
+@bot.edited_message_handler(func=lambda m: not (m.text or "").startswith("/"))
 def callbook_lookup_edited_interactive(message):
     # Test if message is from our bot and has a corresponding reply message to edit:
-    bot_messages = mongo_client.hamfurs.bot_messages
-    old_message = bot_messages.find_one(
-        {"chat_id": message.chat.id, "user_message_id": message.message_id}
-    )
-    if old_message is not None:
+    if edit_store.get(message.chat.id, message.message_id, message.date) is not None:
         try:
             process_lookup(message, message.text)
         except Exception as e:
             hamfurs_log.error("Error while making telegram request: {0}".format(e))
 
 
+def callbook_lookup_interactive(message):
+    process_lookup(message, message.text)
+
+
 @bot.edited_message_handler(commands=["callsign", "lookup"])
 @bot.message_handler(commands=["callsign", "lookup"])
 def callbook_lookup(message):
     chat_id = message.chat.id
 
-    def callbook_lookup_interactive(message):
-        process_lookup(message, message.text)
-
     if " " not in message.text:
         markup = types.ForceReply(selective=True)
         try:
@@ -905,26 +1297,27 @@ def callbook_lookup(message):
 
 def process_lookup(message, callsign):
     chat_id = message.chat.id
-    print("Lookup: {0}".format(callsign))
+    hamfurs_log.info("Lookup: %s", callsign, extra={"callsign": callsign, "chat_id": chat_id})
 
     # import pdb; pdb.set_trace()
 
     if callsign.lower() == "ka6bim":
         return
+    if rate_limited(message, "lookup", is_cached(callsign)):
+        return
 
     try:
-        bot.send_chat_action(chat_id, "typing")
+        with metrics.span("telegram_chat_action"):
+            bot.send_chat_action(chat_id, "typing")
     except telebot.apihelper.ApiException as e:
         hamfurs_log.error("Error while making telegram API request: {0}".format(e))
         hamfurs_log.error("Stopping lookup")
         return
 
-    hamfurs = mongo_client.hamfurs.aliases
-
     alias = None
     if callsign[0] == "@":
         # lookup by telegram handle
-        alias = hamfurs.find_one({"user_name_lower": callsign[1:].lower()})
+        alias = bot.aliases.by_handle(callsign[1:])
         if alias is None:
             send_editable_message(
                 message, text="No associated callsign found for given telegram handle"
@@ -935,7 +1328,7 @@ def process_lookup(message, callsign):
         ]  # Follow down the rest of the code with this callsign
     else:
         # see if callsign has an assigned alias
-        alias = hamfurs.find_one({"callsign": callsign.upper()})
+        alias = bot.aliases.by_callsign(callsign)
 
     if alias is None:
         alias_text = None
@@ -956,119 +1349,51 @@ def process_lookup(message, callsign):
     if is_canadian(callsign):
         icdb = mongo_client.ic
         collection = icdb.callbook
-        result = collection.find_one({"callsign": callsign.upper()})
+        with metrics.span("mongo_ic"):
+            result = collection.find_one({"callsign": callsign.upper()})
         if result is None:
             send_editable_message(message, text="Callsign not found in IC database")
             return
         else:
-            result["alias"] = alias_text
-            if result["club"] is None:
-                qualifications = []
-                if result["qualifications"]["basic"]:
-                    qualifications.append("Basic")
-                if result["qualifications"]["5wpm"]:
-                    qualifications.append("5WPM")
-                if result["qualifications"]["12wpm"]:
-                    qualifications.append("12WPM")
-                if result["qualifications"]["advanced"]:
-                    qualifications.append("Advanced")
-                if result["qualifications"]["basic_honours"]:
-                    qualifications.append("Basic Honours")
-                result["class"] = ", ".join(qualifications)
-
-                txt = u"""\U0001f1e8\U0001f1e6 *{callsign}* - (Person) {class}
-*Name:* {name} {surname}
-*Alias:* {alias}
-*Location:* {city}, {province} {postcode}""".format(
-                    **result
-                )
-            else:
-                txt = u"""\U0001f1e8\U0001f1e6 *{callsign}* - (Club)
-*Name*: {club[name]} {club[name2]}
-*Trustee*: {name} {surname}
-*Club location*: {club[city]}, {club[province]} {club[postcode]}""".format(
-                    **result
-                )
-
-            if dmr_id is not None:
-                txt += "\n*DMR ID*: {0}".format(dmr_id)
+            txt = callbook.from_ic(result).render(alias=alias_text, dmr_id=dmr_id)
             send_editable_message(message, text=txt, parse_mode="Markdown")
             return
 
     if is_norwegian(callsign):
         nkomdb = mongo_client.nkom
         collection = nkomdb.callbook
-        result = collection.find_one({"callsign": callsign.upper()})
+        with metrics.span("mongo_nkom"):
+            result = collection.find_one({"callsign": callsign.upper()})
         if result is None:
             send_editable_message(message, text="Callsign not found in Nkom database")
             return
         else:
-            result["alias"] = alias_text
-            if alias is None:
-                txt = u"""\U0001f1f3\U0001f1f4 *{callsign}* - ({type})
-*Name:* {name} {surname}{club}
-*Updated:* {updated}
-*Location:* {city}, {country} {postcode}""".format(
-                    **result
-                )
-            else:
-                txt = u"""\U0001f1f3\U0001f1f4 *{callsign}* - ({type})
-*Name:* {name} {surname}{club}
-*Alias:* {alias}
-*Updated:* {updated}
-*Location:* {city}, {country} {postcode}""".format(
-                    **result
-                )
-
-            if dmr_id is not None:
-                txt += "\n*DMR ID*: {0}".format(dmr_id)
+            txt = callbook.from_nkom(result).render(alias=alias_text, dmr_id=dmr_id)
             send_editable_message(message, text=txt, parse_mode="Markdown")
             return
 
     # TODO: error handling
-    req = requests.get("https://callook.info/{0}/json".format(callsign))
-    if req.status_code != requests.codes.ok:
+    try:
+        status, record = callook_lookup(callsign)
+    except ValueError:
+        return
+    if status is None:
         send_editable_message(message, text="Please specify a valid callsign")
         return
-    try:
-        result = req.json()
-    except:
-        return 
-
-    collection = mongo_db.ve_session_counts
-    ve_info = collection.find_one({"callsign": callsign.upper()})
 
     # check status key
-    if result["status"] != "VALID":
+    if record is None:
         # Try Ham-QTH:
         data = None
         try:
-            data = hamqth_client.callbook(callsign)
+            data = hamqth_lookup(callsign)
             if data is None:
-                text = "Error in HamQTH lookup ({0})\n".format(result["status"])
+                text = "Error in HamQTH lookup ({0})\n".format(status)
                 text += "(We looked everywhere, but that callsign probably isn't in any database we know about)\n"
                 text += "[Submit Profile](https://hamqth.com/{0})".format(callsign)
             else:
-                data["callsign"] = data["callsign"].upper()
-                data["alias"] = alias_text
-                data["grid"] = data.get("grid", "?")
                 hamfurs_log.debug(data)
-                try:
-                    data["flag"] = FLAG_EMOJI[data["country"]]
-                except KeyError:
-                    data["flag"] = ""
-                if "adr_name" not in data:
-                    data["adr_name"] = "[None]"
-                txt = u"""{flag} *{callsign}* (UTC{utc_offset})
-*Name:* {adr_name} ({nick})
-*Alias:* {alias}
-*Location:* {adr_city}, {adr_country} {adr_zip} ({grid})
-[HamQTH Profile](https://www.hamqth.com/{callsign})
-""".format(
-                    **data
-                )
-                if dmr_id is not None:
-                    txt += "\n*DMR ID*: {0}".format(dmr_id)
+                txt = data.render(alias=alias_text, dmr_id=dmr_id)
                 send_editable_message(
                     message,
                     text=txt,
@@ -1086,7 +1411,7 @@ def process_lookup(message, callsign):
         if alias is None and data is None:
             country = callsigns.get_country(callsign)
             try:
-                flag = FLAG_EMOJI[callsigns.COUNTRY_NAMES[country]]
+                flag = flag_emoji()[callsigns.COUNTRY_NAMES[country]]
             except:
                 flag = ""
             text = "{2} *{1}*\n*Alias:* {0}\n(That's all we know - [Update Profile](https://hamqth.com/{1}))".format(
@@ -1097,96 +1422,302 @@ def process_lookup(message, callsign):
         )
         return
 
-    result["type"] = result["type"].title()
+    collection = mongo_db.ve_session_counts
+    with metrics.span("mongo_ve"):
+        ve_info = collection.find_one({"callsign": callsign.upper()})
 
     if ve_info is not None:
-        result["ve"] = "VE (Session count: {count})".format(**ve_info)
+        ve = "VE (Session count: {count})".format(**ve_info)
     else:
-        result["ve"] = ""
-
-    result["alias"] = alias_text
-
-    result["dmr_txt"] = ""
-    if dmr_id is not None:
-        result["dmr_txt"] = "\n*DMR ID*: {0}".format(dmr_id)
-
-    txt = u"""\U0001f1fa\U0001f1f8 *{current[callsign]}* - ({type}) {current[operClass]} {ve}
-*Name:* {name}
-*Alias:* {alias}{dmr_txt}
-*Location:* {address[line2]} ({location[gridsquare]})
-*Granted:* {otherInfo[grantDate]}
-*Expiry:* {otherInfo[expiryDate]}
-[ULS license page]({otherInfo[ulsUrl]})
-""".format(
-        **result
+        ve = ""
+
+    trustee_alias = None
+    if record.kind == "Club" and record.trustee:
+        trustee_alias = bot.aliases.by_callsign(record.trustee)
+
+    txt = record.render(
+        alias=alias_text, dmr_id=dmr_id, ve=ve, trustee_alias=trustee_alias
     )
+    send_editable_message(message, text=txt, parse_mode="Markdown")
 
-    if result["type"] == "Club":
-        result['trustee_alias'] = hamfurs.find_one({"callsign": result['trustee']['callsign']})
-        if result['trustee_alias']:
-            txt += u"*Trustee:* {trustee[callsign]}, @{trustee_alias[user_name]}".format(**result)
-        else:
-            txt += u"*Trustee:* {trustee[callsign]}, {trustee[name]}".format(**result)
 
+def callook_lookup(callsign):
+    """
+    Returns (status, record) for `callsign` from callook.info, where
+    status is None if the request failed and record is None unless the
+    status is VALID.  Raises ValueError on a malformed response.
+    """
+    key = (callbook.CALLOOK, callsign.upper())
+    try:
+        record = remote_records.get(key)
+        return ("INVALID" if record is None else "VALID"), record
+    except KeyError:
+        pass
+    with metrics.span("callook"):
+        status, record = callbook.fetch_callook(CALLOOK_URL, callsign)
+    # Anything else (UPDATING) is transient and worth asking again
+    if status in ("VALID", "INVALID"):
+        remote_records.put(key, record)
+        locator.record(record)
+    return status, record
+
+
+def hamqth_lookup(callsign):
+    """
+    Returns the HamQTH record for `callsign`, or None.
+    """
+    key = (callbook.HAMQTH, callsign.upper())
+    try:
+        record = remote_records.get(key)
+        if record is not None:
+            return record
+    except KeyError:
+        pass
+    if hamqth_logging_in.is_set():
+        raise hamqth.RequestError("Still logging in to HamQTH")
+    # The client's session and retry state aren't thread safe
+    with hamqth_lock, metrics.span("hamqth"):
+        data = hamqth_client.callbook(callsign)
+    if data is None:
+        return None
+    record = callbook.from_hamqth(data, flag_emoji())
+    remote_records.put(key, record)
+    locator.record(record)
+    return record
+
+
+def remote_lookup(callsign):
+    """
+    Returns a record for `callsign` from callook.info, falling back to
+    HamQTH, or None.
+    """
+    status, record = callook_lookup(callsign)
+    if record is None:
+        record = hamqth_lookup(callsign)
+    return record
+
+
+bulk_lookup = bulk.BulkLookup(mongo_client, remote_lookup)
+
+if RATELIMIT_BACKEND == "mongo":
+    limiter = ratelimit.RateLimiter(ratelimit.MongoBackend(mongo_client.hamfurs.ratelimits))
+else:
+    limiter = ratelimit.RateLimiter()
+conditions_cache = chats.TTLCache(CONDITIONS_TTL)
+
+
+def rate_limited(message, command, cached):
+    """
+    Spends from the sender's and chat's budget for `command`.  Returns
+    True, after replying once per wait, if either is used up.
+    """
+    delay = limiter.check(message.from_user.id, message.chat.id, command, cached)
+    if not delay:
+        return False
+    if limiter.should_notify(message.from_user.id, command, delay):
+        bot.outbox.reply_to(
+            message, "Slow down! Try that again in {0}s.".format(int(math.ceil(delay)))
+        )
+    return True
+
+
+def is_cached(callsign):
+    """
+    True if looking up `callsign` needs no upstream call: it belongs in
+    a local callbook, or callook.info's (and if needed HamQTH's) answer
+    is cached.
+    """
+    if callsign.startswith("@"):
+        alias = bot.aliases.by_handle(callsign[1:])
+        if alias is None:
+            return True
+        callsign = alias["callsign"]
+    callsign = callsign.upper()
+    if callbook.source_for(callsign) != callbook.CALLOOK:
+        return True
+    try:
+        if remote_records.get((callbook.CALLOOK, callsign)) is not None:
+            return True
+    except KeyError:
+        return False
+    return (callbook.HAMQTH, callsign) in remote_records
+
+
+@bot.edited_message_handler(commands=["lookup_many"])
+@bot.message_handler(commands=["lookup_many"])
+def lookup_many(message):
+    words = message.text.split(None, 1)
+    callsigns, invalid = bulk.parse_callsigns(words[1] if len(words) > 1 else "")
+    if not callsigns:
+        send_editable_message(
+            message, text="Usage: /lookup_many <callsign> <callsign> ..."
+        )
+        return
+    if len(callsigns) > bulk.MAX_CALLSIGNS:
+        send_editable_message(
+            message,
+            text="Please look up at most {0} callsigns at a time".format(
+                bulk.MAX_CALLSIGNS
+            ),
+        )
+        return
+
+    if rate_limited(message, "bulk", all(is_cached(c) for c in callsigns)):
+        return
+
+    try:
+        with metrics.span("telegram_chat_action"):
+            bot.send_chat_action(message.chat.id, "typing")
+    except telebot.apihelper.ApiException as e:
+        hamfurs_log.error("Error while making telegram API request: {0}".format(e))
+
+    results = bulk_lookup.lookup(callsigns)
+    txt = "```\n{0}\n```".format(bulk.table(results))
+    if invalid:
+        txt += "\nIgnored: {0}".format(escape_markdown(", ".join(invalid)))
+    send_editable_message(message, text=txt, parse_mode="Markdown")
+
+
+@bot.edited_message_handler(commands=["distance"])
+@bot.message_handler(commands=["distance"])
+def distance_between(message):
+    tokens = message.text.split()
+    if len(tokens) != 3:
+        bot.outbox.reply_to(message, "Usage: /distance <grid or callsign> <grid or callsign>")
+        return
+    try:
+        lat1, lon1, start = locator.resolve(tokens[1])
+        lat2, lon2, end = locator.resolve(tokens[2])
+    except ValueError as e:
+        bot.outbox.reply_to(message, str(e))
+        return
+    km = float(geo.distance(lat1, lon1, lat2, lon2))
+    heading = float(geo.bearing(lat1, lon1, lat2, lon2))
+    bot.outbox.reply_to(
+        message,
+        "{0} to {1}: {2:,.0f} km ({3:,.0f} mi), bearing {4:.0f}°".format(
+            start, end, km, km * geo.KM_TO_MILES, heading
+        ),
+    )
+
+
+@bot.edited_message_handler(commands=["nearby"])
+@bot.message_handler(commands=["nearby"])
+def nearby(message):
+    tokens = message.text.split()
+    if len(tokens) != 3:
+        send_editable_message(message, text="Usage: /nearby <grid or callsign> <km>")
+        return
+    try:
+        km = float(tokens[2])
+        if not 0 < km <= geo.MAX_RADIUS:
+            raise ValueError("Please pick a distance up to {0} km".format(geo.MAX_RADIUS))
+        latitude, longitude, label = locator.resolve(tokens[1])
+    except ValueError as e:
+        send_editable_message(message, text=str(e))
+        return
+
+    with metrics.span("mongo_nearby"):
+        results = locator.nearby(latitude, longitude, km)
+    if not results:
+        send_editable_message(message, text="No stations within {0:g} km of {1}".format(km, label))
+        return
+    rows = []
+    for km_away, callsign, grid, source in results:
+        alias = bot.aliases.by_callsign(callsign)
+        handle = "@{0}".format(alias["user_name"]) if alias and alias.get("user_name") else ""
+        rows.append("{0:<10} {1:>7.1f} km  {2:<6} {3}".format(callsign, km_away, grid, handle).rstrip())
+    txt = "Within {0:g} km of {1}:\n```\n{2}\n```".format(km, escape_markdown(label), "\n".join(rows))
     send_editable_message(message, text=txt, parse_mode="Markdown")
 
 
+@bot.message_handler(commands=["setgrid"])
+def set_grid(message):
+    tokens = message.text.split()
+    if len(tokens) != 2 or not geo.is_grid(tokens[1]):
+        bot.outbox.reply_to(message, "Usage: /setgrid <Maidenhead locator>, e.g. /setgrid FN25dk")
+        return
+    latitude, longitude = geo.grid_to_latlon(tokens[1])
+    document = mongo_client.hamfurs.aliases.find_one_and_update(
+        {"user_id": message.from_user.id},
+        {
+            "$set": {
+                "location": geo.point(latitude, longitude),
+                "grid": tokens[1],
+                "updated": int(time.time()),
+            }
+        },
+        return_document=ReturnDocument.AFTER,
+    )
+    if document is None:
+        bot.outbox.reply_to(message, "Please /register your callsign first")
+        return
+    bot.aliases.put(document)
+    bot.outbox.reply_to(
+        message, "{0} is now in {1} for /nearby".format(document["callsign"], tokens[1])
+    )
+
+
 def get_dmr_id(callsign):
     callsign = callsign.upper()
     db = mongo_client.dmr_marc.users
-    r = db.find_one({"callsign": callsign})
+    with metrics.span("mongo_dmr"):
+        r = db.find_one({"callsign": callsign})
     if r is None:
         return None
     return r["radio_id"]
 
 
+@metrics.timed("send_editable_message")
 def send_editable_message(
     message, text, parse_mode=None, reply_markup=None, disable_web_page_preview=None
 ):
     if message is None:
-        hamfurs_log("send_editable_message : `message` parameter cannot be None")
+        hamfurs_log.error("send_editable_message : `message` parameter cannot be None")
         return
     chat_id = message.chat.id
-    bot_messages = mongo_client.hamfurs.bot_messages
-    old_message = bot_messages.find_one(
-        {"chat_id": chat_id, "user_message_id": message.message_id}
-    )
-    new_message = None
-    if old_message is not None:
-        # Edit the old corresponding message
-        try:
-            new_message = bot.edit_message_text(
+    bot_message_id = edit_store.get(chat_id, message.message_id, message.date)
+    if isinstance(bot_message_id, Future):
+        # Our first reply is still in the outbox; edit it once it's sent
+        def edit_when_sent(future):
+            if future.exception() is not None:
+                # Nothing to edit (edit_store has dropped it), send anew
+                send_editable_message(message, text, disable_web_page_preview=disable_web_page_preview)
+                return
+            bot.outbox.edit_message_text(
                 text,
                 parse_mode="Markdown",
                 chat_id=chat_id,
-                message_id=old_message["bot_message_id"],
-                disable_web_page_preview=disable_web_page_preview,
-            )
-        except telebot.apihelper.ApiException as e:
-            hamfurs_log.error(e)
-            return
-    else:
-        # Send a new message and store away the ID to edit later if needed
-        try:
-            new_message = bot.send_message(
-                chat_id,
-                text=text,
-                parse_mode="Markdown",
+                message_id=future.result().message_id,
                 disable_web_page_preview=disable_web_page_preview,
             )
-        except telebot.apihelper.ApiException as e:
-            hamfurs_log.error(e)
-            return
-    document = {
-        "chat_id": chat_id,
-        "user_message_id": message.message_id,
-        "bot_message_id": new_message.message_id,
-    }
-    bot_messages.replace_one(
-        {"chat_id": chat_id, "user_message_id": message.message_id},
-        document,
-        upsert=True,
+
+        bot_message_id.add_done_callback(edit_when_sent)
+        return
+    if bot_message_id is not None:
+        # Edit the old corresponding message
+        bot.outbox.edit_message_text(
+            text,
+            parse_mode="Markdown",
+            chat_id=chat_id,
+            message_id=bot_message_id,
+            disable_web_page_preview=disable_web_page_preview,
+        )
+        return
+
+    def log_failure(future):
+        if future.exception() is not None:
+            hamfurs_log.error(future.exception())
+
+    # Send a new message and store away the ID to edit later if needed
+    new_message = bot.outbox.send_message(
+        chat_id,
+        text=text,
+        parse_mode="Markdown",
+        disable_web_page_preview=disable_web_page_preview,
     )
+    edit_store.expect(chat_id, message.message_id, new_message, message.date)
+    new_message.add_done_callback(log_failure)
 
 
 def ve_lookup(callsign):
@@ -1198,17 +1729,25 @@ def ve_lookup(callsign):
 @bot.message_handler(commands=['conditions', 'band_conditions'])
 def band_conditions(message):
     chat_id = message.chat.id
-    bot.send_chat_action(chat_id, "upload_photo")
+    banner = conditions_cache.get(CONDITIONS_URL)
+    if rate_limited(message, "conditions", banner is not chats.MISSING):
+        return
+    try:
+        with metrics.span("telegram_chat_action"):
+            bot.send_chat_action(chat_id, "upload_photo")
+    except telebot.apihelper.ApiException as e:
+        hamfurs_log.error("Error while making telegram API request: {0}".format(e))
 
-    req = requests.get("http://www.hamqsl.com/solar101vhf.php")
-    if req.status_code == requests.codes.ok:
-        photo = BytesIO(req.content)
-        try:
-            bot.send_photo(chat_id=chat_id, photo=("conditions.gif", photo))
-        except error as e:
-            logging.error(e)
-    else:
-        bot.send_message(chat_id=chat_id, text="Error while fetching band conditions")
+    if banner is chats.MISSING:
+        with metrics.span("hamqsl"):
+            req = requests.get(CONDITIONS_URL)
+        if req.status_code != requests.codes.ok:
+            bot.outbox.send_message(chat_id=chat_id, text="Error while fetching band conditions")
+            return
+        banner = req.content
+        conditions_cache.set(CONDITIONS_URL, banner)
+    # Only re-uploaded when hamqsl.com has drawn a new one
+    assets.send_bytes("send_photo", chat_id, banner, "conditions.gif")
 
 
 @bot.message_handler(
@@ -1219,7 +1758,7 @@ def band_conditions(message):
 def mute_spots(message):
     chat_id = message.chat.id
     bot.mute_spots()
-    bot.send_message(chat_id, "Spotter notifications muted for the next hour.")
+    bot.outbox.send_message(chat_id, "Spotter notifications muted for the next hour.")
 
 
 @bot.message_handler(
@@ -1230,7 +1769,7 @@ def mute_spots(message):
 def unmute_spots(message):
     chat_id = message.chat.id
     bot.unmute_spots()
-    bot.send_message(chat_id, "Spotter notifications resumed.")
+    bot.outbox.send_message(chat_id, "Spotter notifications resumed.")
 
 
 @bot.message_handler(
@@ -1239,40 +1778,66 @@ def unmute_spots(message):
     ]
 )
 def send_qsv(message):
-    tokens = message.text.split(" ")
+    tokens = message.text.split()
     if len(tokens) == 1:
         choice = random.choice(("MORSE", "CW", "TEXT", "RTTY", "HELL"))
     else:
         choice = tokens[1].upper()
-    if choice == "TEXT":
-        bot.reply_to(message, "…VVVVVVVV…")
+    if choice in synth.MODES and len(tokens) > 2:
+        send_synth(message, choice, tokens[2:])
+    elif choice == "TEXT":
+        bot.outbox.reply_to(message, "…VVVVVVVV…")
     elif choice == "MORSE":
-        bot.reply_to(message, "···— ···— ···— ···—")
-    elif choice == "CW":
-        message = bot.send_voice(
+        bot.outbox.reply_to(message, "···— ···— ···— ···—")
+    elif choice in QSV_CLIPS:
+        assets.send_file(
+            "send_voice",
             message.chat.id,
-            "AwADAQADAgADuQq3EXz85vkZKnreAg",
+            QSV_CLIPS[choice],
             reply_to_message_id=message.message_id,
         )
-    elif choice == "RTTY":
-        message = bot.send_voice(
-            message.chat.id,
-            "AwADAQADAQADuQq3EfwWa3yAVhOTAg",
-            reply_to_message_id=message.message_id,
-        )
-    elif choice == "HELL":
-        message = bot.send_voice(
+
+
+@bot.message_handler(commands=["cw"])
+def send_cw(message):
+    tokens = message.text.split()
+    if len(tokens) == 1:
+        bot.outbox.reply_to(message, "Usage: /cw [WPM or WPM/Farnsworth WPM] <text>, e.g. /cw 18/10 CQ DE VE3FXY")
+        return
+    send_synth(message, "CW", tokens[1:])
+
+
+def send_synth(message, mode, words):
+    """
+    Replies with `words` sent in CW, RTTY or Hell as a voice message.
+    Each clip is rendered and uploaded once; asking for it again reuses
+    the Telegram file_id.
+    """
+    params = {}
+    if mode == "CW":
+        wpm, farnsworth, text = synth.parse_cw(words)
+        params = {"wpm": wpm, "farnsworth": farnsworth}
+    else:
+        text = " ".join(words)
+    try:
+        text = synth.check_text(text)
+        assets.send_rendered(
+            "send_voice",
             message.chat.id,
-            "AwADAQADAwADuQq3EafVsjXqN3z5Ag",
+            (mode, text, sorted(params.items()), synth.SAMPLE_RATE),
+            lambda: synth.encode(synth.MODES[mode](text, **params)),
+            "{0}.ogg".format(mode.lower()),
             reply_to_message_id=message.message_id,
         )
+    except synth.SynthError as e:
+        bot.outbox.reply_to(message, str(e))
 
 
 @bot.message_handler(commands=["mpe", "power_density"])
 def power_density(message):
     tokens = message.text.split()
     if len(tokens) != 5:
-        bot.send_message(
+        bot.outbox.send_message(
             message.chat.id,
             "Usage: /power_density [PEP Watts] [Antenna Gain] [Distance in m] [Frequency in MHz]",
         )
@@ -1283,7 +1848,7 @@ def power_density(message):
             float(tokens[1]), float(tokens[2]), float(tokens[3]), float(tokens[4])
         )
     except (ValueError, TypeError) as e:
-        bot.send_message(message.chat.id, "Error: {0}".format(e))
+        bot.outbox.send_message(message.chat.id, "Error: {0}".format(e))
         return
 
     data["controlled_compliant"] = "Uncompliant"
@@ -1313,7 +1878,7 @@ Minimum distance to compliance from antenna
         **data
     )
 
-    bot.send_message(message.chat.id, text=text, parse_mode="Markdown")
+    bot.outbox.send_message(message.chat.id, text=text, parse_mode="Markdown")
 
 
 def calculate_power_density(watts, gain, distance, frequency, ground=True):
@@ -1371,5 +1936,30 @@ def calculate_power_density(watts, gain, distance, frequency, ground=True):
     }
 
 
+startup.clock.mark("handlers")
+
 if __name__ == "__main__":
-    bot.polling()
+    if METRICS_PORT:
+        metrics.serve(int(METRICS_PORT))
+    if CLUSTER:
+        bot.cluster_mode(
+            REPLICA_ID,
+            CLUSTER_WORKERS,
+            reply_callbacks=(
+                register_callsign_interactive,
+                lookup_definition_interactive,
+                callbook_lookup_interactive,
+            ),
+        )
+    if WEBHOOK_URL:
+        bot.webhook(
+            WEBHOOK_URL,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            secret=WEBHOOK_SECRET,
+            workers=WEBHOOK_WORKERS,
+            cert=WEBHOOK_CERT,
+            key=WEBHOOK_KEY,
+        )
+    else:
+        bot.polling()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+"""
+Uploads each piece of media to Telegram once and sends it by file_id
+from then on.
+
+Media is identified by the SHA-256 of its bytes, so bundled files under
+res/ and generated images (/standards, /conditions) are treated alike:
+the first send uploads them, later sends of the same bytes reuse the
+file_id.  file_ids only work for the bot that uploaded them, so they are
+stored in `hamfurs.media` per bot token (hashed, never the token itself).
+A file_id Telegram no longer accepts is forgotten and the media uploaded
+again.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from io import BytesIO
+from concurrent.futures import Future
+
+from pymongo.errors import PyMongoError
+from telebot import apihelper
+
+from outbox import chain
+
+logger = logging.getLogger("HamfursBot.media")
+
+# Where each send method's result keeps the new file_id
+FILE_IDS = {
+    "send_photo": lambda message: message.photo[-1].file_id,
+    "send_voice": lambda message: message.voice.file_id,
+    "send_audio": lambda message: message.audio.file_id,
+    "send_document": lambda message: message.document.file_id,
+    "send_sticker": lambda message: message.sticker.file_id,
+    "send_animation": lambda message: message.animation.file_id,
+}
+
+
+# How Telegram describes a file_id it won't accept, e.g. "Bad Request:
+# wrong file identifier/HTTP URL specified"
+STALE_FILE_ID = ("file identifier", "file_id", "file reference")
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def stale_file_id(e):
+    """
+    True if `e` is Telegram rejecting the file_id itself, rather than
+    e.g. the chat, the message being replied to or the caption.
+    """
+    if not isinstance(e, apihelper.ApiException) or getattr(e, "error_code", None) != 400:
+        return False
+    description = (getattr(e, "description", None) or str(e)).lower()
+    return any(marker in description for marker in STALE_FILE_ID)
+
+
+class MediaRegistry(object):
+    def __init__(self, collection, outbox, token):
+        self.collection = collection
+        self.outbox = outbox
+        self.token = hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+        self.file_ids = None
+        self.uploads = {}
+        self.assets = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.file_ids or ())
+
+    def load(self):
+        file_ids = {}
+        try:
+            self.collection.create_index([("token", 1), ("hash", 1)], unique=True)
+            for document in self.collection.find({"token": self.token}):
+                file_ids[document["hash"]] = document["file_id"]
+        except PyMongoError as e:
+            logger.error("Unable to load media file_ids: {0}".format(e))
+        self.file_ids = file_ids
+
+    def send_file(self, method, chat_id, path, **kwargs):
+        """
+        Sends a local file with `bot.<method>`, e.g. send_voice.  Returns
+        a Future like the outbox does.
+        """
+        stat = os.stat(path)
+        asset = self.assets.get(path)
+        if asset is None or asset[0] != stat.st_mtime:
+            with open(path, "rb") as f:
+                asset = (stat.st_mtime, content_hash(f.read()))
+            self.assets[path] = asset
+
+        def load():
+            with open(path, "rb") as f:
+                return (os.path.basename(path), BytesIO(f.read()))
+
+        return self.send(method, chat_id, asset[1], load, **kwargs)
+
+    def send_bytes(self, method, chat_id, data, filename, **kwargs):
+        """
+        Sends generated media, uploading it only if these exact bytes
+        haven't been uploaded before.
+        """
+        return self.send(
+            method,
+            chat_id,
+            content_hash(data),
+            lambda: (filename, BytesIO(data)),
+            **kwargs
+        )
+
+    def send_rendered(self, method, chat_id, key, render, filename, **kwargs):
+        """
+        Sends media that is expensive to generate (synthesized audio),
+        identified by `key` (a tuple of everything that affects the
+        output) instead of its bytes.  `render()` returning the bytes is
+        only called if that key has never been uploaded.
+        """
+        digest = "rendered:" + content_hash(repr(key).encode("utf-8"))
+        return self.send(method, chat_id, digest, lambda: (filename, BytesIO(render())), **kwargs)
+
+    def send(self, method, chat_id, digest, load, **kwargs):
+        with self.lock:
+            if self.file_ids is None:
+                self.load()
+            file_id = self.file_ids.get(digest)
+            upload = self.uploads.get(digest)
+            owner = file_id is None and upload is None
+            if owner:
+                upload = Future()
+                self.uploads[digest] = upload
+
+        if owner:
+            # Loading (or rendering) happens outside the lock; anyone else
+            # sending the same media waits on `upload` meanwhile
+            try:
+                data = load()
+            except Exception as e:
+                with self.lock:
+                    self.uploads.pop(digest, None)
+                upload.set_exception(e)
+                raise
+            sent = self.outbox.submit(method, chat_id, chat_id, data, **kwargs)
+            sent.add_done_callback(lambda f: self.uploaded(method, digest, f))
+            sent.add_done_callback(lambda f: chain(f, upload))
+            return upload
+
+        result = Future()
+        if file_id is None:
+            # Someone is uploading these bytes already; wait for their file_id
+            upload.add_done_callback(lambda f: self.resend(method, chat_id, digest, load, result, kwargs))
+            return result
+
+        def sent(future):
+            if stale_file_id(future.exception()):
+                logger.warning("Telegram rejected file_id {0}, uploading again".format(file_id))
+                self.forget(digest, file_id)
+                self.resend(method, chat_id, digest, load, result, kwargs)
+            else:
+                chain(future, result)
+
+        self.outbox.submit(method, chat_id, chat_id, file_id, **kwargs).add_done_callback(sent)
+        return result
+
+    def resend(self, method, chat_id, digest, load, result, kwargs):
+        # Runs in done callbacks, i.e. on an outbox worker: chain the new
+        # send when it completes rather than waiting for it here
+        sent = self.send(method, chat_id, digest, load, **kwargs)
+        sent.add_done_callback(lambda f: chain(f, result))
+
+    def uploaded(self, method, digest, future):
+        file_id = None
+        if future.exception() is None:
+            try:
+                file_id = FILE_IDS[method](future.result())
+            except (KeyError, AttributeError, IndexError, TypeError):
+                logger.error("No file_id in the result of {0}".format(method))
+        with self.lock:
+            self.uploads.pop(digest, None)
+            if file_id is not None:
+                self.file_ids[digest] = file_id
+        if file_id is None:
+            return
+        try:
+            self.collection.replace_one(
+                {"token": self.token, "hash": digest},
+                {
+                    "token": self.token,
+                    "hash": digest,
+                    "method": method,
+                    "file_id": file_id,
+                    "updated": int(time.time()),
+                },
+                upsert=True,
+            )
+        except PyMongoError as e:
+            logger.error("Unable to store file_id for {0}: {1}".format(digest, e))
+
+    def forget(self, digest, file_id):
+        with self.lock:
+            if self.file_ids.get(digest) == file_id:
+                del self.file_ids[digest]
+        try:
+            self.collection.delete_one({"token": self.token, "hash": digest, "file_id": file_id})
+        except PyMongoError as e:
+            logger.error("Unable to forget file_id for {0}: {1}".format(digest, e))
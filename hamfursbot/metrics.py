@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+Minimal in-process metrics with Prometheus text exposition.
+
+Spans are cheap enough for the hot path (a couple of perf_counter calls
+and a bisect), so handlers and upstream calls can be timed everywhere:
+
+  with metrics.span("callook"):
+      req = requests.get(...)
+
+Anything else worth exporting (e.g. cron run stats kept in Mongo) can be
+added with `REGISTRY.collector(func)`, where `func` returns exposition
+lines and is only called when /metrics is scraped.
+"""
+
+import time
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("HamfursBot.metrics")
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, v) for k, v in labels) + "}"
+
+
+class Counter(object):
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value, amount=1):
+        with self.lock:
+            self.values[value] = self.values.get(value, 0) + amount
+
+    def render(self):
+        yield "# HELP {0} {1}".format(self.name, self.help)
+        yield "# TYPE {0} counter".format(self.name)
+        with self.lock:
+            values = sorted(self.values.items())
+        for value, count in values:
+            yield "{0}{1} {2}".format(
+                self.name, format_labels([(self.label, value)]), count
+            )
+
+
+class Histogram(object):
+    def __init__(self, name, help, label, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, seconds):
+        index = bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(value)
+            if series is None:
+                # [per-bucket counts..., +Inf count, sum]
+                series = self.series[value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def render(self):
+        yield "# HELP {0} {1}".format(self.name, self.help)
+        yield "# TYPE {0} histogram".format(self.name)
+        with self.lock:
+            series = sorted((value, list(row)) for value, row in self.series.items())
+        for value, row in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), row[:-1]):
+                cumulative += count
+                yield "{0}_bucket{1} {2}".format(
+                    self.name,
+                    format_labels([(self.label, value), ("le", bound)]),
+                    cumulative,
+                )
+            labels = format_labels([(self.label, value)])
+            yield "{0}_sum{1} {2}".format(self.name, labels, row[-1])
+            yield "{0}_count{1} {2}".format(self.name, labels, cumulative)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, label):
+        metric = Counter(name, help, label)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, label, buckets=BUCKETS):
+        metric = Histogram(name, help, label, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for func in self.collectors:
+            try:
+                lines.extend(func())
+            except Exception as e:
+                logger.error("Metrics collector {0} failed: {1}".format(func.__name__, e))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+handler_seconds = REGISTRY.histogram(
+    "hamfurs_handler_seconds", "Time spent handling one update.", "command"
+)
+handler_errors = REGISTRY.counter(
+    "hamfurs_handler_errors_total", "Updates whose handler raised.", "command"
+)
+dependency_seconds = REGISTRY.histogram(
+    "hamfurs_dependency_seconds", "Time spent in calls to outside services.", "dependency"
+)
+dependency_errors = REGISTRY.counter(
+    "hamfurs_dependency_errors_total", "Calls to outside services that raised.", "dependency"
+)
+
+
+class span(object):
+    """
+    Context manager timing a block into `histogram` under `value`.
+    Exceptions are counted in `errors` and re-raised.
+    """
+
+    __slots__ = ("value", "histogram", "errors", "start")
+
+    def __init__(self, value, histogram=dependency_seconds, errors=dependency_errors):
+        self.value = value
+        self.histogram = histogram
+        self.errors = errors
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(self.value, time.perf_counter() - self.start)
+        if exc_type is not None and self.errors is not None:
+            self.errors.inc(self.value)
+        return False
+
+
+def timed(value, histogram=dependency_seconds):
+    """
+    Decorator form of `span`.
+    """
+
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with span(value, histogram):
+                return func(*args, **kwargs)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    return decorator
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path == "/metrics":
+            body = REGISTRY.render().encode("utf-8")
+            content_type = CONTENT_TYPE
+        elif path in ("", "/health"):
+            # Health check for load balancers and docker
+            body = b"OK\n"
+            content_type = "text/plain"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, listen="0.0.0.0"):
+    """
+    Serve /metrics, and a health check on / and /health, from a
+    background thread.
+    """
+    server = ThreadingHTTPServer((listen, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    logger.info("Serving metrics on {0}:{1}/metrics".format(listen, port))
+    return server
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+"""
+Outbound Telegram request scheduler.
+
+Handlers queue their sends and edits here and return immediately.  A
+few worker threads drain the queue in order, keeping each chat (and the
+bot as a whole) inside Telegram's flood limits with token buckets,
+backing off when Telegram answers 429 with `retry_after`, and collapsing
+queued edits of the same message into the most recent one.  A chat has
+at most one request in flight, so its messages arrive in order while a
+slow upload only holds up its own chat.
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from telebot import apihelper
+
+import metrics
+
+logger = logging.getLogger("HamfursBot.outbox")
+
+# Telegram: ~30 requests/s overall, ~1/s into one chat, ~20/min into groups
+GLOBAL_RATE = 30.0
+GLOBAL_BURST = 30
+PRIVATE_RATE = 1.0
+PRIVATE_BURST = 3
+GROUP_RATE = 20 / 60.0
+GROUP_BURST = 5
+
+MAX_ATTEMPTS = 5
+WORKERS = 4
+# Drop idle buckets and expired holds once there are this many
+PRUNE_AT = 10000
+
+
+def get_retry_after(exception):
+    """
+    Returns the number of seconds Telegram asked us to back off for, or
+    None if `exception` isn't a flood-control error.
+    """
+    if getattr(exception, "error_code", None) != 429:
+        return None
+    result = getattr(exception, "result_json", None) or {}
+    return result.get("parameters", {}).get("retry_after", 1)
+
+
+def chain(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """
+        Seconds until a token is available (0 if one is available now).
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class Job(object):
+    __slots__ = ("method", "chat_id", "args", "kwargs", "key", "future", "attempts")
+
+    def __init__(self, method, chat_id, args, kwargs, key=None):
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.future = Future()
+        self.attempts = 0
+
+
+class Outbox(object):
+    def __init__(self, bot, global_rate=None, global_burst=None, workers=WORKERS):
+        self.bot = bot
+        self.queue = deque()
+        self.edits = {}
+        self.buckets = {}
+        self.holds = {}
+        # Chats with a request being delivered
+        self.sending = set()
+        self.global_bucket = TokenBucket(
+            global_rate or GLOBAL_RATE, global_burst or GLOBAL_BURST
+        )
+        self.condition = threading.Condition()
+        self.running = True
+        self.threads = []
+        for number in range(workers):
+            thread = threading.Thread(target=self.run, name="Outbox-{0}".format(number), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def collect_metrics(self):
+        yield "# HELP hamfurs_outbox_queued Telegram requests waiting in the outbox."
+        yield "# TYPE hamfurs_outbox_queued gauge"
+        yield "hamfurs_outbox_queued {0}".format(len(self.queue))
+
+    def submit(self, method, chat, *args, key=None, **kwargs):
+        """
+        Queue `bot.<method>(*args, **kwargs)` for delivery to `chat`.
+        Returns a Future resolving to the API result.  A pending job with
+        the same `key` is updated in place instead of queueing another.
+        """
+        with self.condition:
+            if key is not None and key in self.edits:
+                job = self.edits[key]
+                job.args = args
+                job.kwargs = kwargs
+                return job.future
+            job = Job(method, chat, args, kwargs, key)
+            self.queue.append(job)
+            if key is not None:
+                self.edits[key] = job
+            self.condition.notify()
+            return job.future
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit("send_message", chat_id, chat_id, text, **kwargs)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.submit(
+            "send_message",
+            message.chat.id,
+            message.chat.id,
+            text,
+            reply_to_message_id=message.message_id,
+            **kwargs
+        )
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self.submit(
+            "edit_message_text",
+            chat_id,
+            text,
+            chat_id=chat_id,
+            message_id=message_id,
+            key=(chat_id, message_id),
+            **kwargs
+        )
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        return self.submit("send_photo", chat_id, chat_id, photo, **kwargs)
+
+    def send_sticker(self, chat_id, sticker, **kwargs):
+        return self.submit("send_sticker", chat_id, chat_id, sticker, **kwargs)
+
+    def send_document(self, chat_id, document, **kwargs):
+        return self.submit("send_document", chat_id, chat_id, document, **kwargs)
+
+    def send_voice(self, chat_id, voice, **kwargs):
+        return self.submit("send_voice", chat_id, chat_id, voice, **kwargs)
+
+    def send_location(self, chat_id, latitude, longitude, **kwargs):
+        return self.submit(
+            "send_location", chat_id, chat_id, latitude, longitude, **kwargs
+        )
+
+    def get_bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            try:
+                private = int(chat_id) > 0
+            except ValueError:
+                # "@channelusername"
+                private = False
+            if private:
+                bucket = TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+            else:
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def prune(self, now):
+        # A full bucket is the same as none at all
+        for chat_id, bucket in list(self.buckets.items()):
+            if bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self.buckets[chat_id]
+        for chat_id, until in list(self.holds.items()):
+            if until <= now:
+                del self.holds[chat_id]
+
+    def next_job(self, now):
+        """
+        Pops the oldest job whose chat may be written to right now.  Later
+        jobs for a chat never overtake an earlier one that is waiting or
+        being delivered.  Returns (job, None) or (None, seconds to wait);
+        the wait is None if only a delivery can free a job.
+        """
+        if len(self.buckets) + len(self.holds) > PRUNE_AT:
+            self.prune(now)
+        wait = self.global_bucket.delay(now)
+        if wait:
+            return None, wait
+        wait = None
+        skipped = set(self.sending)
+        for job in self.queue:
+            if job.chat_id in skipped:
+                continue
+            delay = max(
+                self.holds.get(job.chat_id, 0) - now,
+                self.get_bucket(job.chat_id).delay(now),
+            )
+            if delay <= 0:
+                self.queue.remove(job)
+                if job.key is not None:
+                    del self.edits[job.key]
+                self.global_bucket.take()
+                self.get_bucket(job.chat_id).take()
+                self.sending.add(job.chat_id)
+                return job, None
+            skipped.add(job.chat_id)
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                job, wait = self.next_job(time.monotonic())
+                if job is None:
+                    self.condition.wait(wait)
+                    continue
+            try:
+                self.deliver(job)
+            finally:
+                with self.condition:
+                    self.sending.discard(job.chat_id)
+                    # The chat's next job may be waiting on this one
+                    self.condition.notify()
+
+    def deliver(self, job):
+        job.attempts += 1
+        try:
+            with metrics.span("telegram_" + job.method):
+                result = getattr(self.bot, job.method)(*job.args, **job.kwargs)
+        except apihelper.ApiException as e:
+            retry_after = get_retry_after(e)
+            if retry_after is None or job.attempts >= MAX_ATTEMPTS:
+                logger.error("{0} to {1} failed: {2}".format(job.method, job.chat_id, e))
+                job.future.set_exception(e)
+                return
+            logger.warning(
+                "Flood control on {0}, retrying in {1}s".format(job.chat_id, retry_after)
+            )
+            with self.condition:
+                self.holds[job.chat_id] = time.monotonic() + retry_after
+                newer = self.edits.get(job.key) if job.key is not None else None
+                if newer is not None:
+                    # Superseded while we were waiting; follow the newer edit
+                    newer.future.add_done_callback(lambda f: chain(f, job.future))
+                    return
+                self.queue.appendleft(job)
+                if job.key is not None:
+                    self.edits[job.key] = job
+            return
+        except Exception as e:
+            logger.exception(e)
+            job.future.set_exception(e)
+            return
+        job.future.set_result(result)
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
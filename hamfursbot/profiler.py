@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+"""
+Profiling the running bot without restarting it (/profile, /memsnap,
+/memdiff).
+
+SamplingProfiler walks every thread's stack from a background thread
+every few milliseconds (sys._current_frames), so the threads being
+profiled aren't slowed down by tracing hooks.  The samples come out in
+the collapsed stack format flamegraph.pl and speedscope read, or as a
+self-contained SVG flame graph.
+
+MemoryTracker takes tracemalloc snapshots and diffs them against the
+first one, alongside the sizes of the bot's long-lived containers
+(spot windows, reply handlers, caches) registered with watch().
+tracemalloc only sees allocations made after it started, so take a
+snapshot, wait, then diff.
+"""
+
+import sys
+import time
+import html
+import zlib
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+
+logger = logging.getLogger("HamfursBot.profiler")
+
+INTERVAL = 0.005
+MAX_SECONDS = 300
+TRACE_FRAMES = 10
+TOP = 25
+
+# Flame graph geometry
+WIDTH = 1200
+FRAME_HEIGHT = 16
+MIN_WIDTH = 0.1
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "{0} ({1}:{2})".format(code.co_name, code.co_filename.rsplit("/", 1)[-1], code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def profile(self, seconds):
+        """
+        Samples all other threads for `seconds`.  Returns a Counter of
+        stacks (root first, as tuples of frame names) and the number of
+        samples taken.  Raises ProfilerBusy if a profile is running.
+        """
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running")
+        try:
+            return self.sample(min(seconds, MAX_SECONDS))
+        finally:
+            self.lock.release()
+
+    def sample(self, seconds):
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[tuple(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        return stacks, samples
+
+
+def collapsed(stacks):
+    """
+    One "root;...;leaf count" line per distinct stack.
+    """
+    return "".join(
+        "{0} {1}\n".format(";".join(stack), count) for stack, count in stacks.most_common()
+    )
+
+
+def flamegraph(stacks, title="Flame graph"):
+    """
+    Renders stacks as an SVG flame graph, root at the bottom.  Frames
+    narrower than MIN_WIDTH pixels are left out.
+    """
+    # Merge the stacks into a tree of {name: [count, children]}
+    root = [0, {}]
+    for stack, count in stacks.items():
+        root[0] += count
+        node = root
+        for name in stack:
+            node = node[1].setdefault(name, [0, {}])
+            node[0] += count
+    total = max(root[0], 1)
+
+    rects = []
+    depth = [0]
+
+    def walk(children, x, level):
+        depth[0] = max(depth[0], level + 1)
+        for name, (count, grandchildren) in sorted(children.items()):
+            width = WIDTH * count / total
+            if width >= MIN_WIDTH:
+                rects.append((x, level, width, name, count))
+                walk(grandchildren, x, level + 1)
+            x += width
+
+    walk(root[1], 0, 0)
+    height = (depth[0] + 2) * FRAME_HEIGHT
+    out = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" font-family="monospace" '
+        'font-size="11">'.format(WIDTH, height),
+        '<text x="4" y="12">{0} ({1} samples)</text>'.format(html.escape(title), root[0]),
+    ]
+    for x, level, width, name, count in rects:
+        y = height - (level + 1) * FRAME_HEIGHT
+        # Warm colours, varied by name so neighbours stand apart
+        shade = zlib.crc32(name.encode("utf-8")) % 120
+        label = html.escape(name)
+        out.append(
+            '<g><title>{0} ({1} samples, {2:.1f}%)</title>'
+            '<rect x="{3:.1f}" y="{4}" width="{5:.1f}" height="{6}" fill="rgb(230,{7},50)"/>'
+            '<text x="{8:.1f}" y="{9}">{10}</text></g>'.format(
+                label,
+                count,
+                100.0 * count / total,
+                x,
+                y,
+                width,
+                FRAME_HEIGHT - 1,
+                80 + shade,
+                x + 2,
+                y + FRAME_HEIGHT - 4,
+                # About 7 pixels per character
+                label[: int(width / 7)] if width > 21 else "",
+            )
+        )
+    out.append("</svg>")
+    return "\n".join(out)
+
+
+class MemoryTracker(object):
+    def __init__(self, frames=TRACE_FRAMES):
+        self.frames = frames
+        self.baseline = None
+        self.baseline_sizes = {}
+        self.watched = {}
+        self.lock = threading.Lock()
+
+    def watch(self, name, size):
+        """
+        Reports `size()` (e.g. the length of a cache) in every snapshot.
+        """
+        self.watched[name] = size
+
+    def sizes(self):
+        sizes = {}
+        for name, size in self.watched.items():
+            try:
+                sizes[name] = size()
+            except Exception as e:
+                logger.error("Unable to size {0}: {1}".format(name, e))
+        return sizes
+
+    def snapshot(self):
+        """
+        Starts tracing if needed and takes the baseline snapshot.
+        Returns a report of the largest allocation sites.
+        """
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            self.baseline = tracemalloc.take_snapshot()
+            self.baseline_sizes = self.sizes()
+            stats = self.baseline.statistics("lineno")
+            current, peak = tracemalloc.get_traced_memory()
+        lines = ["Traced {0:.1f} MiB (peak {1:.1f} MiB)".format(current / 2 ** 20, peak / 2 ** 20), ""]
+        lines.extend("{0}: {1}".format(name, value) for name, value in sorted(self.baseline_sizes.items()))
+        lines.append("")
+        lines.extend(str(stat) for stat in stats[:TOP])
+        return "\n".join(lines)
+
+    def diff(self):
+        """
+        Compares a new snapshot with the baseline, biggest growth first,
+        with a traceback for the top sites.  Returns None without a
+        baseline.
+        """
+        with self.lock:
+            if self.baseline is None or not tracemalloc.is_tracing():
+                return None
+            snapshot = tracemalloc.take_snapshot()
+            sizes = self.sizes()
+            by_line = snapshot.compare_to(self.baseline, "lineno")
+            by_trace = snapshot.compare_to(self.baseline, "traceback")
+        lines = []
+        for name in sorted(sizes):
+            before = self.baseline_sizes.get(name)
+            lines.append(
+                "{0}: {1} ({2:+d})".format(name, sizes[name], sizes[name] - before)
+                if isinstance(before, int) and isinstance(sizes[name], int)
+                else "{0}: {1}".format(name, sizes[name])
+            )
+        lines.append("")
+        lines.extend(str(stat) for stat in by_line[:TOP])
+        for stat in by_trace[:3]:
+            lines.append("")
+            lines.append("{0:+.1f} KiB in {1} blocks".format(stat.size_diff / 1024, stat.count_diff))
+            lines.extend(stat.traceback.format())
+        return "\n".join(lines)
+
+    def stop(self):
+        with self.lock:
+            self.baseline = None
+            self.baseline_sizes = {}
+            tracemalloc.stop()
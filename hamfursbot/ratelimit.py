@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+Per-user and per-chat command budgets, so nobody can run up our
+callook.info, HamQTH or hamqsl.com usage.
+
+Each command class (lookup, bulk, conditions) has one budget for
+requests we can answer from a cache or a local callbook and a much
+smaller one for requests that go upstream.  A request spends a token
+from its user's bucket and its chat's bucket (outbox.TokenBucket) and is
+refused if either is empty; the handler then sends a short reply (once
+per wait) instead of calling out.
+
+Buckets live in memory by default.  With several processes (clustered
+mode) MongoBackend keeps them in `hamfurs.ratelimits`, refilling and
+spending each one with a single atomic update, and falls back to memory
+if Mongo can't be reached.
+"""
+
+import time
+import logging
+import datetime
+import threading
+
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+import metrics
+from outbox import TokenBucket
+
+logger = logging.getLogger("HamfursBot.ratelimit")
+
+# (command class, cached): {scope: (tokens per second, burst)}
+BUDGETS = {
+    ("lookup", True): {"user": (30 / 60.0, 15), "chat": (60 / 60.0, 30)},
+    ("lookup", False): {"user": (6 / 60.0, 5), "chat": (20 / 60.0, 10)},
+    ("bulk", True): {"user": (6 / 60.0, 3), "chat": (12 / 60.0, 6)},
+    ("bulk", False): {"user": (1 / 120.0, 2), "chat": (3 / 120.0, 4)},
+    ("conditions", True): {"user": (6 / 60.0, 3), "chat": (12 / 60.0, 6)},
+    ("conditions", False): {"user": (1 / 300.0, 1), "chat": (2 / 300.0, 2)},
+}
+# Drop idle buckets once there are this many
+PRUNE_AT = 10000
+
+limited = metrics.REGISTRY.counter(
+    "hamfurs_ratelimited_total", "Commands refused by the rate limiter.", "command"
+)
+
+
+class MemoryBackend(object):
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, requests):
+        """
+        Spends one token from each (key, rate, burst) bucket if all of
+        them have one.  Returns 0 if they did, otherwise the seconds
+        until they will.
+        """
+        with self.lock:
+            # Read under the lock, so no bucket was updated after `now`
+            now = time.monotonic()
+            if len(self.buckets) > PRUNE_AT:
+                self.prune(now)
+            buckets = []
+            delay = 0
+            for key, rate, burst in requests:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket(rate, burst)
+                    # Otherwise it starts a moment in the future, just
+                    # short of its first token
+                    bucket.updated = now
+                buckets.append(bucket)
+                delay = max(delay, bucket.delay(now))
+            if delay:
+                return delay
+            for bucket in buckets:
+                bucket.take()
+            return 0
+
+    def prune(self, now):
+        # A full bucket is the same as none at all
+        for key, bucket in list(self.buckets.items()):
+            if bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self.buckets[key]
+
+
+class MongoBackend(object):
+    def __init__(self, collection):
+        self.collection = collection
+        self.fallback = MemoryBackend()
+        self.indexed = False
+
+    def take(self, requests):
+        try:
+            if not self.indexed:
+                # Buckets are deleted once they would have refilled
+                self.collection.create_index("expires", expireAfterSeconds=0)
+                self.indexed = True
+            now = time.time()
+            taken = []
+            for key, rate, burst in requests:
+                delay = self.take_one(key, rate, burst, now)
+                if delay:
+                    for key, rate, burst in taken:
+                        self.refund(key, burst)
+                    return delay
+                taken.append((key, rate, burst))
+            return 0
+        except PyMongoError as e:
+            logger.error("Rate limit buckets unavailable, using local ones: {0}".format(e))
+            return self.fallback.take(requests)
+
+    def take_one(self, key, rate, burst, now):
+        refilled = {
+            "$min": [
+                burst,
+                {
+                    "$add": [
+                        {"$ifNull": ["$tokens", burst]},
+                        {"$multiply": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, rate]},
+                    ]
+                },
+            ]
+        }
+        document = self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updated": now}},
+                {
+                    "$set": {
+                        "allowed": {"$gte": ["$tokens", 1]},
+                        "tokens": {
+                            "$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]
+                        },
+                        "expires": datetime.datetime.utcfromtimestamp(now + burst / rate),
+                    }
+                },
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if document["allowed"]:
+            return 0
+        return (1 - document["tokens"]) / rate
+
+    def refund(self, key, burst):
+        self.collection.update_one(
+            {"_id": key},
+            [{"$set": {"tokens": {"$min": [burst, {"$add": ["$tokens", 1]}]}}}],
+        )
+
+
+class RateLimiter(object):
+    def __init__(self, backend=None, budgets=None):
+        self.backend = backend or MemoryBackend()
+        self.budgets = budgets if budgets is not None else BUDGETS
+        self.notified = {}
+        self.lock = threading.Lock()
+
+    def check(self, user_id, chat_id, command, cached):
+        """
+        Spends a token for `command` by `user_id` in `chat_id`.  Returns
+        0 if allowed, otherwise the seconds to wait.
+        """
+        path = "cached" if cached else "upstream"
+        budget = self.budgets[(command, cached)]
+        requests = []
+        for scope, key in (("user", user_id), ("chat", chat_id)):
+            if scope == "chat" and chat_id == user_id:
+                # A private chat's budget is its user's
+                continue
+            rate, burst = budget[scope]
+            requests.append(("{0}:{1}:{2}:{3}".format(scope, key, command, path), rate, burst))
+        delay = self.backend.take(requests)
+        if delay:
+            limited.inc(command)
+        return delay
+
+    def should_notify(self, user_id, command, delay):
+        """
+        True the first time a user is refused within a wait, so refusals
+        get one reply rather than one each.
+        """
+        now = time.monotonic()
+        key = (user_id, command)
+        with self.lock:
+            if self.notified.get(key, 0) > now:
+                return False
+            if len(self.notified) > PRUNE_AT:
+                self.notified = {k: until for k, until in self.notified.items() if until > now}
+            self.notified[key] = now + delay
+            return True
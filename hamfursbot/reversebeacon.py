@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
+import logging
 import telnetlib
 
+logger = logging.getLogger('HamfursBot.rbn')
+
 
 class AttrDict(dict):
   def __init__(self, *args, **kwargs):
@@ -18,7 +21,7 @@ class ReverseBeaconClient(object):
     info = self.conn.read_until(callsign.upper().encode('ascii'), timeout)
 
     tokens = info.decode('ascii').split('\r\n')
-    print(info.decode('ascii'))
+    logger.info(info.decode('ascii'))
     self.local_users = tokens[3].split()[-1]
     self.spot_rate = tokens[5].split()[4]
     
@@ -35,7 +38,7 @@ class ReverseBeaconClient(object):
     
     end_parts = end.split()
     if len(end_parts) < 9:
-      print("Not enough tokens ({0}): '{1}'".format(len(end_parts), raw))
+      logger.warning("Not enough tokens (%d): '%s'", len(end_parts), raw)
     freq = end_parts[0]
     dx = end_parts[1]
     mode =  end_parts[2]
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""
+Aggregates reverse beacon spots for watched callsigns into windows so
+that each station gets at most one Telegram send or edit per window,
+no matter how many skimmers hear it.
+"""
+
+import time
+from collections import deque
+
+# (low kHz, high kHz, name)
+BANDS = [
+    (1800, 2000, "160m"),
+    (3500, 4000, "80m"),
+    (5330, 5410, "60m"),
+    (7000, 7300, "40m"),
+    (10100, 10150, "30m"),
+    (14000, 14350, "20m"),
+    (18068, 18168, "17m"),
+    (21000, 21450, "15m"),
+    (24890, 24990, "12m"),
+    (28000, 29700, "10m"),
+    (50000, 54000, "6m"),
+    (144000, 148000, "2m"),
+]
+
+# Telegram allows roughly 20 messages per minute into the same group
+CHAT_LIMIT = 20
+CHAT_PERIOD = 60
+CHAT_INTERVAL = 1.0
+
+MAX_SKIMMERS = 5
+
+
+def get_band(frequency):
+    """
+    Returns the amateur band name for a frequency in kHz, or None.
+    """
+    try:
+        frequency = float(frequency)
+    except (TypeError, ValueError):
+        return None
+    for low, high, name in BANDS:
+        if low <= frequency <= high:
+            return name
+    return None
+
+
+class ChatRateLimiter(object):
+    """
+    Sliding log limiter: at most `limit` writes per `period` seconds per
+    chat, spaced at least `interval` seconds apart.
+    """
+
+    def __init__(self, limit=CHAT_LIMIT, period=CHAT_PERIOD, interval=CHAT_INTERVAL):
+        self.limit = limit
+        self.period = period
+        self.interval = interval
+        self.history = {}
+
+    def allow(self, chat_id, now=None):
+        if now is None:
+            now = time.time()
+        log = self.history.setdefault(chat_id, deque())
+        while log and now - log[0] > self.period:
+            log.popleft()
+        if len(log) >= self.limit:
+            return False
+        if log and now - log[-1] < self.interval:
+            return False
+        log.append(now)
+        return True
+
+
+class SpotWindow(object):
+    """
+    Everything heard about one callsign since its alert message was sent.
+    """
+
+    def __init__(self, callsign, now):
+        self.callsign = callsign
+        self.opened = now
+        self.flushed = None
+        self.last_heard = now
+        self.count = 0
+        self.skimmers = {}
+        self.snr_min = None
+        self.snr_max = None
+        self.bands = []
+        self.modes = []
+        self.last = None
+        self.message = None
+        self.dirty = False
+
+    def add(self, spot, now):
+        self.count += 1
+        self.last_heard = now
+        self.last = spot
+        self.dirty = True
+        snr = spot["snr"]
+        if spot["skimmer"] not in self.skimmers or snr > self.skimmers[spot["skimmer"]]:
+            self.skimmers[spot["skimmer"]] = snr
+        if self.snr_min is None or snr < self.snr_min:
+            self.snr_min = snr
+        if self.snr_max is None or snr > self.snr_max:
+            self.snr_max = snr
+        band = get_band(spot["frequency"]) or "{0} kHz".format(spot["frequency"])
+        if band not in self.bands:
+            self.bands.append(band)
+        if spot["mode"] not in self.modes:
+            self.modes.append(spot["mode"])
+
+    def summary(self):
+        last = self.last
+        text = "Heard *{0}* calling {1} on {2} operating {3}\n".format(
+            self.callsign, last["match"], last["frequency"], last["mode"]
+        )
+        if self.count == 1:
+            text += "(via {skimmer}, {rate} {units} @ {snr} dB, {time})".format(**last)
+            return text
+
+        best = sorted(self.skimmers.items(), key=lambda row: row[1], reverse=True)
+        skimmers = ", ".join(
+            "{0} ({1} dB)".format(name, snr) for name, snr in best[:MAX_SKIMMERS]
+        )
+        if len(best) > MAX_SKIMMERS:
+            skimmers += " +{0} more".format(len(best) - MAX_SKIMMERS)
+        if self.snr_min == self.snr_max:
+            snr = "{0} dB".format(self.snr_max)
+        else:
+            snr = "{0}–{1} dB".format(self.snr_min, self.snr_max)
+
+        text += "*Spots:* {0} from {1} skimmers, last at {2}\n".format(
+            self.count, len(self.skimmers), last["time"]
+        )
+        text += "*Bands:* {0} ({1})\n".format(", ".join(self.bands), ", ".join(self.modes))
+        text += "*SNR:* {0}\n".format(snr)
+        text += "*Skimmers:* {0}".format(skimmers)
+        return text
+
+
+class SpotAggregator(object):
+    """
+    Collects spots per callsign.  The first spot is flushed straight away
+    as a new alert; anything heard afterwards is batched and edited into
+    that alert at most once every `window` seconds.  Callsigns not heard
+    for `expire` seconds are forgotten, so the next spot starts a fresh
+    alert message.
+    """
+
+    def __init__(self, window=30, expire=300, limiter=None):
+        self.window = window
+        self.expire = expire
+        self.limiter = limiter or ChatRateLimiter()
+        self.windows = {}
+
+    def __contains__(self, callsign):
+        return callsign in self.windows
+
+    def __len__(self):
+        return len(self.windows)
+
+    def add(self, spot, now=None):
+        if now is None:
+            now = time.time()
+        window = self.windows.get(spot["callsign"])
+        if window is None:
+            window = SpotWindow(spot["callsign"], now)
+            self.windows[spot["callsign"]] = window
+        window.add(spot, now)
+        return window
+
+    def cull(self, now=None):
+        if now is None:
+            now = time.time()
+        for callsign in list(self.windows.keys()):
+            window = self.windows[callsign]
+            if not window.dirty and now - window.last_heard > self.expire:
+                del self.windows[callsign]
+
+    def ready(self, chat_id, now=None):
+        """
+        Yields the windows that are due to be written to `chat_id`, oldest
+        first, for as long as the chat's rate limit allows.  Windows that
+        miss out stay dirty and are retried on the next call.
+        """
+        if now is None:
+            now = time.time()
+        self.cull(now)
+        due = [
+            window
+            for window in self.windows.values()
+            if window.dirty
+            and (window.flushed is None or now - window.flushed >= self.window)
+        ]
+        due.sort(key=lambda window: window.flushed or 0)
+        for window in due:
+            if not self.limiter.allow(chat_id, now):
+                return
+            window.dirty = False
+            window.flushed = now
+            yield window
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+Startup timing, and the work that used to hold it up.
+
+main.py times its import in phases (imports, clients, ...) and hands
+anything slow that handlers can live without for a moment (the HamQTH
+login, Mongo index builds) to background threads.  Modules only some
+commands need are imported on first use with lazy().  When the first update
+has been handled the breakdown is logged once, and it stays available
+as hamfurs_startup_seconds on /metrics and through /startup.
+"""
+
+import os
+import time
+import logging
+import importlib
+import threading
+
+import metrics
+
+logger = logging.getLogger("HamfursBot.startup")
+
+
+def process_age():
+    """
+    Seconds since this process was started (Linux), so the clock
+    includes interpreter startup.  0 where /proc isn't available.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name in parentheses may contain spaces
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class StartupClock(object):
+    def __init__(self):
+        self.started = time.perf_counter() - process_age()
+        self.last = self.started
+        self.phases = []
+        self.background_phases = []
+        self.first_update = None
+        self.lock = threading.Lock()
+
+    def mark(self, name):
+        """
+        Ends phase `name`, which ran since the previous mark.
+        """
+        now = time.perf_counter()
+        with self.lock:
+            self.phases.append((name, now - self.last))
+            self.last = now
+
+    def background(self, name, func, *args):
+        """
+        Runs `func(*args)` in a daemon thread, timing it.  Failures are
+        logged, not raised.
+        """
+
+        def run():
+            start = time.perf_counter()
+            try:
+                func(*args)
+                outcome = "ok"
+            except Exception as e:
+                logger.error("Background startup task {0} failed: {1}".format(name, e))
+                outcome = "failed"
+            with self.lock:
+                self.background_phases.append((name, time.perf_counter() - start, outcome))
+
+        thread = threading.Thread(target=run, name="Startup-{0}".format(name), daemon=True)
+        thread.start()
+        return thread
+
+    def handled(self):
+        """
+        Called after every update; the first one completes startup.
+        """
+        if self.first_update is not None:
+            return
+        with self.lock:
+            if self.first_update is not None:
+                return
+            self.first_update = time.perf_counter() - self.started
+        logger.info(self.report(), extra={"phases": dict((n, round(s, 4)) for n, s in self.phases)})
+
+    def report(self):
+        with self.lock:
+            phases = list(self.phases)
+            background = list(self.background_phases)
+            first_update = self.first_update
+        text = "Startup: " + ", ".join("{0} {1:.3f}s".format(name, seconds) for name, seconds in phases)
+        if first_update is not None:
+            text += "; first update handled {0:.3f}s after start".format(first_update)
+        if background:
+            text += "; background: " + ", ".join(
+                "{0} {1:.3f}s ({2})".format(name, seconds, outcome) for name, seconds, outcome in background
+            )
+        return text
+
+    def render(self):
+        yield "# HELP hamfurs_startup_seconds Time spent in each startup phase."
+        yield "# TYPE hamfurs_startup_seconds gauge"
+        with self.lock:
+            phases = list(self.phases)
+            phases.extend((name, seconds) for name, seconds, outcome in self.background_phases)
+            if self.first_update is not None:
+                phases.append(("first_update", self.first_update))
+        for name, seconds in phases:
+            yield "hamfurs_startup_seconds{0} {1}".format(metrics.format_labels([("phase", name)]), seconds)
+
+
+class LazyModule(object):
+    """
+    Stands in for a module that is only imported when one of its
+    attributes is first used; the import time is reported as a
+    background phase.
+    """
+
+    def __init__(self, name, clock):
+        self._name = name
+        self._clock = clock
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    self._module = importlib.import_module(self._name)
+                    with self._clock.lock:
+                        self._clock.background_phases.append(
+                            ("import " + self._name, time.perf_counter() - start, "lazy")
+                        )
+                module = self._module
+        return getattr(module, attr)
+
+
+clock = StartupClock()
+
+
+def lazy(name):
+    return LazyModule(name, clock)
+
+
+metrics.REGISTRY.collector(clock.render)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+Embedded webhook receiver for the bot.
+
+Telegram POSTs each update as JSON to https://<host>/<path>.  The
+request is acknowledged as soon as the body is parsed, and the update
+is handed to a small pool of workers which run it through the bot's
+normal handler registry (`bot.process_new_updates`).  Updates are
+sharded onto workers by chat so each chat is still handled in order.
+The port only takes POSTs; metrics are served on HAMFURS_METRICS_PORT.
+
+Telegram only posts over HTTPS, to port 443, 80, 88 or 8443.  Either
+give the server a certificate and key (HAMFURS_WEBHOOK_CERT and
+HAMFURS_WEBHOOK_KEY) or put it behind a proxy that terminates TLS and
+forwards plain HTTP to HAMFURS_WEBHOOK_PORT.
+
+To try it locally, start the bot with HAMFURS_WEBHOOK_URL set and post
+a recorded update at it:
+
+  curl -H 'Content-Type: application/json' -d @update.json \\
+    http://localhost:8443/<path>
+"""
+
+import ssl
+import json
+import queue
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+logger = logging.getLogger("HamfursBot.webhook")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+UPDATE_TYPES = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+    "callback_query",
+)
+
+
+def get_chat_id(update):
+    """
+    Returns the chat an update JSON document belongs to, or None.
+    """
+    for kind in UPDATE_TYPES:
+        body = update.get(kind)
+        if body is None:
+            continue
+        if kind == "callback_query":
+            body = body.get("message") or {}
+        chat = body.get("chat")
+        if chat is not None:
+            return chat["id"]
+    return None
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    server_version = "HamfursBot"
+    # Don't let a stalled client hold a handler thread forever
+    timeout = 30
+
+    def do_POST(self):
+        server = self.server
+        if self.path.rstrip("/") != server.path:
+            self.send_error(404)
+            return
+        if server.secret and self.headers.get(SECRET_HEADER) != server.secret:
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            update = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+        if not isinstance(update, dict):
+            self.send_error(400)
+            return
+        try:
+            server.dispatch(update)
+        except Exception as e:
+            # Telegram retries anything that isn't a 2xx
+            logger.error("Unable to queue update: {0}".format(e))
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self, bot, listen="0.0.0.0", port=8443, path="/", secret=None, workers=4, sink=None, cert=None, key=None
+    ):
+        """
+        With `sink`, updates are passed to `sink([update])` (the cluster
+        queue) instead of being processed here.  With `cert` (and `key`,
+        unless the cert file has it too), serves HTTPS.
+        """
+        super().__init__((listen, port), WebhookHandler)
+        if cert:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert, key or None)
+            # The handshake happens on the handler thread's first read,
+            # so a slow client can't stall accept()
+            self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+        self.bot = bot
+        self.path = path.rstrip("/")
+        self.secret = secret
+        self.sink = sink
+        self.queues = []
+        if sink is not None:
+            workers = 0
+        for number in range(workers):
+            inbox = queue.Queue()
+            worker = threading.Thread(
+                target=self.work, args=(inbox,), name="Webhook-{0}".format(number)
+            )
+            worker.daemon = True
+            worker.start()
+            self.queues.append(inbox)
+
+    def dispatch(self, update):
+        if self.sink is not None:
+            self.sink([update])
+            return
+        chat_id = get_chat_id(update) or 0
+        self.queues[hash(chat_id) % len(self.queues)].put(update)
+
+    def work(self, inbox):
+        while True:
+            update = inbox.get()
+            if update is None:
+                return
+            try:
+                self.bot.process_new_updates([types.Update.de_json(update)])
+            except Exception as e:
+                logger.exception(e)
+
+    def shutdown(self):
+        super().shutdown()
+        for inbox in self.queues:
+            inbox.put(None)